@@ -1,9 +1,16 @@
+import bisect
 import json
+import logging
+import threading
 from datetime import datetime
 from json import JSONDecodeError
+from time import monotonic, sleep
 from typing import Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from app import settings
 
 
 class Fuse5APIException(Exception):
@@ -11,10 +18,32 @@ class Fuse5APIException(Exception):
 
 
 class Fuse5Client:
-    def __init__(self, api_key: str, api_url: str, timeout: int = 30):
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+    MAX_BACKOFF_TIME = 30
+
+    # upper bounds in seconds of the latency histograms buckets
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self, api_key: str, api_url: str, timeout: int = 30, max_retries: int = None,
+                 backoff_factor: float = None, pool_size: int = 10, logger: logging.Logger = None):
         self.api_key = api_key
         self.api_url = api_url
         self.timeout = timeout
+        self.max_retries = settings.FUSE5_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_factor = settings.FUSE5_RETRY_BACKOFF_FACTOR if backoff_factor is None else backoff_factor
+        self.logger = logger or logging.getLogger(__name__)
+
+        # keeps the connections alive between the calls
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._latencies: dict[str, dict] = {}
+        self._latencies_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
 
     def export_to_csv(self, fields: list[str], changed_since: datetime = None) -> str:
         identifier = None
@@ -28,7 +57,8 @@ class Fuse5Client:
         return self._request("location/all")['data']
 
     def create_sales_order(self, params: dict):
-        return self._request("sales_order/create", params=params)['data']
+        # not idempotent, so the order could be created twice if the request is retried after a timeout
+        return self._request("sales_order/create", params=params, retry=False)['data']
 
     def search_sales_order_by_customer_order_id(self, account_number: str, customer_order_id: str) -> dict | None:
         if orders := self.get_sales_orders(account_number=account_number, customerpo=customer_order_id):
@@ -96,16 +126,34 @@ class Fuse5Client:
                  params: dict | list = None,
                  identifier: dict = None,
                  method: str = 'POST',
-                 timeout: int = None
+                 timeout: int = None,
+                 retry: bool = True
                  ):
         timeout = timeout or self.timeout
+        max_retries = self.max_retries if retry else 0
+        data = {'data': json.dumps(self._get_request_data(api_endpoint, params, identifier))}
 
-        res = requests.request(
-            method,
-            self.api_url,
-            data={'data': json.dumps(self._get_request_data(api_endpoint, params, identifier))},
-            timeout=timeout
-        )
+        for attempt in range(max_retries + 1):
+            started_at = monotonic()
+
+            try:
+                res = self.session.request(method, self.api_url, data=data, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                self._record_latency(api_endpoint, monotonic() - started_at, failed=True)
+
+                if attempt < max_retries:
+                    self._backoff(api_endpoint, attempt, e)
+                    continue
+                raise e
+
+            self._record_latency(api_endpoint, monotonic() - started_at,
+                                 failed=res.status_code in self.RETRY_STATUS_CODES)
+
+            if res.status_code in self.RETRY_STATUS_CODES and attempt < max_retries:
+                self._backoff(api_endpoint, attempt, f"HTTP {res.status_code}")
+                continue
+
+            break
 
         res.raise_for_status()
 
@@ -121,6 +169,42 @@ class Fuse5Client:
 
         return res_data
 
+    def _backoff(self, api_endpoint: str, attempt: int, reason):
+        wait_time = min(self.backoff_factor * 2 ** attempt, self.MAX_BACKOFF_TIME)
+        self.logger.warning("The Fuse5 %s request failed (%s). Retrying in %s sec", api_endpoint, reason, wait_time)
+        sleep(wait_time)
+
+    def _record_latency(self, api_endpoint: str, latency: float, failed: bool = False):
+        with self._latencies_lock:
+            stats = self._latencies.setdefault(api_endpoint, dict(
+                count=0, failed=0, total=0.0, max=0.0, buckets=[0] * len(self.LATENCY_BUCKETS)
+            ))
+
+            stats['count'] += 1
+            stats['failed'] += failed
+            stats['total'] += latency
+            stats['max'] = max(stats['max'], latency)
+            stats['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def latency_metrics(self) -> dict[str, dict]:
+        """
+        Returns requests count, failed requests count, average and max latency and the latency histogram
+        as {"<=bucket upper bound": requests count} by the API endpoints
+        """
+
+        with self._latencies_lock:
+            return {
+                api_endpoint: dict(
+                    count=stats['count'],
+                    failed=stats['failed'],
+                    avg=round(stats['total'] / stats['count'], 3),
+                    max=round(stats['max'], 3),
+                    histogram={f"<={bound}": count for bound, count in zip(self.LATENCY_BUCKETS, stats['buckets'])
+                               if count}
+                )
+                for api_endpoint, stats in self._latencies.items()
+            }
+
     def _get_request_data(self,
                           api_endpoint: str,
                           params: dict | list = None,
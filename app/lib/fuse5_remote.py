@@ -1,18 +1,23 @@
+import csv
+import io
 import logging
 import tempfile
 from abc import abstractmethod
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 from html import unescape
 from pathlib import Path
-from typing import BinaryIO
+from typing import BinaryIO, Iterable
 
 import pandas as pd
 import requests
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils.timezone import now
 
 from app import settings
 from app.lib.fuse5_client import Fuse5Client
+from app.lib.products_finder import ProductsFinder
 from app.settings import EXPORT_CSV_FILEPATH
 
 
@@ -49,19 +54,61 @@ class Fuse5FieldsMap(BaseFieldsMap):
     LOCATION_NAME = ('location_name', str)
 
 
+class UnescapedCSVReader(io.TextIOBase):
+    """
+    File-like object reading CSV rows one by one and converting HTML entities like &amp; in the values to text.
+    Only a few rows are kept in memory, so it can feed a huge CSV file into `cursor.copy_expert`.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self._rows = csv.reader(lines)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size is None or size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+
+            self._writer.writerow([unescape(value) for value in row])
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+        if size is None or size < 0:
+            chunk, self._pending = self._pending, ''
+        else:
+            chunk, self._pending = self._pending[:size], self._pending[size:]
+
+        return chunk
+
+
 class Fuse5RemoteBase:
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, fuse5_client: Fuse5Client, logger: logging.Logger = None):
         self.logger = logger or logging.getLogger(__name__)
         self.fuse5_client = fuse5_client
 
-    @staticmethod
-    def _download_csv(url: str, save_to: Path | BinaryIO):
-        response = requests.get(url)
-        if response.ok:
-            if isinstance(save_to, Path):
-                save_to.write_bytes(response.content)
-            else:
-                save_to.write(response.content)
+    def _download_csv(self, url: str, save_to: Path | BinaryIO):
+        with requests.get(url, stream=True, timeout=60) as response:
+            if not response.ok:
+                self.logger.error("Unable to download the file %s - %s", url, response.status_code)
+                return
+
+            f = save_to.open('wb') if isinstance(save_to, Path) else save_to
+
+            try:
+                for chunk in response.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            finally:
+                if isinstance(save_to, Path):
+                    f.close()
 
     def get_data_from_remote(self, save_to: Path | BinaryIO, changed_since: datetime = None):
         csv_url = self.get_csv_url_from_remote(changed_since)
@@ -109,11 +156,8 @@ class Fuse5CSV(Fuse5RemoteBase):
 
     def get_data(self, update_from_remote: bool = False) -> pd.DataFrame:
         if update_from_remote:
-            # TODO use changed_since to get only items changed since previous sync
-            self.get_data_from_remote(
-                save_to=EXPORT_CSV_FILEPATH,
-                changed_since=pd.to_datetime(settings.FUSE5_LOAD_DATA_CHANGED_SINCE)
-            )
+            # the file is replaced by the export, so it has to contain all products
+            self.get_data_from_remote(save_to=EXPORT_CSV_FILEPATH)
             suppliers_df = self._read_data()
 
         else:
@@ -127,6 +171,17 @@ class Fuse5CSV(Fuse5RemoteBase):
 
 
 class Fuse5DB(Fuse5RemoteBase):
+    """
+    Keeps the Fuse5 products in the DB table.
+
+    Usually only the products changed since the previous update are loaded from Fuse5 and upserted into the table.
+    Once in `settings.FUSE5_FULL_RECONCILIATION_DAYS` days all products are loaded, and the ones missed in the export
+    are deleted. The time of the update is stored in the `updated_at` column of upserted products, so the max value is
+    the time of the previous update and the min value is the time of the previous full reconciliation.
+    """
+
+    # the same expressions are used by the unique index on the table
+    UNIQUE_KEY_EXPRESSIONS = ("COALESCE(line_code, '')", "COALESCE(sku, '')", "COALESCE(location_name, '')")
 
     @classmethod
     def exists(cls):
@@ -142,17 +197,47 @@ class Fuse5DB(Fuse5RemoteBase):
 
         return df
 
-    def update_from_remote(self):
+    def is_full_update_required(self) -> bool:
+        from products_sync.models import Fuse5Products
+
+        if not settings.FUSE5_INCREMENTAL_UPDATE or not self.exists():
+            return True
+
+        if Fuse5Products.objects.filter(updated_at__isnull=True).exists():
+            return True
+
+        last_full_update = Fuse5Products.objects.aggregate(Min('updated_at'))['updated_at__min']
+
+        return last_full_update < now() - timedelta(days=settings.FUSE5_FULL_RECONCILIATION_DAYS)
+
+    def get_changed_since(self) -> datetime | None:
+        from products_sync.models import Fuse5Products
+
+        if last_update := Fuse5Products.objects.aggregate(Max('updated_at'))['updated_at__max']:
+            # overlapping with the previous update to not miss anything because of different time zones
+            return last_update - timedelta(hours=settings.FUSE5_CHANGED_SINCE_OVERLAP_HOURS)
+
+        return None
+
+    def update_from_remote(self, full: bool = None):
+        if full is None:
+            full = self.is_full_update_required()
+
+        changed_since = None if full else self.get_changed_since()
+        updated_at = now()
+
+        if full:
+            self.logger.info("Loading all suppliers products")
+        else:
+            self.logger.info("Loading suppliers products changed since %s", changed_since)
+
         with tempfile.NamedTemporaryFile(mode='wb', delete=True) as tmp_file:
-            self.get_data_from_remote(
-                save_to=tmp_file,
-                changed_since=pd.to_datetime(settings.FUSE5_LOAD_DATA_CHANGED_SINCE)
-            )
-            self.save_csv_2_DB(Path(tmp_file.name))
+            self.get_data_from_remote(save_to=tmp_file, changed_since=changed_since)
+            tmp_file.flush()
+            self.save_csv_2_DB(Path(tmp_file.name), full=full, updated_at=updated_at)
 
     def get_data(self, update_from_remote: bool = False) -> pd.DataFrame:
         if update_from_remote:
-            # TODO use changed_since to get only items changed since previous sync
             self.update_from_remote()
 
         self.logger.info("Loading suppliers data from DB")
@@ -160,38 +245,63 @@ class Fuse5DB(Fuse5RemoteBase):
 
         return suppliers_df
 
-    def save_csv_2_DB(self, csv_file_path: Path):
+    def save_csv_2_DB(self, csv_file_path: Path, full: bool = True, updated_at: datetime = None):
+        """
+        Copies the CSV file into the temporary table and upserts it into the products table in one transaction,
+        so the table is never empty for other readers.
+        :param csv_file_path:
+        :param full: the file contains all products, so the products missed in it have to be deleted
+        :param updated_at: the time of the update
+        """
+
         from products_sync.models import Fuse5Products
 
         if not csv_file_path.exists() or csv_file_path.stat().st_size == 0:
             self.logger.warning("The suppliers CSV file doesn't exists or is empty")
             return
 
+        updated_at = updated_at or now()
         table_name = Fuse5Products._meta.db_table
-        with connection.cursor() as cursor:
-            # read the csv file with pandas
-            df = pd.read_csv(csv_file_path)
-
-            # iterate over each column and apply html.unescape to convert entities like &amp; to text
-            for col in df.columns:
-                df[col] = df[col].apply(lambda x: unescape(x) if isinstance(x, str) else x)
-
-            # overwrite the csv file with cleaned data
-            df.to_csv(csv_file_path, index=False, header=True)
+        staging_table_name = f"{table_name}_staging"
+        columns = ','.join([db_col for db_col in Fuse5FieldsMap.as_dict_flipped().values()])
+        update_columns = ','.join(
+            f"{col} = EXCLUDED.{col}" for col in [*columns.split(','), 'sku_normalized', 'barcode_key', 'updated_at']
+        )
+        unique_key = ', '.join(self.UNIQUE_KEY_EXPRESSIONS)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging_table_name} ON COMMIT DROP AS "
+                f"SELECT {columns} FROM {table_name} WITH NO DATA"
+            )
+            # numbers the rows in the file order, so the last one of the duplicated rows wins
+            cursor.execute(f"ALTER TABLE {staging_table_name} ADD COLUMN row_number BIGSERIAL")
 
-            copy_sql = """
-                       COPY {table_name}({columns})
-                       FROM stdin WITH CSV HEADER
-                       DELIMITER as ','
-                       """
+            # the rows are streamed from the file with HTML entities converted to text on the fly
+            with csv_file_path.open(newline='') as f:
+                cursor.copy_expert(
+                    sql=f"COPY {staging_table_name}({columns}) FROM stdin WITH CSV HEADER DELIMITER as ','",
+                    file=UnescapedCSVReader(f)
+                )
 
-            columns = ','.join([db_col for db_col in Fuse5FieldsMap.as_dict_flipped().values()])
+            cursor.execute(
+                f"""
+                INSERT INTO {table_name}({columns}, sku_normalized, barcode_key, updated_at)
+                SELECT DISTINCT ON ({unique_key}) {columns}, {ProductsFinder.SKU_NORMALIZED_SQL},
+                    {ProductsFinder.BARCODE_KEY_SQL}, %s
+                FROM {staging_table_name}
+                ORDER BY {unique_key}, row_number DESC
+                ON CONFLICT ({', '.join(f'({expr})' for expr in self.UNIQUE_KEY_EXPRESSIONS)})
+                DO UPDATE SET {update_columns}
+                """,
+                [updated_at]
+            )
+            self.logger.info("%s suppliers products have been updated", cursor.rowcount)
 
-            # drop all data before copying
-            cursor.execute("TRUNCATE {table_name} RESTART IDENTITY".format(table_name=table_name))
+            if full:
+                cursor.execute(f"DELETE FROM {table_name} WHERE updated_at < %s OR updated_at IS NULL", [updated_at])
+                self.logger.info("%s suppliers products missed in the full export have been deleted",
+                                 cursor.rowcount)
 
-            with csv_file_path.open() as f:
-                cursor.copy_expert(
-                    sql=copy_sql.format(table_name=table_name, columns=columns),
-                    file=f
-                )
+            # it is dropped on commit only, which is not the end of an outer transaction
+            cursor.execute(f"DROP TABLE {staging_table_name}")
@@ -3,18 +3,92 @@ import logging
 import re
 import sqlite3
 from abc import abstractmethod
+from typing import Callable
 
+import more_itertools as mit
 import pandas as pd
 from django.db.models import Model, QuerySet
 
+from app import settings
+
 
 class BaseProductsFinder:
     table_name: str
 
+    RGX_SC_NUM = re.compile(r"\d+\.\d+E\+\d+")
+    RGX_NOT_DIGITS = re.compile(r"\D")
+    MAX_BARCODE_LENGTH = 14
+
     def __init__(self, logger: logging.Logger = None, default_location_name: str = None):
         self.default_location_name = default_location_name
         self.logger = logger or logging.getLogger(__name__)
 
+    @classmethod
+    def clean_barcode(cls, barcode: str | None) -> str | None:
+        """
+        Returns the barcode digits with expanded scientific notation, the leading zeros are kept
+        """
+
+        if barcode is None:
+            return None
+
+        barcode = barcode.strip()
+
+        # barcodes broken by spreadsheets like 1.23456E+11
+        if cls.RGX_SC_NUM.fullmatch(barcode):
+            number = round(float(barcode))
+
+            # expanded to more digits than any barcode has, it can't be restored
+            if number >= 10 ** cls.MAX_BARCODE_LENGTH:
+                return None
+
+            barcode = str(number)
+
+        return cls.RGX_NOT_DIGITS.sub('', barcode)
+
+    @classmethod
+    def clean_barcodes(cls, barcodes: pd.Series) -> pd.Series:
+        """
+        Vectorized `clean_barcode`
+        """
+
+        barcodes = barcodes.astype('string').str.strip()
+
+        is_sc_num = barcodes.str.fullmatch(cls.RGX_SC_NUM.pattern).fillna(False).astype(bool)
+        if is_sc_num.any():
+            numbers = pd.to_numeric(barcodes[is_sc_num]).round()
+
+            # the same limit as `clean_barcode` has, it also keeps the numbers in the int64 range
+            numbers = numbers[numbers < 10 ** cls.MAX_BARCODE_LENGTH]
+            barcodes[is_sc_num] = numbers.astype('int64').astype(str).reindex(barcodes.index[is_sc_num])
+
+        return barcodes.str.replace(cls.RGX_NOT_DIGITS.pattern, '', regex=True)
+
+    @classmethod
+    def normalize_barcode(cls, barcode: str | None) -> str | None:
+        """
+        Returns the canonical barcode key - digits only, without leading zeros and with expanded scientific notation.
+        The keys longer than `MAX_BARCODE_LENGTH` are None, they can't be matched anyway
+        """
+
+        barcode = cls.clean_barcode(barcode)
+        if barcode is None:
+            return None
+
+        barcode_key = barcode.lstrip('0')
+
+        return barcode_key if len(barcode_key) <= cls.MAX_BARCODE_LENGTH else None
+
+    @classmethod
+    def normalize_barcodes(cls, barcodes: pd.Series) -> pd.Series:
+        """
+        Vectorized `normalize_barcode`
+        """
+
+        barcode_keys = cls.clean_barcodes(barcodes).str.lstrip('0')
+
+        return barcode_keys.mask((barcode_keys.str.len() > cls.MAX_BARCODE_LENGTH).fillna(False))
+
     def fill_default_location(self, df: pd.DataFrame):
         if self.default_location_name is not None:
             if 'location_name' not in df.columns:
@@ -32,6 +106,10 @@ class BaseProductsFinder:
     def find_by_sku(self, sku: str) -> pd.DataFrame:
         ...
 
+    @abstractmethod
+    def find_by_barcode_keys(self, barcode_keys: list) -> pd.DataFrame:
+        ...
+
     def find_products_by_sku(self, shopify_variant_data: dict) -> list[dict] | None:
         sku = shopify_variant_data['sku']
         supplier_products = self.find_by_sku(sku)
@@ -41,35 +119,40 @@ class BaseProductsFinder:
 
         return supplier_products.to_dict(orient='records')
 
-    def find_product_by_barcode_and_sku(self, shopify_variant_data: dict) -> dict | None:
-        def log_no_sku_warning(_supplier_products: list[dict]):
-            if len(_supplier_products) > 1:
-                msg_tmpl = "A few products with the barcode %s have been found in the supplier's data, but no one " \
-                           "matched the SKU %s. Will use the first one.\n Shopify product:%s \nSupplier's products:"
-            else:
-                msg_tmpl = "A product with the barcode %s has been found in the supplier's data, but the SKU %s do " \
-                           "not match. \n\tShopify product:%s \n\tSupplier's product:"
+    def log_no_sku_warning(self, shopify_variant_data: dict, supplier_products: list[dict]):
+        barcode, sku = shopify_variant_data['barcode'], shopify_variant_data['sku']
+
+        if len(supplier_products) > 1:
+            msg_tmpl = "A few products with the barcode %s have been found in the supplier's data, but no one " \
+                       "matched the SKU %s. Will use the first one.\n Shopify product:%s \nSupplier's products:"
+        else:
+            msg_tmpl = "A product with the barcode %s has been found in the supplier's data, but the SKU %s do " \
+                       "not match. \n\tShopify product:%s \n\tSupplier's product:"
 
-            shopify_variant_data_str = "\n\t\tproduct_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode} ".format(
-                **shopify_variant_data)
+        shopify_variant_data_str = "\n\t\tproduct_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode} ".format(
+            **shopify_variant_data)
 
-            msg = msg_tmpl % (barcode, sku, shopify_variant_data_str)
+        msg = msg_tmpl % (barcode, sku, shopify_variant_data_str)
 
-            for product in _supplier_products:
-                msg += "\n\t\tbarcode={barcode}; sku={sku}".format(**product)
-                if 'product_name' in product:
-                    msg += "; name=%s" % html.unescape(product['product_name'] or '')
+        for product in supplier_products:
+            msg += "\n\t\tbarcode={barcode}; sku={sku}".format(**product)
+            if 'product_name' in product:
+                msg += "; name=%s" % html.unescape(product['product_name'] or '')
 
-            self.logger.warning(msg)
+        self.logger.warning(msg)
 
+    def find_by_barcode(self, barcode: str) -> pd.DataFrame:
+        # create variants of the barcode of different length by filling leading zeros
+        barcodes = [barcode.zfill(i) for i in range(len(barcode), 15)]
+        return self.find_by_barcodes(barcodes)
+
+    def find_product_by_barcode_and_sku(self, shopify_variant_data: dict) -> dict | None:
         barcode, sku = shopify_variant_data['barcode'], shopify_variant_data['sku']
 
         if barcode is None:
             return None
 
-        # create variants of the barcode of different length by filling leading zeros
-        barcodes = [barcode.zfill(i) for i in range(len(barcode), 15)]
-        supplier_products = self.find_by_barcodes(barcodes)
+        supplier_products = self.find_by_barcode(barcode)
 
         if supplier_products.empty:
             return None
@@ -79,33 +162,259 @@ class BaseProductsFinder:
         if sku is not None:
             narrowed_by_sku = supplier_products[supplier_products['sku'] == sku]
             if narrowed_by_sku.empty:
-                log_no_sku_warning(supplier_products.to_dict("records"))
+                self.log_no_sku_warning(shopify_variant_data, supplier_products.to_dict("records"))
             else:
                 found_product = narrowed_by_sku.iloc[0]
 
         return found_product.to_dict()
 
+    def find_many_by_barcode_and_sku(self, variants: list[dict]) -> dict[int, dict]:
+        """
+        Matches a page of Shopify variants by one lookup, using the same rules as `find_product_by_barcode_and_sku`
+        :param variants: should contain `id`, `product_id`, `sku` and `barcode` keys
+        :return: found supplier's products by variant ids
+        """
+
+        variants_df = self._get_variants_barcode_keys_df(variants)
+        if variants_df.empty:
+            return {}
+
+        supplier_products = self.find_by_barcode_keys(variants_df['barcode_key'].unique().tolist())
+        records = supplier_products.to_dict('records')
+
+        # the barcodes read from CSV files may be numbers
+        supplier_barcodes = supplier_products['barcode'].astype('string')
+        barcodes_df = pd.DataFrame({
+            'barcode_key': self.normalize_barcodes(supplier_barcodes).astype(object),
+            'supplier_barcode_length': supplier_barcodes.str.len(),
+            'supplier_sku': supplier_products['sku'],
+            'offset': range(len(supplier_products)),
+        })
+
+        return self._match_by_barcode_keys(variants_df, barcodes_df, records.__getitem__)
+
+    def _get_variants_barcode_keys_df(self, variants: list[dict]) -> pd.DataFrame:
+        variants_df = pd.DataFrame(variants, columns=['id', 'product_id', 'sku', 'barcode'])
+        variants_df = variants_df[variants_df['barcode'].fillna('') != '']
+
+        variants_df = variants_df.assign(
+            barcode_key=self.normalize_barcodes(variants_df['barcode']).astype(object),
+            barcode_length=variants_df['barcode'].str.len()
+        )
+
+        return variants_df[variants_df['barcode_key'].fillna('') != '']
+
+    def _match_by_barcode_keys(self, variants_df: pd.DataFrame, barcodes_df: pd.DataFrame,
+                               get_record: Callable[[int], dict]) -> dict[int, dict]:
+        """
+        :param variants_df: variants with `barcode_key` and `barcode_length` columns
+        :param barcodes_df: supplier's products with `barcode_key`, `supplier_barcode_length`, `supplier_sku` and
+         `offset` columns, where the offset is passed to `get_record` to get the whole product
+        """
+
+        matches = variants_df.merge(barcodes_df, on='barcode_key')
+
+        # the same as searching among the barcode variants filled by leading zeros up to the max barcode length
+        matches = matches[
+            (matches['barcode_length'] <= matches['supplier_barcode_length'])
+            & (matches['supplier_barcode_length'] <= self.MAX_BARCODE_LENGTH)
+        ]
+
+        if matches.empty:
+            return {}
+
+        # the first product with the same SKU wins, otherwise just the first one with the barcode
+        matches = matches.assign(sku_matched=matches['sku'].notna() & (matches['sku'] == matches['supplier_sku']))
+        matches = matches.sort_values(['id', 'sku_matched', 'offset'], ascending=[True, False, True])
+        found = matches.groupby('id', sort=False).head(1)
+
+        not_matched_by_sku = found.loc[found['sku'].notna() & ~found['sku_matched'], 'id']
+        if not not_matched_by_sku.empty:
+            variants_data = variants_df.set_index('id')
+            offsets_by_variant = matches[matches['id'].isin(not_matched_by_sku)].groupby('id')['offset'].agg(list)
+
+            for variant_id, offsets in offsets_by_variant.items():
+                shopify_variant_data = variants_data.loc[variant_id, ['product_id', 'sku', 'barcode']].to_dict()
+                self.log_no_sku_warning(
+                    shopify_variant_data | {'id': variant_id},
+                    [get_record(offset) for offset in offsets]
+                )
+
+        return {variant_id: get_record(offset) for variant_id, offset in zip(found['id'], found['offset'])}
+
 
 class ProductsFinder(BaseProductsFinder):
+    """
+    Searches products in the supplier's DB table.
+
+    With `preload_index=True` the whole table is loaded once and indexed in memory by the normalized barcode and SKU,
+    so the lookups don't touch the DB. If the table has more than `settings.PRODUCTS_FINDER_INDEX_MAX_ROWS` records,
+    it falls back to querying the DB for every lookup.
+    """
+
+    # the only definition of the SKU normalization, `normalize_sku`, `normalize_skus` and the SQL expression
+    # used to fill `sku_normalized` in bulk are built from it
+    RGX_SKU_SEPARATORS = re.compile(r"[-_ ]")
+    SKU_NORMALIZED_SQL = f"lower(regexp_replace(sku, '{RGX_SKU_SEPARATORS.pattern}', '', 'g'))"
+
+    # the same normalization as `normalize_barcode` does, `substring` gives NULL for the too long keys
+    BARCODE_KEY_SQL = rf"""
+        substring(
+            ltrim(
+                CASE WHEN trim(barcode) ~ '^\d+\.\d+E\+\d+$' THEN round(trim(barcode)::numeric)::text
+                ELSE regexp_replace(barcode, '\D', '', 'g') END,
+                '0'
+            ),
+            '^\d{{0,{BaseProductsFinder.MAX_BARCODE_LENGTH}}}$'
+        )
+    """
 
     def __init__(self, supplier_products: QuerySet | Model, logger: logging.Logger = None,
-                 default_location_name: str = None):
+                 default_location_name: str = None, preload_index: bool = False):
         super().__init__(logger, default_location_name)
 
         self.supplier_products = supplier_products if isinstance(supplier_products,
                                                                  QuerySet) else supplier_products
         self.table_name = self.supplier_products.model._meta.db_table
 
+        self._fields: list[str] = []
+        self._rows: list[tuple] = []
+        self._barcode_index: dict[str, list[int]] = {}
+        self._sku_index: dict[str, list[int]] = {}
+        self._barcodes_df: pd.DataFrame | None = None
+        self.is_indexed = False
+
+        if preload_index:
+            self.load_index()
+
+    @classmethod
+    def normalize_sku(cls, sku: str | None) -> str | None:
+        if sku is None:
+            return None
+
+        return cls.RGX_SKU_SEPARATORS.sub('', sku).lower()
+
+    @classmethod
+    def normalize_skus(cls, skus: pd.Series) -> pd.Series:
+        """
+        Vectorized `normalize_sku`
+        """
+
+        return skus.astype('string').str.replace(cls.RGX_SKU_SEPARATORS.pattern, '', regex=True).str.lower()
+
+    def load_index(self):
+        records_count = self.supplier_products.count()
+
+        if records_count > settings.PRODUCTS_FINDER_INDEX_MAX_ROWS:
+            self.logger.info("The supplier's data contains %s records, which is too many to index in memory. "
+                             "The products will be searched in the DB", records_count)
+            return
+
+        self.logger.info("Indexing %s supplier's products for search...", records_count)
+
+        self._fields = [field.attname for field in self.supplier_products.model._meta.concrete_fields]
+        self._rows = list(self.supplier_products.order_by('pk').values_list(*self._fields))
+
+        barcode_pos, sku_pos = self._fields.index('barcode'), self._fields.index('sku')
+
+        for offset, row in enumerate(self._rows):
+            if barcode_key := self.normalize_barcode(row[barcode_pos]):
+                self._barcode_index.setdefault(barcode_key, []).append(offset)
+
+            if sku_key := self.normalize_sku(row[sku_pos]):
+                self._sku_index.setdefault(sku_key, []).append(offset)
+
+        # the same barcodes index, but as a frame to match a lot of variants at once by merging
+        self._barcodes_df = pd.DataFrame(
+            [
+                (barcode_key, len(self._rows[offset][barcode_pos]), self._rows[offset][sku_pos], offset)
+                for barcode_key, offsets in self._barcode_index.items()
+                for offset in offsets
+            ],
+            columns=['barcode_key', 'supplier_barcode_length', 'supplier_sku', 'offset']
+        )
+
+        self.is_indexed = True
+
+    def _get_indexed_record(self, offset: int) -> dict:
+        record = dict(zip(self._fields, self._rows[offset]))
+
+        if self.default_location_name is not None and record.get('location_name') is None:
+            record['location_name'] = self.default_location_name
+
+        return record
+
+    def find_product_by_barcode_and_sku(self, shopify_variant_data: dict) -> dict | None:
+        if not self.is_indexed:
+            return super().find_product_by_barcode_and_sku(shopify_variant_data)
+
+        barcode, sku = shopify_variant_data['barcode'], shopify_variant_data['sku']
+
+        if not barcode:
+            return None
+
+        # the same as searching among the barcode variants filled by leading zeros up to the max barcode length
+        offsets = self._barcode_index.get(self.normalize_barcode(barcode), [])
+        supplier_products = [
+            record for record in map(self._get_indexed_record, offsets)
+            if len(barcode) <= len(record['barcode']) <= self.MAX_BARCODE_LENGTH
+        ]
+
+        if not supplier_products:
+            return None
+
+        if sku is not None:
+            if found_product := next((p for p in supplier_products if p['sku'] == sku), None):
+                return found_product
+
+            self.log_no_sku_warning(shopify_variant_data, supplier_products)
+
+        return supplier_products[0]
+
+    def find_many_by_barcode_and_sku(self, variants: list[dict]) -> dict[int, dict]:
+        if not self.is_indexed:
+            return super().find_many_by_barcode_and_sku(variants)
+
+        variants_df = self._get_variants_barcode_keys_df(variants)
+        if variants_df.empty:
+            return {}
+
+        return self._match_by_barcode_keys(variants_df, self._barcodes_df, self._get_indexed_record)
+
+    def find_products_by_sku(self, shopify_variant_data: dict) -> list[dict] | None:
+        if not self.is_indexed:
+            return super().find_products_by_sku(shopify_variant_data)
+
+        if not (sku_key := self.normalize_sku(shopify_variant_data['sku'])):
+            return None
+
+        if offsets := self._sku_index.get(sku_key):
+            return [self._get_indexed_record(offset) for offset in offsets]
+
+        return None
+
     def find_by_barcodes(self, barcodes: list) -> pd.DataFrame:
         filtered_records = self.supplier_products.filter(barcode__in=barcodes)
         return self._get_found_df(filtered_records)
 
-    def find_by_sku(self, sku: str) -> pd.DataFrame:
-        # filtered_records = self.supplier_products.filter(sku__iexact=sku)
+    def find_by_barcode(self, barcode: str) -> pd.DataFrame:
+        barcode_key = self.normalize_barcode(barcode)
+        df = self._get_found_df(self.supplier_products.filter(barcode_key=barcode_key).order_by('pk')
+                                if barcode_key else self.supplier_products.none())
+
+        # the same as searching among the barcode variants filled by leading zeros up to the max barcode length
+        lengths = df['barcode'].str.len()
+        return df[(len(barcode) <= lengths) & (lengths <= self.MAX_BARCODE_LENGTH)]
 
-        regex_pattern = re.sub(r'(.)', '\g<1>[-_ ]*', re.sub(r"[-_ ]", '', sku))
-        regex_pattern = f"^{regex_pattern}$"
-        filtered_records = self.supplier_products.filter(sku__iregex=regex_pattern)
+    def find_by_barcode_keys(self, barcode_keys: list) -> pd.DataFrame:
+        filtered_records = self.supplier_products.filter(barcode_key__in=barcode_keys).order_by('pk')
+        return self._get_found_df(filtered_records)
+
+    def find_by_sku(self, sku: str) -> pd.DataFrame:
+        # an empty key would match all the products without SKU
+        sku_key = self.normalize_sku(sku)
+        filtered_records = self.supplier_products.filter(sku_normalized=sku_key) if sku_key \
+            else self.supplier_products.none()
 
         return self._get_found_df(filtered_records)
 
@@ -122,15 +431,18 @@ class ProductsFinder(BaseProductsFinder):
 
 
 class SqliteProductsFinder(BaseProductsFinder):
+    SQLITE_MAX_PARAMS = 900
+
     def __init__(self, df: pd.DataFrame, logger: logging.Logger = None, default_location_name: str = None):
         super().__init__(logger, default_location_name)
         self.table_name = 'supplier_products'
 
         self.logger.info('Indexing suppliers data for search...')
         self.sqlite_conn = sqlite3.connect(':memory:')
-        df.to_sql('supplier_products', self.sqlite_conn)
+        df.assign(barcode_key=self.normalize_barcodes(df['barcode'])).to_sql('supplier_products', self.sqlite_conn)
 
         self.sqlite_conn.execute("CREATE INDEX barcode_idx ON supplier_products (barcode)")
+        self.sqlite_conn.execute("CREATE INDEX barcode_key_idx ON supplier_products (barcode_key)")
 
     def __del__(self):
         self.sqlite_conn.close()
@@ -145,6 +457,25 @@ class SqliteProductsFinder(BaseProductsFinder):
 
         return df
 
+    def find_by_barcode_keys(self, barcode_keys: list) -> pd.DataFrame:
+        # SQLite limits the number of the query parameters
+        dfs = [
+            pd.read_sql_query(
+                f"SELECT * FROM {self.table_name} WHERE barcode_key IN ({','.join(['?'] * len(chunk))})",
+                self.sqlite_conn, params=chunk
+            )
+            for chunk in mit.chunked(barcode_keys, self.SQLITE_MAX_PARAMS)
+        ]
+
+        df = pd.concat(dfs, ignore_index=True) if dfs else pd.read_sql_query(
+            f"SELECT * FROM {self.table_name} LIMIT 0", self.sqlite_conn
+        )
+
+        # the helper columns are not the supplier's data
+        df = df.sort_values('index', ignore_index=True).drop(columns=['index', 'barcode_key'])
+
+        return self.fill_default_location(df)
+
     @abstractmethod
     def find_by_sku(self, sku: str) -> pd.DataFrame:
         raise NotImplementedError
@@ -1,37 +1,187 @@
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
 from http.client import IncompleteRead
-from time import sleep
+from queue import Queue, Full
+from time import sleep, monotonic
 from typing import Type, Iterator, Iterable
 import logging
 
-import pandas as pd
+import more_itertools as mit
+import redis
+import requests
 from decouple import config
 from pyactiveresource.connection import ClientError, ResourceNotFound
 import shopify
-from shopify import ShopifyResource, Variant, Location, Limits
-from shopify.collection import PaginatedIterator
+from shopify import ShopifyResource, Variant, Location
+from shopify.collection import PaginatedCollection
+
+from app import settings
+from app.lib.shopify_rate_limiter import ShopifyRateLimiter, ShopifyAPI
+
+
+class ShopifyGraphQLException(Exception):
+    pass
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache of the limited size, which items expire in `ttl` seconds
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self._lock:
+            if (item := self._items.get(key)) is None:
+                return default
+
+            expires_at, value = item
+            if expires_at < monotonic():
+                del self._items[key]
+                return default
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
 
 class ShopifyClient:
     # RATE_LIMIT_WAIT_TIME = 30
     DEFAULT_LOCATION_NAME = "One Guy Garage"
+    API_VERSION = '2024-01'
+
+    MAX_RETRIES = 5
+    MAX_BACKOFF_TIME = 30
+
+    # the cost is used to reserve points from the bucket before the request, the actual one comes in the response
+    GRAPHQL_DEFAULT_COST = 10
+    # every productVariantsBulkUpdate costs 10 points of the 1000 points GraphQL bucket
+    PRODUCTS_PER_PRICES_MUTATION = 25
+    # keeps the URL of the inventory levels request short enough
+    INVENTORY_ITEMS_PER_REQUEST = 50
+    # the requests of all threads are paced by the shared rate limiter
+    INVENTORY_LEVELS_WORKERS = 4
+
+    VARIANTS_CACHE_SIZE = 10_000
+    VARIANTS_CACHE_TTL = 5 * 60
+
+    # max number of quantities Shopify accepts in one inventorySetQuantities mutation
+    QUANTITIES_PER_INVENTORY_MUTATION = 250
+
+    INVENTORY_SET_QUANTITIES_MUTATION = """
+        mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+            inventorySetQuantities(input: $input) {
+                userErrors { field message }
+            }
+        }
+    """
+
+    BULK_OPERATION_POLL_INTERVAL = 5
+    BULK_OPERATION_TIMEOUT = 60 * 60
+
+    BULK_VARIANTS_QUERY = """
+        {
+            productVariants {
+                edges {
+                    node {
+                        id
+                        title
+                        sku
+                        barcode
+                        price
+                        inventoryQuantity
+                        updatedAt
+                        product { id }
+                        inventoryItem {
+                            id
+                            inventoryLevels {
+                                edges {
+                                    node {
+                                        location { id }
+                                        quantities(names: ["available"]) { name quantity }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    """
+
+    BULK_OPERATION_RUN_QUERY_MUTATION = """
+        mutation bulkOperationRunQuery($query: String!) {
+            bulkOperationRunQuery(query: $query) {
+                bulkOperation { id status }
+                userErrors { field message }
+            }
+        }
+    """
+
+    BULK_OPERATION_CANCEL_MUTATION = """
+        mutation bulkOperationCancel($id: ID!) {
+            bulkOperationCancel(id: $id) {
+                userErrors { field message }
+            }
+        }
+    """
+
+    CURRENT_BULK_OPERATION_QUERY = """
+        {
+            currentBulkOperation {
+                id
+                status
+                errorCode
+                objectCount
+                url
+            }
+        }
+    """
 
     def __init__(self, shop_name: str, api_token: str, page_size: int = 250, logger: logging.Logger = None,
-                 on_page_callback: callable = None) -> None:
+                 on_page_callback: callable = None, graphql_url: str = None,
+                 rate_limiter: ShopifyRateLimiter = None, prefetch_pages: int = 0) -> None:
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
             self.logger.setLevel(config('DJANGO_LOG_LEVEL'))
 
+        self.shop_name = shop_name
         self.page_size = page_size
+        self.prefetch_pages = prefetch_pages
         shop_url = f"{shop_name}.myshopify.com"
-        api_version = '2024-01'
-        session = shopify.Session(shop_url, api_version, api_token)
-        shopify.ShopifyResource.activate_session(session)
+        self.session = shopify.Session(shop_url, self.API_VERSION, api_token)
         self.client = shopify
+        self.activate_session()
+
+        self.graphql_url = graphql_url or f"https://{shop_url}/admin/api/{self.API_VERSION}/graphql.json"
+        self.http_session = requests.Session()
+        self.http_session.headers.update({'X-Shopify-Access-Token': api_token})
+
+        # shared by all workers, so the concurrent syncs don't exceed the API limits together
+        self.rate_limiter = rate_limiter or ShopifyRateLimiter(redis.from_url(settings.REDIS_URL), shop_name,
+                                                               self.logger)
 
         self.callback = on_page_callback
+        self.variants_cache = TTLCache(self.VARIANTS_CACHE_SIZE, self.VARIANTS_CACHE_TTL)
 
         self.locations: list = self.get_locations()
         self.default_location: Location = self.find_location_by_name(self.DEFAULT_LOCATION_NAME)
@@ -41,6 +191,14 @@ class ShopifyClient:
     def __del__(self):
         self.client.ShopifyResource.clear_session()
 
+    def activate_session(self):
+        """
+        The headers and the connection of the `shopify` resources are thread local, so the session should be activated
+        in every thread making the REST requests, otherwise they are sent without the access token
+        """
+
+        self.client.ShopifyResource.activate_session(self.session)
+
     def get_locations(self) -> list[Location]:
         return self.call_with_rate_limit(self.client.Location.find)
 
@@ -71,11 +229,16 @@ class ShopifyClient:
 
         return inventory_level.available
 
-    def set_inventory_level(self, variant: Variant, quantity: int, location: Location | str | None = None):
+    def get_location(self, location: Location | str | None = None) -> Location:
         if location is None:
-            location = self.default_location
+            return self.default_location
         elif isinstance(location, str):
-            location = self.find_location_by_name(location) or self.default_location
+            return self.find_location_by_name(location) or self.default_location
+
+        return location
+
+    def set_inventory_level(self, variant: Variant, quantity: int, location: Location | str | None = None):
+        location = self.get_location(location)
 
         inventory_level = self.call_with_rate_limit(
             self.client.InventoryLevel.set,
@@ -94,19 +257,193 @@ class ShopifyClient:
             variant.price = float(variant.price)
             yield variant
 
+    def bulk_variants(self) -> Iterator[Variant]:
+        """
+        Exports only the needed fields of all variants by the GraphQL bulk operation. Unlike `variants` it also
+        receives the available quantities by locations, which are set to the `inventory_levels` attribute of the
+        variants as {location_id: available}.
+        """
+
+        result_url = self.run_bulk_operation(self.BULK_VARIANTS_QUERY)
+
+        if result_url is None:
+            return
+
+        for variant in self._iter_bulk_variants(self._iter_jsonl(result_url)):
+            yield variant
+
+            if self.callback is not None:
+                if not self.callback():
+                    return
+
+    def run_bulk_operation(self, query: str) -> str | None:
+        """
+        Starts the bulk operation and waits till it is completed. The operation is cancelled if the waiting is aborted
+        by the callback or takes more than `BULK_OPERATION_TIMEOUT` seconds.
+        :return: url of the JSONL file with results or None if there are no results or the waiting is aborted
+        """
+
+        data = self.graphql(self.BULK_OPERATION_RUN_QUERY_MUTATION, dict(query=query))['bulkOperationRunQuery']
+
+        if data['userErrors']:
+            raise ShopifyGraphQLException(data['userErrors'])
+
+        bulk_operation_id = data['bulkOperation']['id']
+        self.logger.info("The bulk operation %s has been started", bulk_operation_id)
+
+        deadline = monotonic() + self.BULK_OPERATION_TIMEOUT
+
+        while True:
+            bulk_operation = self.graphql(self.CURRENT_BULK_OPERATION_QUERY, cost=1)['currentBulkOperation']
+
+            if bulk_operation is None or bulk_operation['id'] != bulk_operation_id:
+                raise ShopifyGraphQLException("The bulk operation %s is not found" % bulk_operation_id)
+
+            if bulk_operation['status'] == 'COMPLETED':
+                self.logger.info("The bulk operation %s has been completed, %s objects have been exported",
+                                 bulk_operation_id, bulk_operation['objectCount'])
+                return bulk_operation['url']
+
+            if bulk_operation['status'] not in ('CREATED', 'RUNNING'):
+                raise ShopifyGraphQLException("The bulk operation %s is %s (%s)" % (
+                    bulk_operation_id, bulk_operation['status'], bulk_operation['errorCode']))
+
+            if self.callback is not None and not self.callback():
+                self.cancel_bulk_operation(bulk_operation_id)
+                return None
+
+            if monotonic() > deadline:
+                self.cancel_bulk_operation(bulk_operation_id)
+                raise ShopifyGraphQLException("The bulk operation %s is not completed in %s sec" % (
+                    bulk_operation_id, self.BULK_OPERATION_TIMEOUT))
+
+            sleep(self.BULK_OPERATION_POLL_INTERVAL)
+
+    def cancel_bulk_operation(self, bulk_operation_id: str):
+        try:
+            data = self.graphql(self.BULK_OPERATION_CANCEL_MUTATION, dict(id=bulk_operation_id))['bulkOperationCancel']
+            if data['userErrors']:
+                raise ShopifyGraphQLException(data['userErrors'])
+        except Exception as e:
+            self.logger.warning("Unable to cancel the bulk operation %s - %s", bulk_operation_id, e)
+        else:
+            self.logger.info("The bulk operation %s has been cancelled", bulk_operation_id)
+
+    def _iter_jsonl(self, url: str) -> Iterator[dict]:
+        with self.http_session.get(url, stream=True, timeout=60, headers={'X-Shopify-Access-Token': None}) as response:
+            response.raise_for_status()
+
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def _iter_bulk_variants(self, lines: Iterator[dict]) -> Iterator[Variant]:
+        """
+        The lines of inventory levels refer to their variants by __parentId. They come after the line of the variant,
+        but not necessarily right after it, so the variants are yielded when the whole file has been read.
+        """
+
+        variants: dict[str, Variant] = dict()
+
+        for line in lines:
+            if '__parentId' not in line:
+                variants[line['id']] = self._bulk_line_to_variant(line)
+
+            elif (variant := variants.get(line['__parentId'])) is not None:
+                available = next((q['quantity'] for q in line['quantities'] if q['name'] == 'available'), None)
+                variant.inventory_levels[self.from_gid(line['location']['id'])] = available
+
+            else:
+                raise ShopifyGraphQLException("The parent %s of the bulk operation line is not found" %
+                                              line['__parentId'])
+
+        yield from variants.values()
+
+    def _bulk_line_to_variant(self, line: dict) -> Variant:
+        # the prefix options are not split out of the attributes, otherwise `product_id` is moved out of them
+        variant = self.client.Variant(dict(
+            id=self.from_gid(line['id']),
+            product_id=self.from_gid(line['product']['id']),
+            title=line['title'],
+            sku=line['sku'],
+            barcode=line['barcode'],
+            price=float(line['price']),
+            inventory_quantity=line['inventoryQuantity'],
+            inventory_item_id=self.from_gid(line['inventoryItem']['id']),
+            updated_at=line.get('updatedAt')
+        ), prefix_options={})
+
+        # not a resource attribute, so it is never sent back to Shopify on saving
+        object.__setattr__(variant, 'inventory_levels', dict())
+
+        return variant
+
     def orders(self, since_id: int = None, **params):
         if since_id is not None:
             params['since_id'] = since_id
 
         return self._iter_objects(self.client.Order, **params)
 
+    def _iter_pages(self, resource: Type[ShopifyResource], **params) -> Iterator[PaginatedCollection]:
+        page = self.call_with_rate_limit(resource.find, limit=self.page_size, **params)
+
+        while True:
+            yield page
+
+            if not isinstance(page, PaginatedCollection) or not page.has_next_page():
+                return
+
+            page = self.call_with_rate_limit(page.next_page, no_cache=True)
+
+    def _iter_pages_prefetched(self, pages: Iterator[PaginatedCollection]) -> Iterator[PaginatedCollection]:
+        """
+        Fetches the next pages in the background thread while the current one is being processed.
+        Not more than `self.prefetch_pages` pages are kept in memory.
+        """
+
+        pages_queue = Queue(maxsize=self.prefetch_pages)
+        stopped = threading.Event()
+        end_of_pages = object()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    pages_queue.put(item, timeout=1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def fetch_pages():
+            try:
+                self.activate_session()
+
+                for fetched_page in pages:
+                    if not put(fetched_page):
+                        return
+                put(end_of_pages)
+            except Exception as e:
+                put(e)
+
+        threading.Thread(target=fetch_pages, daemon=True, name='shopify_pages_prefetch').start()
+
+        try:
+            while (page := pages_queue.get()) is not end_of_pages:
+                if isinstance(page, Exception):
+                    raise page
+
+                yield page
+        finally:
+            stopped.set()
+
     def _iter_objects(self, resource: Type[ShopifyResource], **params) -> Iterator:
         if 'ids' not in params:
             total_objects_count = self.call_with_rate_limit(resource.count, **params)
             self.logger.info("The total %ss count is %s" % (resource.__name__.lower(), total_objects_count))
 
-        objects = self.call_with_rate_limit(resource.find, limit=self.page_size, **params)
-        pages = PaginatedIterator(objects)
+        pages = self._iter_pages(resource, **params)
+        if self.prefetch_pages:
+            pages = self._iter_pages_prefetched(pages)
 
         try:
             for page_idx, page in enumerate(pages):
@@ -127,43 +464,246 @@ class ShopifyClient:
         return self.call_with_rate_limit(object.save)
 
     @staticmethod
-    def call_with_rate_limit(method: callable, *args, **kwargs):
-        max_retries = 5
+    def to_gid(resource_name: str, object_id: int) -> str:
+        return f"gid://shopify/{resource_name}/{object_id}"
+
+    @staticmethod
+    def from_gid(gid: str) -> int:
+        return int(gid.rsplit('/', 1)[-1])
+
+    def graphql(self, query: str, variables: dict = None, cost: int = GRAPHQL_DEFAULT_COST) -> dict:
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire(ShopifyAPI.GRAPHQL, cost)
+
+            response = self.http_session.post(self.graphql_url, json=dict(query=query, variables=variables or {}),
+                                              timeout=60)
+
+            if response.status_code == 429 and attempt < self.MAX_RETRIES:
+                self.rate_limiter.throttled(ShopifyAPI.GRAPHQL)
+                self._backoff(attempt, response.headers.get('Retry-After'))
+                continue
+
+            response.raise_for_status()
+            res = response.json()
+
+            self.rate_limiter.update_from_graphql_extensions(res.get('extensions'))
+
+            if errors := res.get('errors'):
+                if attempt < self.MAX_RETRIES and any(e.get('extensions', {}).get('code') == 'THROTTLED'
+                                                      for e in errors):
+                    self.rate_limiter.throttled(ShopifyAPI.GRAPHQL)
+                    self._backoff(attempt)
+                    continue
+
+                raise ShopifyGraphQLException(errors)
+
+            return res['data']
+
+    def update_variants_prices(self, prices: Iterable[tuple[int, int, float]]) -> dict[int, str]:
+        """
+        Updates prices of a lot of variants by a few GraphQL productVariantsBulkUpdate mutations
+        :param prices: (product_id, variant_id, price) items
+        :return: error messages by variant ids for not updated variants
+        """
 
-        while max_retries:
-            max_retries -= 1
+        variants_by_products = dict()
+        for product_id, variant_id, price in prices:
+            variants_by_products.setdefault(product_id, []).append((variant_id, price))
+
+        errors = dict()
+
+        for products_batch in mit.batched(variants_by_products.items(), self.PRODUCTS_PER_PRICES_MUTATION):
+            variables_definitions, mutations, variables = [], [], {}
+
+            for idx, (product_id, variants) in enumerate(products_batch):
+                variables_definitions.append(f"$productId{idx}: ID!, $variants{idx}: [ProductVariantsBulkInput!]!")
+                mutations.append(
+                    f"p{idx}: productVariantsBulkUpdate(productId: $productId{idx}, variants: $variants{idx}) "
+                    "{ userErrors { field message } }"
+                )
+                variables[f"productId{idx}"] = self.to_gid('Product', product_id)
+                variables[f"variants{idx}"] = [
+                    dict(id=self.to_gid('ProductVariant', variant_id), price=str(price)) for variant_id, price in variants
+                ]
+
+            query = "mutation updateVariantsPrices(%s) {\n%s\n}" % (', '.join(variables_definitions),
+                                                                      '\n'.join(mutations))
+
+            try:
+                data = self.graphql(query, variables, cost=self.GRAPHQL_DEFAULT_COST * len(products_batch))
+            except Exception as e:
+                errors.update({variant_id: str(e) for _, variants in products_batch for variant_id, _ in variants})
+                continue
+
+            for idx, (product_id, variants) in enumerate(products_batch):
+                for user_error in (data.get(f"p{idx}") or {}).get('userErrors', []):
+                    field = user_error.get('field') or []
+
+                    # the field looks like ['variants', '0', 'price'] pointing to the variant in the input list
+                    failed_variants = variants
+                    if len(field) > 1 and field[0] == 'variants' and str(field[1]).isdigit():
+                        failed_variants = variants[int(field[1]):int(field[1]) + 1] or variants
+
+                    for variant_id, _ in failed_variants:
+                        errors[variant_id] = user_error['message']
+
+        return errors
+
+    def set_inventory_levels(self, changes: Iterable[tuple[int, int, int]]) -> dict[tuple[int, int], str]:
+        """
+        Sets available quantities of a lot of inventory items by a few GraphQL inventorySetQuantities mutations
+        :param changes: (inventory_item_id, location_id, quantity) items
+        :return: error messages by (inventory_item_id, location_id) for not updated items
+        """
+
+        errors = dict()
+
+        for changes_batch in mit.batched(changes, self.QUANTITIES_PER_INVENTORY_MUTATION):
+            variables = {
+                'input': {
+                    'name': 'available',
+                    'reason': 'correction',
+                    'ignoreCompareQuantity': True,
+                    'quantities': [
+                        dict(
+                            inventoryItemId=self.to_gid('InventoryItem', inventory_item_id),
+                            locationId=self.to_gid('Location', location_id),
+                            quantity=quantity
+                        )
+                        for inventory_item_id, location_id, quantity in changes_batch
+                    ]
+                }
+            }
+
+            keys = [(inventory_item_id, location_id) for inventory_item_id, location_id, _ in changes_batch]
 
             try:
-                is_limit_maxed = Limits.credit_maxed()
+                data = self.graphql(self.INVENTORY_SET_QUANTITIES_MUTATION, variables)
             except Exception as e:
-                is_limit_maxed = True
-                logging.error(e)
+                errors.update({key: str(e) for key in keys})
+                continue
 
-            if is_limit_maxed:
-                logging.debug("Rate limit maxed. Sleeping 1 sec")
-                sleep(1)
+            for user_error in (data.get('inventorySetQuantities') or {}).get('userErrors', []):
+                field = user_error.get('field') or []
+
+                # the field looks like ['input', 'quantities', '0', 'locationId'] pointing to the changed item
+                failed_keys = keys
+                if len(field) > 2 and field[1] == 'quantities' and str(field[2]).isdigit():
+                    failed_keys = keys[int(field[2]):int(field[2]) + 1] or keys
+
+                for key in failed_keys:
+                    errors[key] = user_error['message']
+
+        return errors
+
+    def call_with_rate_limit(self, method: callable, *args, **kwargs):
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire(ShopifyAPI.REST)
 
             try:
                 return method(*args, **kwargs)
             except ClientError as e:
                 if e.code == 429:
+                    self.rate_limiter.throttled(ShopifyAPI.REST)
+                    self._backoff(attempt, e.response.headers.get('Retry-After'))
                     continue
                 raise e
+            finally:
+                self._update_rest_rate_limit()
 
-    def get_inventory_levels(self, inventory_item_ids: Iterable[int], location_ids: Iterable[int]) -> pd.DataFrame:
-        inventory_levels = self.call_with_rate_limit(
-            self.client.InventoryLevel.find,
-            location_ids=','.join(map(str, location_ids)),
-            inventory_item_ids=','.join(map(str, inventory_item_ids)),
-            limit=self.page_size
-        )
-
-        return inventory_levels
+    def _update_rest_rate_limit(self):
+        # the connection is thread local, so it has the response to the last request of the calling thread
+        try:
+            response = getattr(ShopifyResource.connection, 'response', None)
+            if response is not None:
+                self.rate_limiter.update_from_rest_header(
+                    response.headers.get(ShopifyRateLimiter.REST_CALL_LIMIT_HEADER)
+                )
+        except Exception as e:
+            logging.error(e)
+
+    def _backoff(self, attempt: int, retry_after: str | None = None):
+        wait_time = float(retry_after) if retry_after else min(2 ** attempt, self.MAX_BACKOFF_TIME)
+        logging.debug("Rate limit maxed. Sleeping %s sec", wait_time)
+        sleep(wait_time)
+
+    def get_inventory_levels(self, inventory_item_ids: Iterable[int],
+                             location_ids: Iterable[int]) -> dict[tuple[int, int], int | None]:
+        """
+        Fetches inventory levels by chunks of items in parallel threads, following the pagination of every chunk
+        :return: available quantities by (inventory_item_id, location_id) for all the requested pairs,
+                 None if the item is not stocked at the location
+        """
+
+        inventory_item_ids, location_ids = list(inventory_item_ids), list(location_ids)
+        location_ids_param = ','.join(map(str, location_ids))
+
+        def fetch_inventory_levels(inventory_item_ids_chunk: list[int]) -> dict[tuple[int, int], int]:
+            self.activate_session()
+
+            pages = self._iter_pages(
+                self.client.InventoryLevel,
+                location_ids=location_ids_param,
+                inventory_item_ids=','.join(map(str, inventory_item_ids_chunk))
+            )
+
+            return {(item.inventory_item_id, item.location_id): item.available for page in pages for item in page}
+
+        inventory_levels = dict()
+
+        with ThreadPoolExecutor(max_workers=self.INVENTORY_LEVELS_WORKERS) as executor:
+            chunks = mit.chunked(inventory_item_ids, self.INVENTORY_ITEMS_PER_REQUEST)
+            for chunk_inventory_levels in executor.map(fetch_inventory_levels, chunks):
+                inventory_levels.update(chunk_inventory_levels)
+
+        return {
+            (inventory_item_id, location_id): inventory_levels.get((inventory_item_id, location_id))
+            for inventory_item_id in inventory_item_ids
+            for location_id in location_ids
+        }
+
+    def get_order(self, order_id: int) -> shopify.Order | None:
+        try:
+            return self.call_with_rate_limit(self.client.Order.find, order_id)
+        except ResourceNotFound:
+            return None
 
     def get_variant(self, variant_id: int) -> Variant | None:
         if variant_id is None:
             return None
+
+        if variant_id in self.variants_cache:
+            return self.variants_cache.get(variant_id)
+
         try:
-            return self.call_with_rate_limit(self.client.Variant.find, variant_id)
+            variant = self.call_with_rate_limit(self.client.Variant.find, variant_id)
         except ResourceNotFound:
-            return None
+            variant = None
+
+        self.variants_cache.set(variant_id, variant)
+
+        return variant
+
+    def get_variants(self, variant_ids: Iterable[int]) -> dict[int, Variant]:
+        """
+        Fetches a lot of variants by a few requests and keeps them in the cache, so `get_variant` doesn't request them
+        :return: found variants by ids
+        """
+
+        variant_ids = {variant_id for variant_id in variant_ids if variant_id is not None}
+        variants = {variant_id: self.variants_cache.get(variant_id) for variant_id in variant_ids
+                    if variant_id in self.variants_cache}
+
+        for chunk in mit.chunked(variant_ids - variants.keys(), self.page_size):
+            found = {
+                variant.id: variant
+                for variant in self.call_with_rate_limit(self.client.Variant.find, ids=','.join(map(str, chunk)),
+                                                         limit=self.page_size)
+            }
+
+            # the deleted variants are cached as well, so they are not requested one by one
+            for variant_id in chunk:
+                variants[variant_id] = found.get(variant_id)
+                self.variants_cache.set(variant_id, variants[variant_id])
+
+        return {variant_id: variant for variant_id, variant in variants.items() if variant is not None}
@@ -0,0 +1,175 @@
+import logging
+from enum import StrEnum
+from time import sleep
+
+import redis
+
+
+class ShopifyAPI(StrEnum):
+    REST = 'rest'
+    GRAPHQL = 'graphql'
+
+
+class ShopifyRateLimiter:
+    """
+    Leaky bucket rate limiter for the Shopify API shared by all processes through Redis.
+
+    Every request of `ShopifyClient`, the next pages of the paginated REST results included, acquires its cost
+    before it is sent. The state of the buckets is estimated locally by the restore rate and corrected by the limits
+    Shopify returns (the REST `X-Shopify-Shop-Api-Call-Limit` header and the GraphQL `throttleStatus`). A small reserve
+    of the bucket is left unused, as the estimation is corrected only by the responses to the requests already sent.
+    """
+
+    REST_CALL_LIMIT_HEADER = 'X-Shopify-Shop-Api-Call-Limit'
+
+    # defaults for the standard plan, till the actual values are received from Shopify
+    DEFAULT_BUCKETS = {
+        ShopifyAPI.REST: dict(capacity=40, restore_rate=2),
+        ShopifyAPI.GRAPHQL: dict(capacity=1000, restore_rate=50),
+    }
+
+    RESERVE = 0.1
+    KEYS_EXPIRE = 3600
+
+    # returns the number of seconds to wait before the cost can be spent, or 0 if it has been spent
+    ACQUIRE_SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+        local capacity = tonumber(redis.call('HGET', KEYS[1], 'capacity') or ARGV[2])
+        local restore_rate = tonumber(redis.call('HGET', KEYS[1], 'restore_rate') or ARGV[3])
+        local available = tonumber(redis.call('HGET', KEYS[1], 'available') or capacity)
+        local updated_at = tonumber(redis.call('HGET', KEYS[1], 'updated_at') or now)
+
+        available = math.min(capacity, available + math.max(0, now - updated_at) * restore_rate)
+
+        local reserve = capacity * tonumber(ARGV[4])
+        local cost = math.min(tonumber(ARGV[1]), capacity - reserve)
+        local wait_time = 0
+
+        if available - cost >= reserve then
+            available = available - cost
+        else
+            wait_time = (cost + reserve - available) / restore_rate
+        end
+
+        redis.call('HSET', KEYS[1], 'capacity', capacity, 'restore_rate', restore_rate,
+                   'available', available, 'updated_at', now)
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+
+        return tostring(wait_time)
+    """
+
+    UPDATE_SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+        redis.call('HSET', KEYS[1], 'capacity', ARGV[1], 'available', ARGV[2], 'updated_at', now)
+        if ARGV[3] ~= '' then
+            redis.call('HSET', KEYS[1], 'restore_rate', ARGV[3])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    """
+
+    def __init__(self, redis_client: redis.Redis, shop_name: str, logger: logging.Logger = None):
+        self.redis_client = redis_client
+        self.key_prefix = f"shopify_rate_limiter:{shop_name}"
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._acquire = self.redis_client.register_script(self.ACQUIRE_SCRIPT)
+        self._update = self.redis_client.register_script(self.UPDATE_SCRIPT)
+
+    def _bucket_key(self, api: ShopifyAPI) -> str:
+        return f"{self.key_prefix}:{api}"
+
+    def _metrics_key(self, api: ShopifyAPI) -> str:
+        return f"{self.key_prefix}:{api}:metrics"
+
+    def acquire(self, api: ShopifyAPI, cost: float = 1):
+        """
+        Blocks till the cost can be spent from the shared bucket
+        """
+
+        defaults = self.DEFAULT_BUCKETS[api]
+        total_wait_time = 0
+
+        try:
+            while wait_time := float(self._acquire(
+                    keys=[self._bucket_key(api)],
+                    args=[cost, defaults['capacity'], defaults['restore_rate'], self.RESERVE, self.KEYS_EXPIRE]
+            )):
+                self.logger.debug("Shopify %s API rate limit is reached. Sleeping %.2f sec", api, wait_time)
+                sleep(wait_time)
+                total_wait_time += wait_time
+
+            with self.redis_client.pipeline() as pipe:
+                pipe.hincrby(self._metrics_key(api), 'requests', 1)
+                pipe.hincrbyfloat(self._metrics_key(api), 'cost', cost)
+                pipe.hincrbyfloat(self._metrics_key(api), 'wait_time', total_wait_time)
+                pipe.expire(self._metrics_key(api), self.KEYS_EXPIRE)
+                pipe.execute()
+        except redis.RedisError as e:
+            self.logger.error("Unable to use the shared Shopify rate limiter - %s", e)
+
+    def update(self, api: ShopifyAPI, capacity: float, available: float, restore_rate: float = None):
+        """
+        Sets the actual state of the bucket received from Shopify
+        """
+
+        try:
+            self._update(
+                keys=[self._bucket_key(api)],
+                args=[capacity, available, '' if restore_rate is None else restore_rate, self.KEYS_EXPIRE]
+            )
+        except redis.RedisError as e:
+            self.logger.error("Unable to use the shared Shopify rate limiter - %s", e)
+
+    def update_from_rest_header(self, call_limit_header: str | None):
+        # the header looks like "32/40"
+        if not call_limit_header:
+            return
+
+        used, capacity = map(int, call_limit_header.split('/'))
+        self.update(ShopifyAPI.REST, capacity=capacity, available=capacity - used)
+
+    def update_from_graphql_extensions(self, extensions: dict | None):
+        if throttle_status := (extensions or {}).get('cost', {}).get('throttleStatus'):
+            self.update(
+                ShopifyAPI.GRAPHQL,
+                capacity=throttle_status['maximumAvailable'],
+                available=throttle_status['currentlyAvailable'],
+                restore_rate=throttle_status['restoreRate']
+            )
+
+    def throttled(self, api: ShopifyAPI):
+        try:
+            self.redis_client.hincrby(self._metrics_key(api), 'throttled', 1)
+        except redis.RedisError as e:
+            self.logger.error("Unable to use the shared Shopify rate limiter - %s", e)
+
+    def metrics(self) -> dict[str, dict]:
+        """
+        Returns requests count, spent cost, wait time, throttled requests count and the current utilization
+        of the buckets by all processes for the last hour
+        """
+
+        metrics = dict()
+
+        for api in ShopifyAPI:
+            try:
+                bucket = self.redis_client.hgetall(self._bucket_key(api))
+                api_metrics = {k.decode(): float(v) for k, v in self.redis_client.hgetall(self._metrics_key(api)).items()}
+            except redis.RedisError as e:
+                self.logger.error("Unable to use the shared Shopify rate limiter - %s", e)
+                continue
+
+            requests_count = api_metrics.get('requests', 0)
+            api_metrics['avg_wait_time'] = api_metrics.get('wait_time', 0) / requests_count if requests_count else 0
+
+            if bucket:
+                capacity, available = float(bucket[b'capacity']), float(bucket[b'available'])
+                api_metrics['utilization'] = round((capacity - available) / capacity, 3)
+
+            metrics[api.value] = api_metrics
+
+        return metrics
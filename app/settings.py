@@ -237,14 +237,31 @@ if papertrail_destination := config('PAPERTRAIL_DESTINATION', None):
 
 SHOPIFY_SHOP_NAME = config('SHOPIFY_SHOP_NAME')
 SHOPIFY_API_TOKEN = config('SHOPIFY_API_TOKEN')
+# number of the next pages of variants fetched in the background while the current one is being processed
+SHOPIFY_PREFETCH_PAGES = config('SHOPIFY_PREFETCH_PAGES', default=2, cast=int)
+# export variants with their inventory levels by the GraphQL bulk operation instead of the REST pages
+SHOPIFY_BULK_VARIANTS = config('SHOPIFY_BULK_VARIANTS', default=True, cast=bool)
+# the secret the webhooks are signed with, shown in the Shopify admin notifications settings
+SHOPIFY_WEBHOOK_SECRET = config('SHOPIFY_WEBHOOK_SECRET', default=None)
 
 FUSE5_API_KEY = config('FUSE5_API_KEY', None)
 FUSE5_API_URL = config('FUSE5_API_URL', None)
 FUSE5_ACCOUNT_NUMBER = config('FUSE5_ACCOUNT_NUMBER', None)
 
+# retries of the Fuse5 API requests failed by 5xx errors or timeouts, waiting backoff_factor * 2^attempt seconds
+FUSE5_MAX_RETRIES = config('FUSE5_MAX_RETRIES', default=3, cast=int)
+FUSE5_RETRY_BACKOFF_FACTOR = config('FUSE5_RETRY_BACKOFF_FACTOR', default=1.0, cast=float)
+
 EXPORT_CSV_FILEPATH = BASE_DIR / "data/fuse5_products.csv"
 FUSE5_UPDATE_CSV_FROM_REMOTE = config('FUSE5_UPDATE_CSV_FROM_REMOTE', True, cast=bool)
-FUSE5_LOAD_DATA_CHANGED_SINCE = config('FUSE5_LOAD_DATA_CHANGED_SINCE', None)
+
+# load only products changed since the previous update, and all of them once in a few days to remove deleted ones
+FUSE5_INCREMENTAL_UPDATE = config('FUSE5_INCREMENTAL_UPDATE', True, cast=bool)
+FUSE5_FULL_RECONCILIATION_DAYS = config('FUSE5_FULL_RECONCILIATION_DAYS', default=7, cast=int)
+FUSE5_CHANGED_SINCE_OVERLAP_HOURS = config('FUSE5_CHANGED_SINCE_OVERLAP_HOURS', default=24, cast=int)
+
+# the supplier's tables bigger than that are searched by DB queries instead of the in-memory index
+PRODUCTS_FINDER_INDEX_MAX_ROWS = config('PRODUCTS_FINDER_INDEX_MAX_ROWS', default=1_000_000, cast=int)
 
 REDIS_URL = config('REDIS_URL')
 
@@ -252,5 +269,21 @@ CELERY_BROKER_URL = REDIS_URL + '1'
 CELERY_RESULT_BACKEND = REDIS_URL + '1'
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 
+# every task logs stream holds a web server thread, the clients over the limit poll the logs instead
+TASK_LOGS_MAX_STREAMS = config('TASK_LOGS_MAX_STREAMS', default=4, cast=int)
+
 PRODUCTS_SYNC_DELETE_LOGS_OLDER_DAYS = config('PRODUCTS_SYNC_DELETE_LOGS_OLDER_DAYS', default=30)
 ORDERS_SYNC_DELETE_LOGS_OLDER_DAYS = config('ORDERS_SYNC_DELETE_LOGS_OLDER_DAYS', default=30)
+
+# the known orders index is reconciled with the Fuse5 orders created for the last days once in a few hours
+ORDERS_SYNC_RECONCILIATION_HOURS = config('ORDERS_SYNC_RECONCILIATION_HOURS', default=24, cast=int)
+ORDERS_SYNC_RECONCILIATION_DAYS = config('ORDERS_SYNC_RECONCILIATION_DAYS', default=30, cast=int)
+
+# the number of the Fuse5 orders created at the same time
+ORDERS_SYNC_CREATE_WORKERS = config('ORDERS_SYNC_CREATE_WORKERS', default=4, cast=int)
+# the orders claimed for creating longer ago are searched in Fuse5 again, as their process could die
+ORDERS_SYNC_CLAIM_EXPIRE_MINUTES = config('ORDERS_SYNC_CLAIM_EXPIRE_MINUTES', default=30, cast=int)
+
+# skip the matched variants not changed since the last sync, but check all of them again once in a few days
+PRODUCTS_SYNC_DIFF_BASED = config('PRODUCTS_SYNC_DIFF_BASED', default=True, cast=bool)
+PRODUCTS_SYNC_SNAPSHOTS_DAYS = config('PRODUCTS_SYNC_SNAPSHOTS_DAYS', default=7, cast=int)
@@ -1,6 +1,9 @@
 # -*- encoding: utf-8 -*-
 bind = '0.0.0.0:8000'
 workers = 1
+# threads keep the single worker responsive while the task logs are streamed, see TASK_LOGS_MAX_STREAMS
+worker_class = 'gthread'
+threads = 8
 accesslog = '-'
 loglevel = 'debug'
 capture_output = True
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.2 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+def fill_known_orders(apps, schema_editor):
+    OrdersSyncLog = apps.get_model('orders_sync', 'OrdersSyncLog')
+    Fuse5KnownOrder = apps.get_model('orders_sync', 'Fuse5KnownOrder')
+
+    Fuse5KnownOrder.objects.bulk_create(
+        [
+            Fuse5KnownOrder(
+                customerpo=log.fuse5_customerpo,
+                fuse5_sales_order_number=log.fuse5_sales_order_number,
+                fuse5_sales_order_id=log.fuse5_sales_order_id
+            )
+            for log in OrdersSyncLog.objects.order_by('time')
+        ],
+        ignore_conflicts=True,
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders_sync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Fuse5KnownOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customerpo', models.CharField(unique=True)),
+                ('fuse5_sales_order_number', models.CharField(null=True)),
+                ('fuse5_sales_order_id', models.CharField(null=True)),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('reconciled_at', models.DateTimeField(db_index=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_known_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.2 on 2026-10-17 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders_sync', '0002_fuse5knownorder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrdersSyncCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shop_name', models.CharField()),
+                ('status', models.CharField()),
+                ('last_order_id', models.PositiveBigIntegerField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('shop_name', 'status')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.2 on 2026-10-17 15:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders_sync', '0003_orderssynccursor'),
+        ('products_sync', '0016_syncrun'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+                INSERT INTO products_sync_syncrun (type, gid, source, start_time, end_time, price_updates,
+                                                   quantity_updates, unmatched_variants, orders_created)
+                SELECT 'orders', gid, '', min(time), max(time), 0, 0, 0, count(*)
+                FROM orders_sync_orderssynclog
+                GROUP BY gid
+            """,
+            "DELETE FROM products_sync_syncrun WHERE type = 'orders'"
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.2 on 2026-10-17 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders_sync', '0004_syncrun_backfill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Fuse5OrdersReconciliation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_number', models.CharField(unique=True)),
+                ('reconciled_at', models.DateTimeField()),
+                ('orders_found', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
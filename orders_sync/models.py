@@ -1,7 +1,10 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from dateutil.utils import today
 from django.db import models
+from django.utils.timezone import now
+
+from app import settings
 
 
 class OrdersSyncLog(models.Model):
@@ -25,3 +28,150 @@ class OrdersSyncLog(models.Model):
         # TODO do not delete parts of groups with the same gid. Only delete whole groups.
         delete_time_point = today() - timedelta(days=days)
         cls.objects.filter(time__lte=delete_time_point).delete()
+
+
+class OrdersSyncCursor(models.Model):
+    """
+    The high-water mark of the orders sync - the id of the last processed Shopify order, so the next sync
+    requests only the orders created after it
+    """
+
+    class Meta:
+        unique_together = ('shop_name', 'status')
+
+    shop_name = models.CharField()
+    status = models.CharField()
+    last_order_id = models.PositiveBigIntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_last_order_id(cls, shop_name: str, status: str) -> int | None:
+        return cls.objects.filter(shop_name=shop_name, status=status).values_list('last_order_id', flat=True).first()
+
+    @classmethod
+    def set_last_order_id(cls, shop_name: str, status: str, last_order_id: int | None):
+        cls.objects.update_or_create(shop_name=shop_name, status=status, defaults=dict(last_order_id=last_order_id))
+
+
+class Fuse5KnownOrder(models.Model):
+    """
+    Local index of the Fuse5 sales orders created for the Shopify orders by their customer PO numbers,
+    to check if an order exists without searching it in Fuse5. Unlike the sync logs it is not cleaned up.
+
+    The orders without the Fuse5 order number are claimed by a sync which is creating them. They are not known yet,
+    so they are searched in Fuse5, and the claims expired in `settings.ORDERS_SYNC_CLAIM_EXPIRE_MINUTES` can be taken
+    by another sync.
+    """
+
+    customerpo = models.CharField(unique=True)
+    fuse5_sales_order_number = models.CharField(null=True)
+    fuse5_sales_order_id = models.CharField(null=True)
+    time = models.DateTimeField(auto_now_add=True)
+
+    # the last time the order has been seen in the Fuse5 orders history
+    reconciled_at = models.DateTimeField(null=True, db_index=True)
+
+    def __str__(self):
+        return "{customerpo} - {fuse5_sales_order_id}({fuse5_sales_order_number})".format(**self.__dict__)
+
+    @classmethod
+    def remember(cls, customerpo: str, fuse5_sales_order_number: str = None, fuse5_sales_order_id: str = None):
+        # the claimed order is confirmed too
+        cls.objects.update_or_create(customerpo=customerpo, defaults=dict(
+            fuse5_sales_order_number=fuse5_sales_order_number,
+            fuse5_sales_order_id=fuse5_sales_order_id
+        ))
+
+    @classmethod
+    def confirmed(cls) -> models.QuerySet:
+        return cls.objects.filter(fuse5_sales_order_number__isnull=False)
+
+    @classmethod
+    def remember_many(cls, orders: list[tuple[str, str, str]]):
+        """
+        :param orders: (customerpo, fuse5_sales_order_number, fuse5_sales_order_id) items
+        """
+
+        cls.objects.bulk_create(
+            [
+                cls(customerpo=customerpo, fuse5_sales_order_number=sales_order_number,
+                    fuse5_sales_order_id=sales_order_id)
+                for customerpo, sales_order_number, sales_order_id in orders
+            ],
+            update_conflicts=True,
+            unique_fields=['customerpo'],
+            update_fields=['fuse5_sales_order_number', 'fuse5_sales_order_id']
+        )
+
+    @classmethod
+    def claim(cls, customerpo: str) -> bool:
+        """
+        Adds the order before creating it in Fuse5, so the concurrent syncs (like the webhooks and the polling one)
+        don't create it twice
+        :return: False if the order is already known or claimed by another process
+        """
+
+        known_order, created = cls.objects.get_or_create(customerpo=customerpo)
+        if created:
+            return True
+
+        # the expired claim is taken over, the process which has claimed it is likely dead
+        expire_time = now() - timedelta(minutes=settings.ORDERS_SYNC_CLAIM_EXPIRE_MINUTES)
+        return cls.objects.filter(pk=known_order.pk, fuse5_sales_order_number__isnull=True,
+                                  time__lt=expire_time).update(time=now()) == 1
+
+    @classmethod
+    def release(cls, customerpos: list[str]):
+        """
+        Removes the claimed orders which failed to be created
+        """
+
+        cls.objects.filter(customerpo__in=customerpos, fuse5_sales_order_number__isnull=True).delete()
+
+    @classmethod
+    def is_known(cls, customerpo: str) -> bool:
+        return cls.confirmed().filter(customerpo=customerpo).exists() or \
+            OrdersSyncLog.objects.filter(fuse5_customerpo=customerpo).exists()
+
+    @classmethod
+    def get_known_customerpos(cls) -> set[str]:
+        return set(cls.confirmed().values_list('customerpo', flat=True)) | set(
+            OrdersSyncLog.objects.values_list('fuse5_customerpo', flat=True))
+
+    @classmethod
+    def save_reconciled(cls, fuse5_orders: list[dict]):
+        cls.objects.bulk_create(
+            [
+                cls(
+                    customerpo=order['customerpo'],
+                    fuse5_sales_order_number=order.get('sales_order_number'),
+                    fuse5_sales_order_id=order.get('sales_order_id'),
+                    reconciled_at=now()
+                )
+                for order in fuse5_orders
+            ],
+            update_conflicts=True,
+            unique_fields=['customerpo'],
+            update_fields=['fuse5_sales_order_number', 'fuse5_sales_order_id', 'reconciled_at'],
+            batch_size=1000
+        )
+
+
+class Fuse5OrdersReconciliation(models.Model):
+    """
+    The last reconciliation of the known orders with the Fuse5 orders history of the account. It is kept apart from
+    the known orders, as the reconciliation could find none of them.
+    """
+
+    account_number = models.CharField(unique=True)
+    reconciled_at = models.DateTimeField()
+    orders_found = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get_last_time(cls, account_number: str) -> datetime | None:
+        return cls.objects.filter(account_number=account_number).values_list('reconciled_at', flat=True).first()
+
+    @classmethod
+    def save_time(cls, account_number: str, reconciled_at: datetime, orders_found: int):
+        cls.objects.update_or_create(account_number=account_number,
+                                     defaults=dict(reconciled_at=reconciled_at, orders_found=orders_found))
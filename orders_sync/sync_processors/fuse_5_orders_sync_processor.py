@@ -1,5 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from enum import StrEnum
 
+import more_itertools as mit
+import pandas as pd
+from django.utils.timezone import now, get_current_timezone
 from pydantic import BaseModel
 
 from app import settings
@@ -8,8 +13,8 @@ from app.lib.fuse5_remote import Fuse5DB
 from app.lib.products_finder import ProductsFinder
 from app.lib.shopify_client import ShopifyClient
 from orders_sync import logger
-from orders_sync.models import OrdersSyncLog
-from products_sync.models import Fuse5Products
+from orders_sync.models import OrdersSyncLog, Fuse5KnownOrder, OrdersSyncCursor, Fuse5OrdersReconciliation
+from products_sync.models import Fuse5Products, SyncRun
 from shopify import Order
 
 
@@ -69,7 +74,7 @@ class Fuse5OrdersSyncProcessor:
         self.shopify_client = shopify_client
 
         self.fuse5_account_number = settings.FUSE5_ACCOUNT_NUMBER
-        self.fuse5 = Fuse5Client(params['API_KEY'], params['API_URL'])
+        self.fuse5 = Fuse5Client(params['API_KEY'], params['API_URL'], logger=logger)
         self.fuse5_locations = self.fuse5.get_locations()
         self.fuse5_default_location = next(iter(self.fuse5_locations), None)
 
@@ -84,52 +89,281 @@ class Fuse5OrdersSyncProcessor:
 
         self.products_finder = ProductsFinder(Fuse5Products.objects, logger, self.fuse5_default_location)
 
-    def run_sync(self, since_id: int = None, status: OrderStatuses = OrderStatuses.OPEN):
+        # found supplier's products (or None) by variant ids for the current page of orders
+        self.matched_products: dict[int, dict | None] = {}
+
+    def run_sync(self, since_id: int = None, status: OrderStatuses = OrderStatuses.OPEN,
+                 full: bool = False) -> int | None:
+        """
+        :param since_id: process only the orders created after the order with this id
+        :param status: the status of the orders to process
+        :param full: process all the orders, otherwise only the ones created after the last processed one
+        :return: the gid of the logs of the created orders, or None if nothing has been created
+        """
+
         logger.info('Starting orders sync...')
 
-        try:
-            gid = OrdersSyncLog.objects.latest('gid').gid + 1
-        except OrdersSyncLog.DoesNotExist:
-            gid = 1
+        # the cursor is moved only when the sync continues from it
+        use_cursor = since_id is None
+        if use_cursor and not full:
+            since_id = OrdersSyncCursor.get_last_order_id(self.shopify_client.shop_name, status)
+
+        if since_id is not None:
+            logger.info("Only the orders created after the order ID=%s will be processed", since_id)
+
+        last_order_id, first_failed_order_id = since_id, None
+        start_time, orders_created = now(), 0
 
         OrdersSyncLog.delete_old(days=settings.ORDERS_SYNC_DELETE_LOGS_OLDER_DAYS)
+        SyncRun.delete_old(SyncRun.Types.ORDERS, days=settings.ORDERS_SYNC_DELETE_LOGS_OLDER_DAYS)
+
+        if self.is_reconciliation_required():
+            self.reconcile_known_orders()
+
+        known_customerpos = Fuse5KnownOrder.get_known_customerpos()
+
+        orders = self.shopify_client.orders(since_id, status=status)
+        gid = self.start_run(start_time)
 
-        for order in self.shopify_client.orders(since_id, status=status):
-            if self.is_order_exists(order):
-                logger.debug("The order %s is already exists", self.get_customer_order_id(order))
+        try:
+            # the orders are created in Fuse5 concurrently, while their params are built in the main thread
+            with ThreadPoolExecutor(max_workers=settings.ORDERS_SYNC_CREATE_WORKERS,
+                                    thread_name_prefix='fuse5_orders') as executor:
+                for orders_page in mit.batched(orders, self.shopify_client.page_size):
+                    new_orders = []
+
+                    for order in orders_page:
+                        last_order_id = max(order.id, last_order_id or 0)
+
+                        if self.is_order_exists(order, known_customerpos):
+                            logger.debug("The order %s is already exists", self.get_customer_order_id(order))
+                        else:
+                            new_orders.append(order)
+                            # the same order could be met twice if the orders are shifted between pages
+                            known_customerpos.add(self.get_customer_order_id(order))
+
+                    self.match_products(new_orders)
+
+                    orders_params, claimed_customerpos = [], []
+                    for order in new_orders:
+                        params = self.build_order_params(order)
+
+                        if params:
+                            if not Fuse5KnownOrder.claim(self.get_customer_order_id(order)):
+                                # it is checked again by the next sync, in case the other process fails
+                                logger.debug("The order %s is being created by another process",
+                                             self.get_customer_order_id(order))
+                                first_failed_order_id = min(order.id, first_failed_order_id or order.id)
+                                continue
+
+                            claimed_customerpos.append(self.get_customer_order_id(order))
+
+                        orders_params.append((order, params))
+
+                    created_orders = []
+
+                    try:
+                        submitted = executor.map(lambda item: self.submit_order(*item) if item[1] else None,
+                                                 orders_params)
+
+                        for (order, params), fuse5_order_info in zip(orders_params, submitted):
+                            if fuse5_order_info:
+                                created_orders.append((order, fuse5_order_info))
+                            elif params:
+                                first_failed_order_id = min(order.id, first_failed_order_id or order.id)
+                            else:
+                                # the next syncs won't find its products either, so the cursor is not held by it
+                                logger.warning("The order %s is skipped without the matched products",
+                                               self.get_order_id_msg(order))
+
+                        self.save_db_logs(created_orders, gid)
+                    finally:
+                        # the claims of the created orders are already confirmed, so only the failed ones are removed
+                        Fuse5KnownOrder.release(claimed_customerpos)
+
+                    orders_created += len(created_orders)
+        finally:
+            # the summary is saved for the failed runs too, as the logs of the created orders are kept,
+            # the runs which have created nothing are not listed
+            if orders_created:
+                SyncRun.save_run(SyncRun.Types.ORDERS, gid, start_time, orders_created=orders_created)
             else:
-                fuse5_order_info = self.create_order(order)
-                if fuse5_order_info:
-                    self.save_db_log(order, fuse5_order_info, gid)
+                SyncRun.delete_run(SyncRun.Types.ORDERS, gid)
+
+        if use_cursor:
+            # the orders failed to be created in Fuse5 are tried again the next time
+            if first_failed_order_id is not None:
+                last_order_id = first_failed_order_id - 1
 
+            OrdersSyncCursor.set_last_order_id(self.shopify_client.shop_name, status, last_order_id)
+
+        logger.info("Shopify API rate limits usage: %s", self.shopify_client.rate_limiter.metrics())
+        logger.info("Fuse5 API latencies: %s", self.fuse5.latency_metrics())
         logger.info("Orders sync done!")
 
-        return gid
+        return gid if orders_created else None
+
+    def sync_order(self, order_id: int) -> dict | None:
+        """
+        Creates the Fuse5 order for the Shopify order if it doesn't exist yet
+        :return: the created order info, or None if it was not created
+        """
 
-    def save_db_log(self, shopify_order: Order, fuse5_order_info: dict, gid: int):
-        OrdersSyncLog(
-            gid=gid,
+        start_time = now()
+        shopify_order = self.shopify_client.get_order(order_id)
 
-            fuse5_account_number=self.fuse5_account_number,
-            fuse5_sales_order_number=fuse5_order_info['sales_order_number'],
-            fuse5_sales_order_id=fuse5_order_info['sales_order_id'],
-            fuse5_customerpo=self.get_customer_order_id(shopify_order),
+        if shopify_order is None:
+            logger.warning("The Shopify order ID=%s is not found", order_id)
+            return None
+
+        customer_order_id = self.get_customer_order_id(shopify_order)
 
-            shopify_order_id=shopify_order.id,
-            shopify_order_number=shopify_order.order_number
-        ).save()
+        if shopify_order.cancelled_at:
+            logger.info("The order %s is cancelled", customer_order_id)
+            return None
 
-    def is_order_exists(self, shopify_order: Order):
-        return self.fuse5.search_sales_order_by_customer_order_id(
+        if Fuse5KnownOrder.is_known(customer_order_id) or self.is_order_exists(shopify_order):
+            logger.debug("The order %s is already exists", customer_order_id)
+            return None
+
+        self.match_products([shopify_order])
+
+        if not (params := self.build_order_params(shopify_order)) or not Fuse5KnownOrder.claim(customer_order_id):
+            return None
+
+        try:
+            if fuse5_order_info := self.submit_order(shopify_order, params):
+                gid = self.start_run(start_time)
+                self.save_db_logs([(shopify_order, fuse5_order_info)], gid)
+                SyncRun.save_run(SyncRun.Types.ORDERS, gid, start_time, orders_created=1)
+        finally:
+            # the claim of the created order is already confirmed, so it is removed only if failed
+            Fuse5KnownOrder.release([customer_order_id])
+
+        return fuse5_order_info
+
+    @staticmethod
+    def start_run(start_time: datetime) -> int:
+        return SyncRun.start_run(SyncRun.Types.ORDERS, OrdersSyncLog, start_time)
+
+    def save_db_logs(self, created_orders: list[tuple[Order, dict]], gid: int):
+        """
+        :param created_orders: Shopify orders with the info of the Fuse5 orders created for them
+        """
+
+        Fuse5KnownOrder.remember_many([
+            (self.get_customer_order_id(shopify_order), info['sales_order_number'], info['sales_order_id'])
+            for shopify_order, info in created_orders
+        ])
+
+        OrdersSyncLog.objects.bulk_create([
+            OrdersSyncLog(
+                gid=gid,
+
+                fuse5_account_number=self.fuse5_account_number,
+                fuse5_sales_order_number=fuse5_order_info['sales_order_number'],
+                fuse5_sales_order_id=fuse5_order_info['sales_order_id'],
+                fuse5_customerpo=self.get_customer_order_id(shopify_order),
+
+                shopify_order_id=shopify_order.id,
+                shopify_order_number=shopify_order.order_number
+            )
+            for shopify_order, fuse5_order_info in created_orders
+        ])
+
+    def is_order_exists(self, shopify_order: Order, known_customerpos: set[str] = None) -> bool:
+        """
+        Checks the local index of the known orders first, and searches in Fuse5 only the unknown ones
+        """
+
+        customer_order_id = self.get_customer_order_id(shopify_order)
+
+        if known_customerpos is not None and customer_order_id in known_customerpos:
+            return True
+
+        fuse5_order = self.fuse5.search_sales_order_by_customer_order_id(
             account_number=self.fuse5_account_number,
-            customer_order_id=self.get_customer_order_id(shopify_order)
-        ) is not None
+            customer_order_id=customer_order_id
+        )
+
+        if fuse5_order is None:
+            return False
+
+        Fuse5KnownOrder.remember(customer_order_id, fuse5_order.get('sales_order_number'),
+                                 fuse5_order.get('sales_order_id'))
+
+        return True
+
+    def is_reconciliation_required(self) -> bool:
+        last_reconciliation_time = Fuse5OrdersReconciliation.get_last_time(self.fuse5_account_number)
+
+        return last_reconciliation_time is None or \
+            now() - last_reconciliation_time > timedelta(hours=settings.ORDERS_SYNC_RECONCILIATION_HOURS)
+
+    def reconcile_known_orders(self, days: int | None = settings.ORDERS_SYNC_RECONCILIATION_DAYS) -> int:
+        """
+        Adds the orders created in Fuse5 for the Shopify orders to the local index, by paging through the Fuse5
+        orders history once instead of searching every order
+        :param days: only the orders created for the last days are checked, all of them if None
+        :return: the number of the found orders
+        """
+
+        logger.info("Reconciling the known orders with the Fuse5 orders history...")
+
+        start_time = now()
+        created_since = None if days is None else start_time - timedelta(days=days)
+        fuse5_orders = []
+
+        # the history is sorted by the created date desc
+        for fuse5_order in self.fuse5.get_sales_orders(account_number=self.fuse5_account_number):
+            if created_since is not None:
+                created_date = self.get_created_date(fuse5_order)
+
+                if created_date is None:
+                    logger.warning("The Fuse5 order %s has no created date, skipped",
+                                   fuse5_order.get('sales_order_number'))
+                    continue
+
+                if created_date < created_since:
+                    break
+
+            if (fuse5_order.get('customerpo') or '').startswith(f"{self.ORDER_ID_PREFIX}-"):
+                fuse5_orders.append(fuse5_order)
+
+        Fuse5KnownOrder.save_reconciled(fuse5_orders)
+        Fuse5OrdersReconciliation.save_time(self.fuse5_account_number, start_time, len(fuse5_orders))
+        logger.info("%s Fuse5 orders created for the Shopify orders have been found", len(fuse5_orders))
+
+        return len(fuse5_orders)
+
+    @staticmethod
+    def get_created_date(fuse5_order: dict) -> pd.Timestamp | None:
+        """
+        Returns the aware created date of the Fuse5 order, the dates without an offset are in the current timezone
+        """
+
+        created_date = pd.to_datetime(fuse5_order.get('sales_order_created_date'), errors='coerce')
+        if created_date is None or pd.isna(created_date):
+            return None
+
+        if created_date.tzinfo is None:
+            return created_date.tz_localize(get_current_timezone())
+
+        return created_date.tz_convert(get_current_timezone())
 
     def get_customer_order_id(self, shopify_order: Order) -> str:
         return f"{self.ORDER_ID_PREFIX}-{shopify_order.order_number}-{shopify_order.id}"
 
+    @staticmethod
+    def get_order_id_msg(shopify_order: Order) -> str:
+        return "%s (ID=%s)" % (shopify_order.order_number, shopify_order.id)
+
     def create_order(self, shopify_order: Order) -> dict | None:
-        order_id_msg = "%s (ID=%s)" % (shopify_order.order_number, shopify_order.id)
+        if params := self.build_order_params(shopify_order):
+            return self.submit_order(shopify_order, params)
+
+    def build_order_params(self, shopify_order: Order) -> dict | None:
+        order_id_msg = self.get_order_id_msg(shopify_order)
 
         products = self.find_matched_products(shopify_order, as_dict=True)
 
@@ -182,6 +416,16 @@ class Fuse5OrdersSyncProcessor:
             "total": float(shopify_order.total_price)
         }
 
+        return params
+
+    def submit_order(self, shopify_order: Order, params: dict) -> dict | None:
+        """
+        Creates the Fuse5 order. Is called in the worker threads, so it must not touch the DB.
+        :return: the created order info, or None if it was not created
+        """
+
+        order_id_msg = self.get_order_id_msg(shopify_order)
+
         try:
             res = self.fuse5.create_sales_order(params)
         except Exception as e:
@@ -203,6 +447,7 @@ class Fuse5OrdersSyncProcessor:
 
         else:
             logger.error('Unable to create an order %s for unknown reasons. Response data: %s', order_id_msg, res)
+            return None
 
         return res
 
@@ -214,11 +459,31 @@ class Fuse5OrdersSyncProcessor:
         if shopify_order.fulfillments:
             return shopify_order.fulfillments[0].tracking_number
 
+    def match_products(self, shopify_orders: list[Order]):
+        """
+        Fetches the variants of all line items of the orders at once and finds their supplier's products by one
+        finder call, so `find_matched_products` doesn't request them item by item
+        """
+
+        variant_ids = {item.variant_id for order in shopify_orders for item in order.line_items}
+        variants = self.shopify_client.get_variants(variant_ids)
+        found_products = self.products_finder.find_many_by_barcode_and_sku(
+            [variant.to_dict() for variant in variants.values()]
+        )
+
+        self.matched_products = {variant_id: found_products.get(variant_id) for variant_id in variants}
+
+    def find_matched_product(self, variant) -> dict | None:
+        if variant.id in self.matched_products:
+            return self.matched_products[variant.id]
+
+        return self.products_finder.find_product_by_barcode_and_sku(variant.to_dict())
+
     def find_matched_products(self, shopify_order: Order, as_dict=False) -> list[Fuse5Product | dict]:
         fuse5_products = []
         for item in shopify_order.line_items:
             if variant := self.shopify_client.get_variant(item.variant_id):
-                if product := self.products_finder.find_product_by_barcode_and_sku(variant.to_dict()):
+                if product := self.find_matched_product(variant):
                     f5_product = Fuse5Product(
                         line_code=product['line_code'],
                         product_number=product['sku'],
@@ -1,14 +1,37 @@
+import redis
 from celery import shared_task
 from celery_singleton import Singleton
 
 from app import settings
+from app.settings import REDIS_URL
 from app.lib.shopify_client import ShopifyClient
 from orders_sync import logger
 from orders_sync.sync_processors.fuse_5_orders_sync_processor import Fuse5OrdersSyncProcessor, OrderStatuses
 
+# Connect to the Redis server
+redis_client = redis.from_url(REDIS_URL)
+
+# the orders received by the webhooks are skipped while their keys exist
+WEBHOOK_ORDER_KEY_TEMPLATE = "orders_webhook:{order_id}"
+WEBHOOK_ORDER_KEY_EXPIRE = 24 * 60 * 60
+
+
+def enqueue_webhook_order(order_id: int) -> bool:
+    """
+    Queues creating of the Fuse5 order for the Shopify order, if it has not been queued yet
+    :return: False if the order is a duplicate
+    """
+
+    if not redis_client.set(WEBHOOK_ORDER_KEY_TEMPLATE.format(order_id=order_id), 1, nx=True,
+                            ex=WEBHOOK_ORDER_KEY_EXPIRE):
+        return False
+
+    create_webhook_order.delay(order_id)
+    return True
+
 
 @shared_task(bind=True, base=Singleton, lock_expiry=60 * 60, name="Sync orders from Shopify to Fuse5")
-def sync_orders(self_task, status: OrderStatuses = OrderStatuses.OPEN):
+def sync_orders(self_task, status: OrderStatuses = OrderStatuses.OPEN, full: bool = False):
     processor = Fuse5OrdersSyncProcessor(
         params={
             'API_KEY': settings.FUSE5_API_KEY,
@@ -22,5 +45,48 @@ def sync_orders(self_task, status: OrderStatuses = OrderStatuses.OPEN):
         )
     )
 
-    gid = processor.run_sync(status=status)
+    gid = processor.run_sync(status=status, full=full)
     return {'gid': gid}
+
+
+@shared_task(bind=True, base=Singleton, lock_expiry=60 * 60, name="Reconcile known orders with Fuse5")
+def reconcile_known_orders(self_task, days: int | None = settings.ORDERS_SYNC_RECONCILIATION_DAYS):
+    processor = Fuse5OrdersSyncProcessor(
+        params={
+            'API_KEY': settings.FUSE5_API_KEY,
+            'API_URL': settings.FUSE5_API_URL
+        },
+        shopify_client=ShopifyClient(
+            shop_name=settings.SHOPIFY_SHOP_NAME,
+            api_token=settings.SHOPIFY_API_TOKEN,
+            logger=logger
+        )
+    )
+
+    return {'found': processor.reconcile_known_orders(days=days)}
+
+
+@shared_task(bind=True, name="Create the Fuse5 order for the Shopify order from the webhook")
+def create_webhook_order(self_task, order_id: int):
+    fuse5_order_info = None
+
+    try:
+        processor = Fuse5OrdersSyncProcessor(
+            params={
+                'API_KEY': settings.FUSE5_API_KEY,
+                'API_URL': settings.FUSE5_API_URL
+            },
+            shopify_client=ShopifyClient(
+                shop_name=settings.SHOPIFY_SHOP_NAME,
+                api_token=settings.SHOPIFY_API_TOKEN,
+                logger=logger
+            )
+        )
+
+        fuse5_order_info = processor.sync_order(order_id)
+    finally:
+        # the next webhook of the same order (like orders/paid after orders/create) can try again
+        if fuse5_order_info is None:
+            redis_client.delete(WEBHOOK_ORDER_KEY_TEMPLATE.format(order_id=order_id))
+
+    return {'fuse5_order': fuse5_order_info}
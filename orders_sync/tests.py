@@ -1,14 +1,31 @@
+import base64
 import datetime
+import hashlib
+import hmac
+import json
 import os
+import random
 from pprint import pprint
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
 
 import pandas as pd
+import requests
 from django.test import TestCase
+from django.urls import reverse
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.test import APITestCase
 
 from app import settings
 from app.lib.fuse5_client import Fuse5Client
 from app.lib.shopify_client import ShopifyClient
+from orders_sync import tasks
+from orders_sync.models import Fuse5KnownOrder, OrdersSyncLog, OrdersSyncCursor
 from orders_sync.sync_processors.fuse_5_orders_sync_processor import Fuse5OrdersSyncProcessor, OrderStatuses
+from app.lib.products_finder import ProductsFinder
+from products_sync.models import Fuse5Products, SyncRun
+from products_sync.tests import FakeShopifyRESTServer, get_offline_shopify_client
 
 
 # Create your tests here.
@@ -98,3 +115,366 @@ class TestFuse5OrdersSyncProcessor(TestCase):
         sales_order_number = 'S1-58281'
         order = self.fuse5.get_sales_order(sales_order_number)
         print(order)
+
+
+class TestFuse5Client(TestCase):
+    @staticmethod
+    def get_response(status_code: int, data=None) -> Mock:
+        return Mock(status_code=status_code, raise_for_status=Mock(),
+                    json=Mock(return_value={'services': [{'response': {'status': True, 'data': data}}]}))
+
+    def test_retries_and_latencies(self):
+        fuse5 = Fuse5Client('key', 'https://fuse5.test/api', max_retries=2, backoff_factor=0)
+
+        with patch.object(fuse5.session, 'request', side_effect=[
+            requests.Timeout(), self.get_response(503), self.get_response(200, ['location'])
+        ]) as mocked_request:
+            self.assertEqual(['location'], fuse5.get_locations())
+
+        self.assertEqual(3, mocked_request.call_count)
+
+        metrics = fuse5.latency_metrics()['location/all']
+        self.assertEqual(3, metrics['count'])
+        self.assertEqual(2, metrics['failed'])
+        self.assertEqual(3, sum(metrics['histogram'].values()))
+
+    def test_create_sales_order_is_not_retried(self):
+        fuse5 = Fuse5Client('key', 'https://fuse5.test/api', max_retries=2, backoff_factor=0)
+
+        with patch.object(fuse5.session, 'request', side_effect=requests.Timeout()) as mocked_request:
+            with self.assertRaises(requests.Timeout):
+                fuse5.create_sales_order({})
+
+        self.assertEqual(1, mocked_request.call_count)
+
+
+class TestKnownOrders(TestCase):
+    def setUp(self):
+        # the processor without connecting to the remote APIs
+        self.processor = Fuse5OrdersSyncProcessor.__new__(Fuse5OrdersSyncProcessor)
+        self.processor.fuse5 = Mock()
+        self.processor.fuse5_account_number = 'A1'
+
+        OrdersSyncLog.objects.create(gid=1, fuse5_account_number='A1', fuse5_sales_order_number='S1-1',
+                                     fuse5_sales_order_id='1', fuse5_customerpo='shopify-1001-1',
+                                     shopify_order_id=1, shopify_order_number='1001')
+
+    def test_known_orders_are_not_searched_remotely(self):
+        known_customerpos = Fuse5KnownOrder.get_known_customerpos()
+
+        self.assertTrue(self.processor.is_order_exists(SimpleNamespace(id=1, order_number=1001), known_customerpos))
+        self.processor.fuse5.search_sales_order_by_customer_order_id.assert_not_called()
+
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = {
+            'customerpo': 'shopify-1002-2', 'sales_order_number': 'S1-2', 'sales_order_id': '2'
+        }
+        self.assertTrue(self.processor.is_order_exists(SimpleNamespace(id=2, order_number=1002), known_customerpos))
+        self.assertIn('shopify-1002-2', Fuse5KnownOrder.get_known_customerpos())
+
+    def test_reconcile_known_orders(self):
+        self.assertTrue(self.processor.is_reconciliation_required())
+
+        self.processor.fuse5.get_sales_orders.return_value = iter([
+            {'customerpo': 'shopify-1003-3', 'sales_order_number': 'S1-3', 'sales_order_id': '3',
+             'sales_order_created_date': str(datetime.date.today())},
+            {'customerpo': 'manual', 'sales_order_number': 'S1-4', 'sales_order_id': '4',
+             'sales_order_created_date': str(datetime.date.today())},
+            # no created date, skipped
+            {'customerpo': 'shopify-1005-5', 'sales_order_number': 'S1-5', 'sales_order_id': '5',
+             'sales_order_created_date': None},
+            # a date with an offset
+            {'customerpo': 'shopify-1006-6', 'sales_order_number': 'S1-6', 'sales_order_id': '6',
+             'sales_order_created_date': (now() - datetime.timedelta(days=1)).astimezone(
+                 datetime.timezone(datetime.timedelta(hours=-5))).isoformat()},
+            {'customerpo': 'shopify-1000-0', 'sales_order_number': 'S1-0', 'sales_order_id': '0',
+             'sales_order_created_date': '2000-01-01'},
+        ])
+
+        self.assertEqual(2, self.processor.reconcile_known_orders(days=30))
+        self.assertEqual({'shopify-1001-1', 'shopify-1003-3', 'shopify-1006-6'},
+                         Fuse5KnownOrder.get_known_customerpos())
+        self.assertFalse(self.processor.is_reconciliation_required())
+
+    def test_reconciliation_without_orders_is_saved(self):
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+
+        self.assertEqual(0, self.processor.reconcile_known_orders(days=30))
+        self.assertFalse(self.processor.is_reconciliation_required())
+
+        with patch('orders_sync.sync_processors.fuse_5_orders_sync_processor.now',
+                   return_value=now() + datetime.timedelta(hours=settings.ORDERS_SYNC_RECONCILIATION_HOURS + 1)):
+            self.assertTrue(self.processor.is_reconciliation_required())
+
+    def test_sync_continues_from_cursor(self):
+        self.processor.shopify_client = Mock(shop_name='test', page_size=2)
+        self.processor.shopify_client.orders.return_value = [
+            SimpleNamespace(id=5, order_number=1005), SimpleNamespace(id=6, order_number=1006),
+            SimpleNamespace(id=7, order_number=1007)
+        ]
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = None
+        self.processor.fuse5.latency_metrics.return_value = {}
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+        OrdersSyncCursor.set_last_order_id('test', OrderStatuses.OPEN, 4)
+
+        def submit_order(order, params):
+            if order.id != 6:
+                return {'sales_order_number': f"S1-{order.id}", 'sales_order_id': str(order.id)}
+
+        # the order 6 is failed, so the next sync starts from it
+        with patch.object(self.processor, 'build_order_params', return_value={'products': []}), \
+                patch.object(self.processor, 'submit_order', side_effect=submit_order), \
+                patch.object(self.processor, 'match_products') as match_products:
+            self.processor.run_sync()
+
+        self.assertEqual(2, match_products.call_count)
+        self.assertEqual(['shopify-1005-5', 'shopify-1007-7'],
+                         list(OrdersSyncLog.objects.filter(gid=2).order_by('id')
+                              .values_list('fuse5_customerpo', flat=True)))
+
+        self.processor.shopify_client.orders.assert_called_with(4, status=OrderStatuses.OPEN)
+        self.assertEqual(5, OrdersSyncCursor.get_last_order_id('test', OrderStatuses.OPEN))
+        self.assertEqual(2, SyncRun.objects.get(type=SyncRun.Types.ORDERS, gid=2).orders_created)
+
+
+    def test_orders_without_products_do_not_hold_cursor(self):
+        self.processor.shopify_client = Mock(shop_name='test', page_size=10)
+        self.processor.shopify_client.orders.return_value = [
+            SimpleNamespace(id=5, order_number=1005), SimpleNamespace(id=6, order_number=1006),
+            SimpleNamespace(id=7, order_number=1007)
+        ]
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = None
+        self.processor.fuse5.latency_metrics.return_value = {}
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+
+        # only the order 6 has the matched products
+        with patch.object(self.processor, 'build_order_params',
+                          side_effect=lambda order: {'products': [{}]} if order.id == 6 else None), \
+                patch.object(self.processor, 'submit_order',
+                             return_value={'sales_order_number': 'S1-6', 'sales_order_id': '6'}) as submit_order, \
+                patch.object(self.processor, 'match_products'):
+            self.processor.run_sync()
+
+        self.assertEqual(1, submit_order.call_count)
+        self.assertEqual(7, OrdersSyncCursor.get_last_order_id('test', OrderStatuses.OPEN))
+        self.assertEqual(1, SyncRun.objects.get(type=SyncRun.Types.ORDERS).orders_created)
+        self.assertFalse(Fuse5KnownOrder.objects.filter(customerpo='shopify-1005-5').exists())
+
+
+    def test_runs_without_created_orders_are_not_saved(self):
+        self.processor.shopify_client = Mock(shop_name='test', page_size=10)
+        self.processor.shopify_client.orders.return_value = [SimpleNamespace(id=1, order_number=1001)]
+        self.processor.fuse5.latency_metrics.return_value = {}
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+
+        # the order is already created
+        with patch.object(self.processor, 'match_products'):
+            self.assertIsNone(self.processor.run_sync())
+
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_claims(self):
+        self.assertTrue(Fuse5KnownOrder.claim('shopify-1008-8'))
+        self.assertFalse(Fuse5KnownOrder.claim('shopify-1008-8'))
+
+        # the claimed orders are not known yet
+        self.assertNotIn('shopify-1008-8', Fuse5KnownOrder.get_known_customerpos())
+        self.assertFalse(Fuse5KnownOrder.is_known('shopify-1008-8'))
+
+        # the expired claim is taken over once
+        Fuse5KnownOrder.objects.filter(customerpo='shopify-1008-8').update(
+            time=now() - datetime.timedelta(minutes=settings.ORDERS_SYNC_CLAIM_EXPIRE_MINUTES + 1))
+        self.assertTrue(Fuse5KnownOrder.claim('shopify-1008-8'))
+        self.assertFalse(Fuse5KnownOrder.claim('shopify-1008-8'))
+
+        Fuse5KnownOrder.remember('shopify-1008-8', 'S1-8', '8')
+        self.assertTrue(Fuse5KnownOrder.is_known('shopify-1008-8'))
+
+        # the confirmed orders are never released or taken over
+        Fuse5KnownOrder.release(['shopify-1008-8'])
+        Fuse5KnownOrder.objects.filter(customerpo='shopify-1008-8').update(
+            time=now() - datetime.timedelta(minutes=settings.ORDERS_SYNC_CLAIM_EXPIRE_MINUTES + 1))
+        self.assertFalse(Fuse5KnownOrder.claim('shopify-1008-8'))
+
+    def test_sync_order(self):
+        self.processor.shopify_client = Mock()
+        self.processor.shopify_client.get_order.return_value = SimpleNamespace(id=8, order_number=1008,
+                                                                               cancelled_at=None)
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = None
+        fuse5_order_info = {'sales_order_number': 'S1-8', 'sales_order_id': '8'}
+
+        # the order is being created by the webhook of another process
+        Fuse5KnownOrder.claim('shopify-1008-8')
+
+        with patch.object(self.processor, 'build_order_params', return_value={'products': [{}]}), \
+                patch.object(self.processor, 'match_products'), \
+                patch.object(self.processor, 'submit_order', side_effect=RuntimeError) as submit_order:
+            self.assertIsNone(self.processor.sync_order(8))
+            submit_order.assert_not_called()
+
+            # the process has died without releasing the claim
+            Fuse5KnownOrder.objects.filter(customerpo='shopify-1008-8').update(
+                time=now() - datetime.timedelta(minutes=settings.ORDERS_SYNC_CLAIM_EXPIRE_MINUTES + 1))
+
+            with self.assertRaises(RuntimeError):
+                self.processor.sync_order(8)
+
+            self.assertFalse(Fuse5KnownOrder.objects.filter(customerpo='shopify-1008-8').exists())
+
+            submit_order.side_effect = None
+            submit_order.return_value = fuse5_order_info
+            self.assertEqual(fuse5_order_info, self.processor.sync_order(8))
+
+        self.assertTrue(Fuse5KnownOrder.is_known('shopify-1008-8'))
+        self.assertEqual('S1-8', OrdersSyncLog.objects.get(fuse5_customerpo='shopify-1008-8').fuse5_sales_order_number)
+
+    def test_orders_claimed_by_webhooks_hold_cursor(self):
+        self.processor.shopify_client = Mock(shop_name='test', page_size=10)
+        self.processor.shopify_client.orders.return_value = [
+            SimpleNamespace(id=5, order_number=1005), SimpleNamespace(id=6, order_number=1006)
+        ]
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = None
+        self.processor.fuse5.latency_metrics.return_value = {}
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+        OrdersSyncCursor.set_last_order_id('test', OrderStatuses.OPEN, 4)
+
+        Fuse5KnownOrder.claim('shopify-1005-5')
+
+        with patch.object(self.processor, 'build_order_params', return_value={'products': [{}]}), \
+                patch.object(self.processor, 'submit_order',
+                             return_value={'sales_order_number': 'S1-6', 'sales_order_id': '6'}) as submit_order, \
+                patch.object(self.processor, 'match_products'):
+            self.processor.run_sync()
+
+        self.assertEqual([6], [call.args[0].id for call in submit_order.call_args_list])
+        # the webhook could fail, so the next sync checks the order 5 again
+        self.assertEqual(4, OrdersSyncCursor.get_last_order_id('test', OrderStatuses.OPEN))
+
+    def test_claims_are_released_on_errors(self):
+        self.processor.shopify_client = Mock(shop_name='test', page_size=10)
+        self.processor.shopify_client.orders.return_value = [SimpleNamespace(id=5, order_number=1005)]
+        self.processor.fuse5.search_sales_order_by_customer_order_id.return_value = None
+        self.processor.fuse5.get_sales_orders.return_value = iter([])
+
+        with patch.object(self.processor, 'build_order_params', return_value={'products': [{}]}), \
+                patch.object(self.processor, 'submit_order',
+                             return_value={'sales_order_number': 'S1-5', 'sales_order_id': '5'}), \
+                patch.object(self.processor, 'save_db_logs', side_effect=RuntimeError), \
+                patch.object(self.processor, 'match_products'):
+            with self.assertRaises(RuntimeError):
+                self.processor.run_sync()
+
+        self.assertFalse(Fuse5KnownOrder.objects.filter(customerpo='shopify-1005-5').exists())
+
+
+class TestMatchProducts(TestCase):
+    def setUp(self):
+        Fuse5Products.objects.create(barcode='12345678', sku='A1', price=10, inventory_quantity=1, line_code='AAA')
+
+        self.processor = Fuse5OrdersSyncProcessor.__new__(Fuse5OrdersSyncProcessor)
+        self.processor.products_finder = ProductsFinder(Fuse5Products.objects)
+
+    def test_variants_are_fetched_in_batches(self):
+        store_variants = {
+            11: dict(id=11, product_id=1, title='Red', sku='a-1', barcode='12345678', price='9.99'),
+            12: dict(id=12, product_id=1, title='Blue', sku='B1', barcode='87654321', price='5.00'),
+            14: dict(id=14, product_id=2, title='Green', sku=None, barcode=None, price='1.00'),
+        }
+
+        def responder(path, query):
+            self.assertEqual('/variants.json', path)
+            ids = [int(variant_id) for variant_id in query['ids'].split(',')]
+            self.assertLessEqual(len(ids), int(query['limit']))
+
+            return {'variants': [store_variants[i] for i in ids if i in store_variants]}, None
+
+        orders = [
+            SimpleNamespace(id=1, order_number=1001, line_items=[
+                SimpleNamespace(variant_id=11, quantity=2, price='9.99'),
+                SimpleNamespace(variant_id=13, quantity=1, price='3.00'),
+            ]),
+            SimpleNamespace(id=2, order_number=1002, line_items=[
+                SimpleNamespace(variant_id=12, quantity=1, price='5.00'),
+                SimpleNamespace(variant_id=14, quantity=1, price='1.00'),
+                SimpleNamespace(variant_id=None, quantity=1, price='1.00'),
+            ]),
+        ]
+
+        with FakeShopifyRESTServer(responder) as server:
+            self.processor.shopify_client = get_offline_shopify_client(graphql_url=None, rest_url=server.base_url)
+            self.processor.shopify_client.page_size = 2
+
+            self.processor.match_products(orders)
+            requests_count = len(server.requests)
+
+            # the deleted variant 13 is cached too, so nothing is requested by the products lookups
+            products = [self.processor.find_matched_products(order, as_dict=True) for order in orders]
+            self.assertEqual({11, 12, 14}, self.processor.shopify_client.get_variants([11, 12, 13, 14]).keys())
+
+        self.assertEqual(2, requests_count)
+        self.assertEqual(requests_count, len(server.requests))
+
+        self.assertEqual({11, 12, 14}, self.processor.matched_products.keys())
+        self.assertEqual('AAA', self.processor.matched_products[11]['line_code'])
+        self.assertIsNone(self.processor.matched_products[12])
+
+        self.assertEqual([[dict(line_code='AAA', product_number='A1', quantity=2, price=9.99)], []], products)
+
+
+class TestWebhookOrderTask(TestCase):
+    def setUp(self):
+        self.order_id = random.randint(10 ** 9, 10 ** 10)
+        self.addCleanup(tasks.redis_client.delete, tasks.WEBHOOK_ORDER_KEY_TEMPLATE.format(order_id=self.order_id))
+
+    @patch('orders_sync.tasks.ShopifyClient')
+    @patch('orders_sync.tasks.Fuse5OrdersSyncProcessor')
+    def test_create_webhook_order(self, processor_class, _):
+        processor = processor_class.return_value
+
+        with patch.object(tasks.create_webhook_order, 'delay') as delay:
+            self.assertTrue(tasks.enqueue_webhook_order(self.order_id))
+            self.assertFalse(tasks.enqueue_webhook_order(self.order_id))
+            delay.assert_called_once_with(self.order_id)
+
+            # the failed order can be queued by the next webhook
+            processor.sync_order.return_value = None
+            self.assertEqual({'fuse5_order': None}, tasks.create_webhook_order(self.order_id))
+            self.assertTrue(tasks.enqueue_webhook_order(self.order_id))
+
+            processor.sync_order.side_effect = RuntimeError
+            with self.assertRaises(RuntimeError):
+                tasks.create_webhook_order(self.order_id)
+            self.assertTrue(tasks.enqueue_webhook_order(self.order_id))
+
+            processor.sync_order.side_effect = None
+            processor.sync_order.return_value = {'sales_order_number': 'S1-9', 'sales_order_id': '9'}
+            tasks.create_webhook_order(self.order_id)
+            self.assertFalse(tasks.enqueue_webhook_order(self.order_id))
+
+        processor.sync_order.assert_called_with(self.order_id)
+
+
+class TestShopifyOrdersWebhook(APITestCase):
+    def post_webhook(self, payload: dict | list | bytes, topic: str = 'orders/create', secret: str = 'secret'):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        signature = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+        return self.client.post(reverse('orders_sync:shopify_orders_webhook'), body, content_type='application/json',
+                                HTTP_X_SHOPIFY_HMAC_SHA256=signature, HTTP_X_SHOPIFY_TOPIC=topic)
+
+    @patch.object(settings, 'SHOPIFY_WEBHOOK_SECRET', 'secret')
+    @patch('orders_sync.views.enqueue_webhook_order', return_value=True)
+    def test_webhook(self, enqueue_webhook_order):
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.post_webhook({'id': 1}, secret='wrong').status_code)
+        self.assertEqual(status.HTTP_200_OK, self.post_webhook({'id': 1}, topic='orders/updated').status_code)
+        enqueue_webhook_order.assert_not_called()
+
+        self.assertEqual(status.HTTP_200_OK, self.post_webhook({'id': 1}).status_code)
+        enqueue_webhook_order.assert_called_once_with(1)
+
+    @patch.object(settings, 'SHOPIFY_WEBHOOK_SECRET', 'secret')
+    @patch('orders_sync.views.enqueue_webhook_order', return_value=True)
+    def test_malformed_webhook(self, enqueue_webhook_order):
+        for payload in (b'{not json', {'order': 1}, [1], b'\xff'):
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, self.post_webhook(payload).status_code)
+
+        enqueue_webhook_order.assert_not_called()
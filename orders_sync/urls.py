@@ -10,4 +10,5 @@ app_name = 'orders_sync'
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('webhooks/shopify/orders/', views.ShopifyOrdersWebhookView.as_view(), name='shopify_orders_webhook'),
 ]
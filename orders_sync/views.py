@@ -1,15 +1,26 @@
+import base64
+import hashlib
+import hmac
+import json
+
 import pandas as pd
 from django.http import HttpResponse
 from django.utils.text import slugify
-from rest_framework import mixins, viewsets
+from rest_framework import mixins, viewsets, status
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from app import settings
+from orders_sync import logger
 from orders_sync.models import OrdersSyncLog
 from orders_sync.serializers import OrdersSyncLogSerializer
+from orders_sync.tasks import enqueue_webhook_order
+from products_sync.models import SyncRun
+from products_sync.serializers import SyncRunSerializer
 
 
 class OrdersSyncLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
@@ -22,13 +33,10 @@ class OrdersSyncLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
     @action(detail=False)
     def groups(self, request: Request) -> Response:
-        # TODO paginating
-        # TODO count created orders and show on frontend
-
-        first_rows = self.queryset.order_by('-gid', 'id').distinct('gid')
+        runs = SyncRun.with_changes(SyncRun.Types.ORDERS).order_by('-gid')
 
-        serializer = self.get_serializer(first_rows, many=True)
-        return Response(serializer.data)
+        serializer = SyncRunSerializer(self.paginate_queryset(runs), many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=False, url_path='download-csv/(?P<gid>\d+)')
     def download_csv(self, request: Request, gid=None):
@@ -53,3 +61,46 @@ class OrdersSyncLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         df.drop(columns=['gid']).to_csv(response, index=False, date_format="%m-%d-%Y %H:%M:%S")
 
         return response
+
+
+def is_valid_shopify_hmac(body: bytes, hmac_header: str | None) -> bool:
+    if not settings.SHOPIFY_WEBHOOK_SECRET or not hmac_header:
+        return False
+
+    digest = hmac.new(settings.SHOPIFY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), hmac_header)
+
+
+class ShopifyOrdersWebhookView(APIView):
+    """
+    Receives the `orders/create` and `orders/paid` Shopify webhooks and queues creating of the Fuse5 orders.
+    Shopify expects the response in a few seconds, so the order is only queued here.
+    """
+
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    TOPICS = ('orders/create', 'orders/paid')
+
+    def post(self, request: Request) -> Response:
+        # the raw body has to be read before the parsed data
+        body = request.body
+
+        if not is_valid_shopify_hmac(body, request.headers.get('X-Shopify-Hmac-Sha256')):
+            logger.warning("The Shopify webhook with invalid HMAC has been received")
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+        if (topic := request.headers.get('X-Shopify-Topic')) not in self.TOPICS:
+            return Response(status=status.HTTP_200_OK)
+
+        try:
+            order_id = json.loads(body)['id']
+        except (ValueError, KeyError, TypeError):
+            # Shopify retries the failed webhooks, but such a body won't become valid
+            logger.warning("The Shopify %s webhook without the order ID has been received", topic)
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if enqueue_webhook_order(order_id):
+            logger.info("The Shopify order ID=%s from the %s webhook has been queued", order_id, topic)
+
+        return Response(status=status.HTTP_200_OK)
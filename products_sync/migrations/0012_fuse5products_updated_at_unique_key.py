@@ -0,0 +1,53 @@
+# Generated by Django 4.2.2 on 2026-10-17 10:00
+
+import logging
+
+from django.db import migrations, models
+
+logger = logging.getLogger(__name__)
+
+
+def delete_duplicates(apps, schema_editor):
+    # the unique key is used by the UPSERT of the Fuse5 products, so the duplicates have to be removed first,
+    # the latest inserted one of them is kept
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            DELETE FROM products_sync_fuse5products a
+            USING products_sync_fuse5products b
+            WHERE a.id < b.id
+              AND COALESCE(a.line_code, '') = COALESCE(b.line_code, '')
+              AND COALESCE(a.sku, '') = COALESCE(b.sku, '')
+              AND COALESCE(a.location_name, '') = COALESCE(b.location_name, '')
+            RETURNING a.id, a.line_code, a.sku, a.location_name
+            """
+        )
+        deleted = cursor.fetchall()
+
+    if deleted:
+        logger.warning("%s duplicated Fuse5 products have been deleted, the first of them "
+                       "(id, line_code, sku, location_name): %s", len(deleted), deleted[:100])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products_sync', '0011_hiddenproductsfromunmatchedreview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fuse5products',
+            name='updated_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(delete_duplicates, reverse_code=migrations.RunPython.noop),
+        migrations.RunSQL(
+            sql="""
+                CREATE UNIQUE INDEX products_sy_fuse5_unique_key_idx ON products_sync_fuse5products (
+                    (COALESCE(line_code, '')), (COALESCE(sku, '')), (COALESCE(location_name, ''))
+                );
+            """,
+            reverse_sql="DROP INDEX products_sy_fuse5_unique_key_idx;",
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.2 on 2026-10-17 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products_sync', '0012_fuse5products_updated_at_unique_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopifyVariantSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variant_id', models.PositiveBigIntegerField(unique=True)),
+                ('shopify_updated_at', models.DateTimeField(null=True)),
+                ('barcode', models.CharField(max_length=20, null=True)),
+                ('sku', models.CharField(null=True)),
+                ('price', models.FloatField(null=True)),
+                ('inventory_quantity', models.IntegerField(null=True)),
+                ('supplier_product_id', models.PositiveBigIntegerField()),
+                ('supplier_row_hash', models.CharField(max_length=32)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.2 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+SKU_NORMALIZED_SQL = "UPDATE {table} SET sku_normalized = lower(regexp_replace(sku, '[-_ ]', '', 'g'))"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products_sync', '0013_shopifyvariantsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customcsvdata',
+            name='sku_normalized',
+            field=models.CharField(max_length=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='fuse5products',
+            name='sku_normalized',
+            field=models.CharField(max_length=30, null=True),
+        ),
+        migrations.RunSQL(
+            sql=SKU_NORMALIZED_SQL.format(table='products_sync_customcsvdata'),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql=SKU_NORMALIZED_SQL.format(table='products_sync_fuse5products'),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='customcsvdata',
+            index=models.Index(fields=['sku_normalized'], name='products_sy_sku_nor_9fa746_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fuse5products',
+            index=models.Index(fields=['sku_normalized'], name='products_sy_sku_nor_a590ab_idx'),
+        ),
+    ]
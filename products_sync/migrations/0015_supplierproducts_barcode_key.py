@@ -0,0 +1,50 @@
+# Generated by Django 4.2.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+BARCODE_KEY_SQL = r"""
+    UPDATE {table} SET barcode_key = substring(
+        ltrim(
+            CASE WHEN trim(barcode) ~ '^\d+\.\d+E\+\d+$' THEN round(trim(barcode)::numeric)::text
+            ELSE regexp_replace(barcode, '\D', '', 'g') END,
+            '0'
+        ),
+        '^\d{{0,14}}$'
+    )
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products_sync', '0014_supplierproducts_sku_normalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customcsvdata',
+            name='barcode_key',
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='fuse5products',
+            name='barcode_key',
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.RunSQL(
+            sql=BARCODE_KEY_SQL.format(table='products_sync_customcsvdata'),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql=BARCODE_KEY_SQL.format(table='products_sync_fuse5products'),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='customcsvdata',
+            index=models.Index(fields=['barcode_key'], name='products_sy_barcode_807d89_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fuse5products',
+            index=models.Index(fields=['barcode_key'], name='products_sy_barcode_3c7ca3_idx'),
+        ),
+    ]
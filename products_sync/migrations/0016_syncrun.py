@@ -0,0 +1,45 @@
+# Generated by Django 4.2.2 on 2026-10-17 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products_sync', '0015_supplierproducts_barcode_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('products', 'Products sync'), ('orders', 'Orders sync')], max_length=10)),
+                ('gid', models.PositiveBigIntegerField()),
+                ('source', models.CharField(blank=True, default='', max_length=30)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('price_updates', models.PositiveIntegerField(default=0)),
+                ('quantity_updates', models.PositiveIntegerField(default=0)),
+                ('unmatched_variants', models.PositiveIntegerField(default=0)),
+                ('orders_created', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('type', 'gid')},
+            },
+        ),
+        migrations.RunSQL(
+            """
+                INSERT INTO products_sync_syncrun (type, gid, source, start_time, end_time, price_updates,
+                                                   quantity_updates, unmatched_variants, orders_created)
+                SELECT 'products', gid, min(source), min(time), max(time),
+                       count(*) FILTER (WHERE changes ? 'price'),
+                       count(*) FILTER (WHERE changes ? 'quantity'),
+                       count(*) FILTER (WHERE changes @> '{"unmatched": true}'),
+                       0
+                FROM products_sync_productsupdatelog
+                GROUP BY gid
+            """,
+            "DELETE FROM products_sync_syncrun WHERE type = 'products'"
+        ),
+    ]
@@ -1,10 +1,14 @@
-from datetime import timedelta
+from datetime import timedelta, datetime
+from typing import Type
 
 from dateutil.utils import today
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django_cte import CTEManager
 
+from app.lib.products_finder import ProductsFinder
+
 from .sync_processors.custom_csv_processor import CustomCSVProcessor
 from .sync_processors.fuse_5_processor import Fuse5Processor
 
@@ -45,6 +49,105 @@ class ProductsUpdateLog(models.Model):
         delete_time_point = today() - timedelta(days=days)
         cls.objects.filter(time__lte=delete_time_point).delete()
 
+    @classmethod
+    def count_changes(cls, gid: int) -> dict[str, int]:
+        return cls.objects.filter(gid=gid).aggregate(
+            price_updates=models.Count('id', filter=models.Q(changes__has_key='price')),
+            quantity_updates=models.Count('id', filter=models.Q(changes__has_key='quantity')),
+            unmatched_variants=models.Count('id', filter=models.Q(changes__contains={'unmatched': True})),
+        )
+
+
+class SyncRun(models.Model):
+    """
+    The summary of the products or orders sync run, so the runs are listed without scanning the logs.
+    The row is added at the start of the run to take its gid, and the summary is written at its end.
+    """
+
+    class Types(models.TextChoices):
+        PRODUCTS = 'products', _('Products sync')
+        ORDERS = 'orders', _('Orders sync')
+
+    class Meta:
+        unique_together = ('type', 'gid')
+
+    type = models.CharField(max_length=10, choices=Types.choices)
+    gid = models.PositiveBigIntegerField()
+    source = models.CharField(max_length=30, blank=True, default='')
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+
+    price_updates = models.PositiveIntegerField(default=0)
+    quantity_updates = models.PositiveIntegerField(default=0)
+    unmatched_variants = models.PositiveIntegerField(default=0)
+    orders_created = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "{type} #{gid}: {start_time} - {end_time}".format(**self.__dict__)
+
+    @property
+    def duration(self) -> timedelta:
+        return self.end_time - self.start_time
+
+    @classmethod
+    def get_next_gid(cls, run_type: Types, log_model: Type[models.Model]) -> int:
+        """
+        :param log_model: the logs of the runs, the runs without logs have the summaries only
+        """
+
+        last_gids = [
+            log_model.objects.aggregate(gid=models.Max('gid'))['gid'],
+            cls.objects.filter(type=run_type).aggregate(gid=models.Max('gid'))['gid'],
+        ]
+
+        return max(filter(None, last_gids), default=0) + 1
+
+    @classmethod
+    def start_run(cls, run_type: Types, log_model: Type[models.Model], start_time: datetime, source: str = '') -> int:
+        """
+        Takes the next gid by inserting the run, the unique key lets only one of the concurrent runs take it
+        :return: the gid of the run
+        """
+
+        while True:
+            gid = cls.get_next_gid(run_type, log_model)
+
+            try:
+                with transaction.atomic():
+                    cls.objects.create(type=run_type, gid=gid, source=source, start_time=start_time,
+                                       end_time=start_time)
+            except IntegrityError:
+                continue
+
+            return gid
+
+    @classmethod
+    def save_run(cls, run_type: Types, gid: int, start_time: datetime, source: str = '', **counts):
+        cls.objects.update_or_create(type=run_type, gid=gid, defaults=dict(
+            source=source,
+            start_time=start_time,
+            end_time=now(),
+            **counts
+        ))
+
+    @classmethod
+    def with_changes(cls, run_type: Types) -> models.QuerySet:
+        # the counts are saved at the end of the run, so the running syncs are hidden as well as the empty ones
+        return cls.objects.filter(
+            models.Q(price_updates__gt=0) | models.Q(quantity_updates__gt=0) | models.Q(unmatched_variants__gt=0)
+            | models.Q(orders_created__gt=0),
+            type=run_type
+        )
+
+    @classmethod
+    def delete_run(cls, run_type: Types, gid: int):
+        cls.objects.filter(type=run_type, gid=gid).delete()
+
+    @classmethod
+    def delete_old(cls, run_type: Types, days: int):
+        delete_time_point = today() - timedelta(days=days)
+        cls.objects.filter(type=run_type, end_time__lte=delete_time_point).delete()
+
 
 class AbstractSupplierProducts(models.Model):
     class Meta:
@@ -52,6 +155,8 @@ class AbstractSupplierProducts(models.Model):
         indexes = [
             models.Index(fields=["barcode"]),
             models.Index(fields=["sku"]),
+            models.Index(fields=["sku_normalized"]),
+            models.Index(fields=["barcode_key"]),
         ]
 
     barcode = models.CharField(max_length=20, null=True)
@@ -60,6 +165,17 @@ class AbstractSupplierProducts(models.Model):
     sku = models.CharField(max_length=30, null=True)
     location_name = models.CharField(max_length=30, null=True)
 
+    # lowercased SKU without `-`, `_` and spaces to search by SKU using the index
+    sku_normalized = models.CharField(max_length=30, null=True)
+
+    # digits only barcode without leading zeros to search by barcode using the index
+    barcode_key = models.CharField(max_length=20, null=True)
+
+    def save(self, *args, **kwargs):
+        self.sku_normalized = ProductsFinder.normalize_sku(self.sku)
+        self.barcode_key = ProductsFinder.normalize_barcode(self.barcode)
+        super().save(*args, **kwargs)
+
 
 class CustomCsv(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -78,6 +194,36 @@ class Fuse5Products(AbstractSupplierProducts):
     product_name = models.CharField(null=True)
     line_code = models.CharField(max_length=3, null=True)
 
+    # the time of the update from Fuse5 which has inserted or changed the product
+    updated_at = models.DateTimeField(null=True, db_index=True)
+
+
+class ShopifyVariantSnapshot(models.Model):
+    """
+    The state of the matched Shopify variant and its supplier's product as of the last sync.
+    The variants which are still in the same state are skipped by the next syncs.
+    """
+
+    variant_id = models.PositiveBigIntegerField(unique=True)
+    shopify_updated_at = models.DateTimeField(null=True)
+    barcode = models.CharField(max_length=20, null=True)
+    sku = models.CharField(null=True)
+    price = models.FloatField(null=True)
+    inventory_quantity = models.IntegerField(null=True)
+    supplier_product_id = models.PositiveBigIntegerField()
+    supplier_row_hash = models.CharField(max_length=32)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def fresh(cls, days: int) -> models.QuerySet:
+        # the variants are checked again at least once in the given days, even if nothing has changed
+        return cls.objects.filter(synced_at__gt=today() - timedelta(days=days))
+
+    @classmethod
+    def delete_old(cls, days: int):
+        delete_time_point = today() - timedelta(days=days)
+        cls.objects.filter(synced_at__lte=delete_time_point).delete()
+
 
 class UnmatchedProductsForReview(models.Model):
     shopify_product_id = models.PositiveBigIntegerField()
@@ -3,7 +3,8 @@ import html
 from rest_framework import serializers
 
 from app import settings
-from .models import StockDataSource, ProductsUpdateLog, UnmatchedProductsForReview, HiddenProductsFromUnmatchedReview
+from .models import StockDataSource, ProductsUpdateLog, UnmatchedProductsForReview, HiddenProductsFromUnmatchedReview, \
+    SyncRun
 
 
 class StockDataSourceSerializer(serializers.ModelSerializer):
@@ -20,6 +21,21 @@ class ProductsUpdateLogSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 
+class SyncRunSerializer(serializers.ModelSerializer):
+    # the time of the log group, as it is shown on the frontend
+    time = serializers.DateTimeField(source='start_time')
+    duration = serializers.SerializerMethodField()
+
+    class Meta:
+        model = SyncRun
+        fields = ['gid', 'source', 'time', 'end_time', 'duration', 'price_updates', 'quantity_updates',
+                  'unmatched_variants', 'orders_created']
+        read_only_fields = fields
+
+    def get_duration(self, obj: SyncRun) -> float:
+        return obj.duration.total_seconds()
+
+
 class UnmatchedProductsForReviewSerializer(serializers.ModelSerializer):
     possible_fuse5_products = serializers.SerializerMethodField()
     product_url = serializers.SerializerMethodField()
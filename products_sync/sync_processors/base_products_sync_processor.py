@@ -58,7 +58,8 @@ class BaseProductsSyncProcessor(AbstractProductsSyncProcessor):
             shop_name=settings.SHOPIFY_SHOP_NAME,
             api_token=settings.SHOPIFY_API_TOKEN,
             logger=logger,
-            on_page_callback=check_if_aborted
+            on_page_callback=check_if_aborted,
+            prefetch_pages=settings.SHOPIFY_PREFETCH_PAGES
         )
 
     def get_suppliers_df(self, *args, **kwargs) -> pd.DataFrame:
@@ -91,7 +92,8 @@ class BaseProductsSyncProcessor(AbstractProductsSyncProcessor):
             update_price=self.params.get('update_price', True),
             update_inventory=self.params.get('update_inventory', True),
             inventory_location=self.params.get('shopify_inventory_location', None),
-            check_if_aborted=check_if_aborted
+            check_if_aborted=check_if_aborted,
+            diff_sync=self.params.get('diff_sync', settings.PRODUCTS_SYNC_DIFF_BASED)
         )
 
         gid = updater.process(dry=dry).gid
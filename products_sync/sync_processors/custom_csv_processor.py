@@ -5,6 +5,7 @@ from django.db import transaction
 from django.db import connection as db_connection
 from django.db.models import QuerySet
 
+from app.lib.products_finder import ProductsFinder
 from .base_products_sync_processor import BaseProductsSyncProcessor
 
 
@@ -40,6 +41,12 @@ class CustomCSVProcessor(BaseProductsSyncProcessor):
             if c in df.columns:
                 df[c] = df[c].str.strip()
 
+        if 'sku' in df.columns:
+            df['sku_normalized'] = ProductsFinder.normalize_skus(df['sku'])
+
+        if 'barcode' in df.columns:
+            df['barcode_key'] = ProductsFinder.normalize_barcodes(df['barcode'])
+
         if (c := 'price') in df.columns:
             df[c] = pd.to_numeric(df[c], downcast='float')
 
@@ -1,22 +1,25 @@
+import hashlib
 import html
 import json
 import re
 from abc import ABC, abstractmethod
 from collections import namedtuple
 from enum import StrEnum
-from typing import Any
+from typing import Any, Iterator
 
 import pandas as pd
 from django.db import connection, transaction
 from django.db.models import QuerySet
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
 from pyactiveresource.connection import ClientError
 import more_itertools as mit
 
 from app import settings
 from app.lib.products_finder import ProductsFinder
-from app.lib.shopify_client import ShopifyClient
+from app.lib.shopify_client import ShopifyClient, ShopifyGraphQLException
 from products_sync import logger
-from shopify import Variant
+from shopify import Variant, Location
 
 
 class SHOPIFY_FIELDS(StrEnum):
@@ -36,7 +39,8 @@ class AbstractShopifyProductsUpdater(ABC):
                  update_price: bool = True,
                  update_inventory: bool = True,
                  inventory_location: str = USE_CSV_FIELD_LOCATION,
-                 check_if_aborted: callable = lambda: False
+                 check_if_aborted: callable = lambda: False,
+                 diff_sync: bool = False
                  ):
         self.shopify_client: ShopifyClient
         self.source_name: str
@@ -46,6 +50,7 @@ class AbstractShopifyProductsUpdater(ABC):
         self.store_variants_df: pd.DataFrame | None
         self.gid: int
         self.check_if_aborted: callable
+        self.diff_sync: bool
 
     @abstractmethod
     def process(self, dry: bool = True):
@@ -115,11 +120,53 @@ class UpdateLogManager:
             return msg
 
 
+class ShopifyUpdatesQueue:
+    """
+    Collects changes of the matched variants to send them to Shopify in batches instead of one request per variant
+    """
+
+    def __init__(self, shopify_client: ShopifyClient):
+        self.shopify_client = shopify_client
+        self._prices: list[tuple["ShopifyVariantUpdater", float]] = []
+        self._quantities: list[tuple["ShopifyVariantUpdater", Location, int]] = []
+
+    def __len__(self):
+        return len(self._prices) + len(self._quantities)
+
+    def add_price(self, variant_updater: "ShopifyVariantUpdater", price: float):
+        self._prices.append((variant_updater, price))
+
+    def add_quantity(self, variant_updater: "ShopifyVariantUpdater", location: Location, quantity: int):
+        self._quantities.append((variant_updater, location, quantity))
+
+    def flush(self):
+        prices, self._prices = self._prices, []
+        quantities, self._quantities = self._quantities, []
+
+        if prices:
+            errors = self.shopify_client.update_variants_prices(
+                (updater.shopify_variant.product_id, updater.shopify_variant.id, price) for updater, price in prices
+            )
+
+            for updater, price in prices:
+                updater.on_price_updated(price, errors.get(updater.shopify_variant.id))
+
+        if quantities:
+            errors = self.shopify_client.set_inventory_levels(
+                (updater.shopify_variant.inventory_item_id, location.id, quantity)
+                for updater, location, quantity in quantities
+            )
+
+            for updater, location, quantity in quantities:
+                updater.on_quantity_updated(location, errors.get((updater.shopify_variant.inventory_item_id,
+                                                                  location.id)))
+
+
 class ShopifyVariantUpdater:
 
     def __init__(self, shopify_variant: Variant, suppliers_product: dict, *, shopify_inventory_level: int,
                  shopify_client: ShopifyClient, gid: int, source_name: str, update_price: bool = True,
-                 update_inventory: bool = True
+                 update_inventory: bool = True, updates_queue: ShopifyUpdatesQueue = None
                  ):
         self.update_inventory = update_inventory
         self.update_price = update_price
@@ -127,9 +174,12 @@ class ShopifyVariantUpdater:
         self.shopify_client = shopify_client
         self.shopify_variant = shopify_variant
         self.suppliers_product = suppliers_product
+        self.updates_queue = updates_queue
         self.dry = True
         self._log = []
         self._updated = False
+        self._pending_updates = 0
+        self.failed = False
 
         self.log_mngr = UpdateLogManager(self.shopify_variant, self.suppliers_product, gid, source_name)
 
@@ -151,7 +201,16 @@ class ShopifyVariantUpdater:
 
         if self.dry and not self._updated:
             self.add2log('The product is up to date')
-        elif not self.dry and self._updated:
+
+        if not self._pending_updates:
+            self.finish()
+
+    @property
+    def updated(self) -> bool:
+        return self._updated
+
+    def finish(self):
+        if not self.dry and self._updated:
             self.add2log(self.log_mngr.get_message())
             self.log_mngr.save2db()
 
@@ -172,6 +231,9 @@ class ShopifyVariantUpdater:
         if self.dry:
             self.add2log('The price will be updated to %s' % self.suppliers_product[SHOPIFY_FIELDS.price])
             self._updated = True
+        elif self.updates_queue is not None:
+            self._pending_updates += 1
+            self.updates_queue.add_price(self, self.suppliers_product[SHOPIFY_FIELDS.price])
         else:
             self.shopify_variant.price = self.suppliers_product[SHOPIFY_FIELDS.price]
             if self.save_variant():
@@ -179,10 +241,31 @@ class ShopifyVariantUpdater:
                 self.log_mngr.price_changed()
                 self._updated = True
 
+    def on_price_updated(self, price: float, error: str | None = None):
+        self._pending_updates -= 1
+
+        if error:
+            self.failed = True
+            logger.error("Unable to update shopify product variant ID=%s - %s", self.shopify_variant.id, error)
+        else:
+            self.shopify_variant.price = price
+            self.log_mngr.price_changed()
+            self._updated = True
+
+        if not self._pending_updates:
+            self.finish()
+
     def do_update_quantity(self, old_quantity: int = None):
         if self.dry:
             self.add2log('The quantity will be updated to %s' % self.suppliers_product[SHOPIFY_FIELDS.quantity])
             self._updated = True
+        elif self.updates_queue is not None:
+            self._pending_updates += 1
+            self.updates_queue.add_quantity(
+                self,
+                self.shopify_client.get_location(self.suppliers_product['location_name']),
+                self.suppliers_product[SHOPIFY_FIELDS.quantity]
+            )
         else:
             try:
                 res = self.shopify_client.set_inventory_level(
@@ -196,12 +279,34 @@ class ShopifyVariantUpdater:
                 else:
                     err_msg = str(e)
 
+                self.failed = True
                 logger.error("Unable to update quantity of the shopify variant ID=%s - %s", self.shopify_variant.id,
                              err_msg)
 
             else:
                 self.log_mngr.quantity_changed(location_name=res['location'].name, old_quantity=old_quantity)
-                self._updated = True
+                self.quantity_updated(self.suppliers_product[SHOPIFY_FIELDS.quantity])
+
+    def on_quantity_updated(self, location: Location, error: str | None = None):
+        self._pending_updates -= 1
+
+        if error:
+            self.failed = True
+            logger.error("Unable to update quantity of the shopify variant ID=%s - %s", self.shopify_variant.id,
+                         error)
+        else:
+            self.log_mngr.quantity_changed(location_name=location.name, old_quantity=self.shopify_inventory_level)
+            self.quantity_updated(self.suppliers_product[SHOPIFY_FIELDS.quantity])
+
+        if not self._pending_updates:
+            self.finish()
+
+    def quantity_updated(self, quantity: int):
+        # the variant's quantity is the total of all locations, so it is changed by the difference at the location
+        if self.shopify_variant.inventory_quantity is not None:
+            self.shopify_variant.inventory_quantity += quantity - (self.shopify_inventory_level or 0)
+
+        self._updated = True
 
     @property
     def comparing_text_table(self) -> str:
@@ -222,6 +327,7 @@ class ShopifyVariantUpdater:
             if not self.shopify_client.save(self.shopify_variant):
                 raise Exception("Can't save shopify variant")
         except Exception as e:
+            self.failed = True
             logger.error("Unable to update shopify product variant ID=%s - %s", self.shopify_variant.id, e)
             return False
 
@@ -250,7 +356,6 @@ class ShopifyVariantUpdater:
 class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
     PER_PAGE = 250
 
-    RGX_SC_NUM = re.compile(r"\d+\.\d+E\+\d+")
     RGX_BARCODE = re.compile(r"\d{6,}")
 
     MatchedProductsTuple = namedtuple('MatchedProductsTuple', 'shopify_variant suppliers_product')
@@ -262,11 +367,13 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
                  update_price: bool = True,
                  update_inventory: bool = True,
                  inventory_location: str = AbstractShopifyProductsUpdater.USE_CSV_FIELD_LOCATION,
-                 check_if_aborted: callable = lambda: False
+                 check_if_aborted: callable = lambda: False,
+                 diff_sync: bool = False
                  ):
         """
         :param ShopifyClient shopify_client:
         :param supplier_products_df: Should contain all columns with names as in SHOPIFY_FIELDS
+        :param diff_sync: skip the matched variants which have not changed since the last sync on both sides
         """
 
         not_required = []
@@ -289,12 +396,17 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
         self._unmatched_variants = []
         self.gid = None
         self.check_if_aborted = check_if_aborted
+        self.updates_queue = ShopifyUpdatesQueue(self.shopify_client)
+        self.diff_sync = diff_sync
+        self.snapshots: dict[int, tuple] = dict()
+        self.skipped_count = 0
 
         # TODO take location from the frontend
         self.products_finder = ProductsFinder(
             supplier_products,
             logger,
-            default_location_name=self.inventory_location or self.shopify_client.DEFAULT_LOCATION_NAME
+            default_location_name=self.inventory_location or self.shopify_client.DEFAULT_LOCATION_NAME,
+            preload_index=True
         )
 
     def process(self, dry: bool = True):
@@ -303,74 +415,209 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
         and update the item on shopify by new values
         """
 
-        from products_sync.models import ProductsUpdateLog
+        from products_sync.models import ProductsUpdateLog, SyncRun
 
-        # TODO get only needed fields by API (have to solve issues with pagination when requesting specific fields)
+        start_time = now()
 
         if not dry:
-            try:
-                self.gid = ProductsUpdateLog.objects.latest('gid').gid + 1
-            except ProductsUpdateLog.DoesNotExist:
-                self.gid = 1
+            self.gid = SyncRun.start_run(SyncRun.Types.PRODUCTS, ProductsUpdateLog, start_time, self.source_name)
 
             ProductsUpdateLog.delete_old(days=settings.PRODUCTS_SYNC_DELETE_LOGS_OLDER_DAYS)
+            SyncRun.delete_old(SyncRun.Types.PRODUCTS, days=settings.PRODUCTS_SYNC_DELETE_LOGS_OLDER_DAYS)
+
+        try:
+            if self.diff_sync:
+                self.load_snapshots(dry)
 
-        # receiving product variants from shopify and iterate them checking for matches
-        for idx, variant in enumerate(self.shopify_client.variants(), 1):
+            # receiving product variants from shopify page by page and matching them in batches
+            for variants_page in mit.batched(enumerate(self.get_shopify_variants(), 1), self.PER_PAGE):
+                self._process_variants_page(variants_page, dry)
+
+            self._process_matched_products(dry)
+            self._process_unmatched_products(dry)
+        finally:
+            # the summary is saved for the failed and aborted runs too, as their logs are kept
+            if not dry:
+                SyncRun.save_run(SyncRun.Types.PRODUCTS, self.gid, start_time, self.source_name,
+                                 **ProductsUpdateLog.count_changes(self.gid))
+
+        if self.diff_sync:
+            logger.info("%s variants not changed since the last sync have been skipped", self.skipped_count)
+
+        logger.info("Shopify API rate limits usage: %s", self.shopify_client.rate_limiter.metrics())
+
+        return self
+
+    def get_shopify_variants(self) -> Iterator[Variant]:
+        if settings.SHOPIFY_BULK_VARIANTS:
+            try:
+                yield from self.shopify_client.bulk_variants()
+                return
+            except ShopifyGraphQLException as e:
+                # raised only before the first variant, e.g. if another bulk operation is running
+                logger.warning("Unable to export variants by the bulk operation, the REST API will be used - %s", e)
+
+        yield from self.shopify_client.variants()
+
+    def _process_variants_page(self, variants_page: tuple[tuple[int, Variant], ...], dry: bool):
+        variants_df = self.get_variants_df([variant for _, variant in variants_page])
+        found_products = self.find_supplier_products(variants_df[variants_df['is_valid_barcode']])
+        page_items = list(zip(variants_page, variants_df['is_valid_barcode']))
+
+        if self.snapshots:
+            # the whole page is matched anyway, so a better supplier's product found since the last sync is not missed
+            not_changed = [self.is_not_changed(variant, found_products.get(variant.id)) for _, variant in variants_page]
+            self.skipped_count += sum(not_changed)
+            page_items = [item for item, skip in zip(page_items, not_changed) if not skip]
+
+        for (idx, variant), is_valid_barcode in page_items:
             logger.debug("%s - Processing variant_id=%s, barcode=%s, price=%s, qty=%s", idx, variant.id,
                          variant.barcode, variant.price, variant.inventory_quantity)
 
-            is_matched = False
+            if variant.barcode and not is_valid_barcode:
+                logger.warning("The shopify barcode is invalid: %s", variant.barcode)
+                continue
 
-            if variant.barcode:
-                barcode = re.sub(r"\D", "", variant.barcode).strip()
+            if supplier_product := found_products.get(variant.id):
+                if self.update_price and supplier_product['price'] is not None:
+                    supplier_product['price'] = round(float(supplier_product['price']), 2)
 
-                if self.RGX_SC_NUM.match(barcode):
-                    barcode = str(int(float(barcode)))
+                if self.inventory_location:
+                    supplier_product['location_name'] = self.inventory_location
 
-                if self.RGX_BARCODE.match(barcode) is None:
-                    logger.warning("The shopify barcode is invalid: %s", variant.barcode)
-                    continue
+                self._matched_products.append(self.MatchedProductsTuple(variant, supplier_product))
 
-                supplier_product = self.find_supplier_product(barcode, variant)
+                if len(self._matched_products) >= self.PER_PAGE:
+                    self._process_matched_products(dry)
 
-                if supplier_product:
-                    is_matched = True
-                    if self.update_price and supplier_product['price'] is not None:
-                        supplier_product['price'] = round(float(supplier_product['price']), 2)
+                continue
 
-                    if self.inventory_location:
-                        supplier_product['location_name'] = self.inventory_location
+            supplier_products_by_sku = self.find_supplier_product_by_sku(variant)
+            if supplier_products_by_sku:
+                self._unmatched_variants.append(self.MatchedProductsTuple(variant, supplier_products_by_sku))
 
-                    self._matched_products.append(self.MatchedProductsTuple(variant, supplier_product))
+                logger.warning(
+                    "Products matched by SKU, but not matched by BARCODE are found in the supplier's data: "
+                    "product_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode}. Found matches:"
+                    " {matched}".format(
+                        **variant.to_dict() | {
+                            'matched': self._supplier_products_as_str(supplier_products_by_sku)})
+                )
+            else:
+                self._unmatched_variants.append(self.MatchedProductsTuple(variant, None))
+                logger.warning(
+                    "The matched product was not found in the supplier's data: "
+                    "product_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode} ".format(
+                        **variant.to_dict())
+                )
 
-                    if len(self._matched_products) >= self.PER_PAGE:
-                        self._process_matched_products(dry)
+    def load_snapshots(self, dry: bool):
+        from products_sync.models import ShopifyVariantSnapshot
 
-            if not is_matched:
-                supplier_products_by_sku = self.find_supplier_product_by_sku(variant)
-                if supplier_products_by_sku:
-                    self._unmatched_variants.append(self.MatchedProductsTuple(variant, supplier_products_by_sku))
+        # the dry runs don't change the DB, the old snapshots are just not used by them
+        if not dry:
+            ShopifyVariantSnapshot.delete_old(days=settings.PRODUCTS_SYNC_SNAPSHOTS_DAYS)
+
+        snapshots = ShopifyVariantSnapshot.fresh(days=settings.PRODUCTS_SYNC_SNAPSHOTS_DAYS)
+        self.snapshots = {
+            variant_id: state
+            for variant_id, *state in snapshots.values_list(
+                'variant_id', 'shopify_updated_at', 'barcode', 'sku', 'price', 'inventory_quantity',
+                'supplier_product_id', 'supplier_row_hash'
+            )
+        }
 
-                    logger.warning(
-                        "Products matched by SKU, but not matched by BARCODE are found in the supplier's data: "
-                        "product_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode}. Found matches:"
-                        " {matched}".format(
-                            **variant.to_dict() | {
-                                'matched': self._supplier_products_as_str(supplier_products_by_sku)})
-                    )
-                else:
-                    self._unmatched_variants.append(self.MatchedProductsTuple(variant, None))
-                    logger.warning(
-                        "The matched product was not found in the supplier's data: "
-                        "product_id={product_id}; variant_id={id}; sku={sku}; barcode={barcode} ".format(
-                            **variant.to_dict())
-                    )
+    @staticmethod
+    def get_variant_state(variant: Variant) -> tuple:
+        updated_at = getattr(variant, 'updated_at', None)
+
+        # the REST API returns prices as strings, the bulk export as floats
+        return (
+            parse_datetime(updated_at) if isinstance(updated_at, str) else updated_at,
+            variant.barcode,
+            variant.sku,
+            None if variant.price is None else float(variant.price),
+            variant.inventory_quantity
+        )
 
-        self._process_matched_products(dry)
-        self._process_unmatched_products(dry)
+    def get_supplier_row_hash(self, supplier_product: dict) -> str:
+        # the sync options are hashed too, because the same product is compared differently with other options
+        price = supplier_product['price']
+        values = [
+            supplier_product['barcode'],
+            supplier_product['sku'],
+            None if price is None else round(float(price), 2),
+            supplier_product['inventory_quantity'],
+            self.inventory_location or supplier_product['location_name'],
+            self.update_price,
+            self.update_inventory
+        ]
+
+        return hashlib.md5(json.dumps(values, default=str).encode()).hexdigest()
+
+    def is_not_changed(self, variant: Variant, supplier_product: dict | None) -> bool:
+        """
+        :param supplier_product: the supplier's product matched to the variant now
+        """
 
-        return self
+        if supplier_product is None or (snapshot := self.snapshots.get(variant.id)) is None:
+            return False
+
+        snapshot_updated_at, *shopify_state = snapshot[:-2]
+        supplier_product_id, supplier_row_hash = snapshot[-2:]
+        updated_at, *variant_state = self.get_variant_state(variant)
+
+        # the time is unknown for the variants updated by the last sync, the fields are compared only
+        if snapshot_updated_at is not None and snapshot_updated_at != updated_at or shopify_state != variant_state:
+            return False
+
+        return supplier_product['id'] == supplier_product_id and \
+            self.get_supplier_row_hash(supplier_product) == supplier_row_hash
+
+    def save_snapshots(self, variant_updaters: list[ShopifyVariantUpdater]):
+        from products_sync.models import ShopifyVariantSnapshot
+
+        snapshots = []
+        for updater in variant_updaters:
+            if updater.failed:
+                continue
+
+            # the variant is in its state after the update, but Shopify has changed its update time
+            updated_at, barcode, sku, price, inventory_quantity = self.get_variant_state(updater.shopify_variant)
+            snapshots.append(ShopifyVariantSnapshot(
+                variant_id=updater.shopify_variant.id,
+                shopify_updated_at=None if updater.updated else updated_at,
+                barcode=barcode,
+                sku=sku,
+                price=price,
+                inventory_quantity=inventory_quantity,
+                supplier_product_id=updater.suppliers_product['id'],
+                supplier_row_hash=self.get_supplier_row_hash(updater.suppliers_product)
+            ))
+
+        ShopifyVariantSnapshot.objects.bulk_create(
+            snapshots,
+            update_conflicts=True,
+            unique_fields=['variant_id'],
+            update_fields=['shopify_updated_at', 'barcode', 'sku', 'price', 'inventory_quantity',
+                           'supplier_product_id', 'supplier_row_hash', 'synced_at'],
+            batch_size=1000
+        )
+
+    @classmethod
+    def get_variants_df(cls, variants: list[Variant]) -> pd.DataFrame:
+        variants_df = pd.DataFrame(
+            [(variant.id, variant.product_id, variant.sku, variant.barcode) for variant in variants],
+            columns=['id', 'product_id', 'sku', 'original_barcode'],
+        )
+
+        # the supplier's barcodes are matched by length too, so the leading zeros are kept here
+        variants_df['barcode'] = (
+            ProductsFinder.clean_barcodes(variants_df['original_barcode'].fillna('')).fillna('').astype(object)
+        )
+        variants_df['is_valid_barcode'] = variants_df['barcode'].str.match(cls.RGX_BARCODE.pattern)
+
+        return variants_df
 
     @staticmethod
     def _supplier_products_as_str(supplier_products: list | None) -> str:
@@ -483,11 +730,22 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
 
         if required_locations:
 
-            # requesting inventory levels from Shopify
-            inventory_levels_map = {
-                (item.inventory_item_id, required_locations[item.location_id]): item.available
-                for item in self.shopify_client.get_inventory_levels(required_inventory_items, required_locations)
-            }
+            if all(hasattr(variant, 'inventory_levels') for variant in required_inventory_items.values()):
+                # the inventory levels have been already exported with the variants
+                inventory_levels_map = {
+                    (inventory_item_id, loc_name): variant.inventory_levels.get(location_id)
+                    for inventory_item_id, variant in required_inventory_items.items()
+                    for location_id, loc_name in required_locations.items()
+                }
+            else:
+                # requesting inventory levels from Shopify
+                inventory_levels_map = {
+                    (inventory_item_id, required_locations[location_id]): available
+                    for (inventory_item_id, location_id), available in self.shopify_client.get_inventory_levels(
+                        required_inventory_items, required_locations).items()
+                }
+
+            variant_updaters = []
 
             while self._matched_products:
 
@@ -498,7 +756,7 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
                 inventory_level = inventory_levels_map.get((shopify_variant.inventory_item_id,
                                                             supplier_product['location_name']))
 
-                ShopifyVariantUpdater(
+                variant_updater = ShopifyVariantUpdater(
                     shopify_variant,
                     supplier_product,
                     shopify_inventory_level=inventory_level,
@@ -506,14 +764,21 @@ class ShopifyProductsUpdater(AbstractShopifyProductsUpdater):
                     gid=self.gid,
                     source_name=self.source_name,
                     update_price=self.update_price,
-                    update_inventory=self.update_inventory
-                )(dry=dry)
+                    update_inventory=self.update_inventory,
+                    updates_queue=self.updates_queue
+                )
+                variant_updater(dry=dry)
+                variant_updaters.append(variant_updater)
 
-    def find_supplier_product(self, shopify_variant_barcode: str, shopify_variant: Variant) -> dict | None:
-        shopify_variant_data = shopify_variant.to_dict() | {'barcode': shopify_variant_barcode}
-        found_product = self.products_finder.find_product_by_barcode_and_sku(shopify_variant_data)
+            self.updates_queue.flush()
 
-        return found_product
+            if self.diff_sync and not dry:
+                self.save_snapshots(variant_updaters)
+
+    def find_supplier_products(self, variants_df: pd.DataFrame) -> dict[int, dict]:
+        return self.products_finder.find_many_by_barcode_and_sku(
+            variants_df[['id', 'product_id', 'sku', 'barcode']].to_dict('records')
+        )
 
     def find_supplier_product_by_sku(self, shopify_variant: Variant) -> list[dict] | None:
         found_products = self.products_finder.find_products_by_sku(shopify_variant.to_dict())
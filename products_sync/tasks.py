@@ -1,4 +1,7 @@
 import logging
+import sys
+import threading
+from time import monotonic
 
 import redis
 from celery import shared_task, chain
@@ -15,19 +18,92 @@ redis_client = redis.from_url(REDIS_URL)
 
 
 class CeleryLogHandler(logging.Handler):
+    """
+    Collects the task logs in the Redis list `task_logs:{task_id}` to show them on the frontend.
+
+    The records are buffered and sent by one pipelined request when the buffer is full or every `FLUSH_INTERVAL`
+    seconds, and on closing the handler at the end of the task. Only the last `MAX_LOG_LINES` lines are kept,
+    the number of the trimmed ones is kept in `task_logs:{task_id}:trimmed`. Every flush is announced in the
+    `task_logs:{task_id}:events` channel for the logs streaming clients.
+    """
+
+    BUFFER_SIZE = 500
+    FLUSH_INTERVAL = 1
+    MAX_LOG_LINES = 100_000
+    KEY_EXPIRE = 3600
+
+    LOGS_EVENT = 'logs'
+    CLOSED_EVENT = 'closed'
+
     def __init__(self, level, task) -> None:
         super().__init__(level)
         self.task = task
 
+        self.redis_key = self.get_redis_key(task.request.id)
+        self.buffer: list[str] = []
+        self.lines_count = 0
+        self.last_flush_time = monotonic()
+
+        # flushes the buffer when nothing is logged for a while
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True, name='celery_log_flusher')
+        self.flusher.start()
+
+    @staticmethod
+    def get_redis_key(task_id: str) -> str:
+        return f"task_logs:{task_id}"
+
+    @staticmethod
+    def get_trimmed_redis_key(task_id: str) -> str:
+        return f"task_logs:{task_id}:trimmed"
+
+    @staticmethod
+    def get_events_channel(task_id: str) -> str:
+        return f"task_logs:{task_id}:events"
+
     def emit(self, record):
-        log_message = self.format(record)
+        self.buffer.append(self.format(record))
+
+        if len(self.buffer) >= self.BUFFER_SIZE or monotonic() - self.last_flush_time >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.last_flush_time = monotonic()
+
+            if not self.buffer:
+                return
+
+            log_messages, self.buffer = self.buffer, []
+            self.lines_count += len(log_messages)
+
+            try:
+                with redis_client.pipeline() as pipe:
+                    pipe.rpush(self.redis_key, *log_messages)
+                    pipe.ltrim(self.redis_key, -self.MAX_LOG_LINES, -1)
+                    pipe.expire(self.redis_key, self.KEY_EXPIRE)
+                    pipe.set(self.get_trimmed_redis_key(self.task.request.id),
+                             max(0, self.lines_count - self.MAX_LOG_LINES), ex=self.KEY_EXPIRE)
+                    pipe.publish(self.get_events_channel(self.task.request.id), self.LOGS_EVENT)
+                    pipe.execute()
+            except redis.RedisError as e:
+                # can't be logged by the logger the handler is attached to
+                sys.stderr.write("Unable to save %s task log lines to Redis - %s\n" % (len(log_messages), e))
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
 
-        # Append the log message to the Redis list with the task ID as the key
-        redis_key = f"task_logs:{self.task.request.id}"
-        redis_client.rpush(redis_key, log_message)
+        try:
+            redis_client.publish(self.get_events_channel(self.task.request.id), self.CLOSED_EVENT)
+        except redis.RedisError as e:
+            sys.stderr.write("Unable to publish the task logs closing - %s\n" % e)
 
-        # Set expiration time for the Redis key (optional)
-        redis_client.expire(redis_key, 3600)  # Set expiration time to 1 hour
+        super().close()
 
 
 class SingletonAbortableTask(AbortableTask, Singleton):
@@ -62,5 +138,6 @@ def sync_products(self_task, source_id: int, dry: bool, params=None):
         gid = processor.run_sync(dry=dry, is_aborted_callback=self_task.is_aborted)
     finally:
         logger.removeHandler(handler)
+        handler.close()
 
     return {'gid': gid}
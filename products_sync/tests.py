@@ -1,19 +1,39 @@
+import csv
+import io
+import json
+import logging
 import os
 import random
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from datetime import timedelta
 from pathlib import Path
-from unittest.mock import patch
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from unittest.mock import Mock, patch
 
 import pandas as pd
-from dateutil.utils import today
+from django.contrib.auth import get_user_model
+from django.db.models import F, Max
 from django.urls import reverse
+from django.utils.timezone import now
 from rest_framework import status
+from rest_framework.authtoken.models import Token
+from django.test import TestCase
+import redis
 from rest_framework.test import APITestCase
 
 from app import settings
-from app.lib.shopify_client import ShopifyClient
+from app.lib.fuse5_remote import Fuse5DB, Fuse5FieldsMap
+from app.lib.products_finder import ProductsFinder, SqliteProductsFinder
+from app.lib.shopify_client import ShopifyClient, TTLCache, ShopifyGraphQLException
+from app.lib.shopify_rate_limiter import ShopifyRateLimiter, ShopifyAPI
+from products_sync.sync_processors.shopify_products_updater import ShopifyUpdatesQueue
 from products_sync.sync_processors import Fuse5Processor, ShopifyProductsUpdater
-from products_sync.models import Fuse5Products
+from products_sync.models import Fuse5Products, ProductsUpdateLog, ShopifyVariantSnapshot, SyncRun
+from products_sync.tasks import CeleryLogHandler
+from products_sync.views import TaskLogsStreamView, TaskStreamTokenAuthentication
+from shopify import Variant
 
 
 class ShopifyProductsUpdater_Patched(ShopifyProductsUpdater):
@@ -31,7 +51,6 @@ class ShopifyProductsUpdater_Patched(ShopifyProductsUpdater):
 class TestShopifyProductsUpdater(APITestCase):
     def setUp(self):
         os.environ.setdefault('SHOPIFY_SHOP_NAME', 'prikidtest')
-        settings.FUSE5_LOAD_DATA_CHANGED_SINCE = (today() - timedelta(days=10)).strftime("%m-%d-%Y 00:00:00")
 
     def mocked_update_from_remote(self):
         sample_fuse5_file = Path("samples/fuse5data.csv")
@@ -123,3 +142,837 @@ class TestShopifyProductsUpdater(APITestCase):
 
         for idx, variant in enumerate(shopify_client.variants(), 1):
             pass
+
+
+class TestProductsFinder(TestCase):
+    def setUp(self):
+        # created one by one to fill `sku_normalized` on save
+        Fuse5Products.objects.create(barcode='0012345678', sku='CBT-49', price=10, inventory_quantity=1, line_code='AAA')
+        Fuse5Products.objects.create(barcode='12345678', sku='cbt49', price=11, inventory_quantity=2, line_code='BBB')
+        Fuse5Products.objects.create(barcode='87654321', sku='XYZ 1', price=12, inventory_quantity=3,
+                                     location_name='Store')
+
+    def test_indexed_search_is_the_same_as_db_search(self):
+        db_finder = ProductsFinder(Fuse5Products.objects, default_location_name='Default')
+        indexed_finder = ProductsFinder(Fuse5Products.objects, default_location_name='Default', preload_index=True)
+        self.assertTrue(indexed_finder.is_indexed)
+
+        variants = [
+            dict(id=1, product_id=1, barcode='12345678', sku='cbt49'),
+            dict(id=2, product_id=1, barcode='012345678', sku='CBT-49'),
+            dict(id=3, product_id=1, barcode='87654321', sku=''),
+            dict(id=4, product_id=1, barcode='11111111', sku='xyz1'),
+        ]
+
+        for variant in variants:
+            expected = db_finder.find_product_by_barcode_and_sku(variant)
+            found = indexed_finder.find_product_by_barcode_and_sku(variant)
+
+            if expected is None:
+                self.assertIsNone(found)
+            else:
+                self.assertEqual(expected['id'], found['id'])
+                self.assertEqual(expected['location_name'], found['location_name'])
+
+            self.assertEqual(
+                sorted(p['id'] for p in db_finder.find_products_by_sku(variant) or []),
+                sorted(p['id'] for p in indexed_finder.find_products_by_sku(variant) or [])
+            )
+
+    def test_sku_normalization_is_the_same_in_python_pandas_and_sql(self):
+        from django.db import connection
+
+        skus = ['CBT-49', 'cbt49', 'XYZ 1', 'a_B-c d', '--', '', None]
+
+        python_keys = [ProductsFinder.normalize_sku(sku) for sku in skus]
+        pandas_keys = ProductsFinder.normalize_skus(pd.Series(skus, dtype=object)).tolist()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {ProductsFinder.SKU_NORMALIZED_SQL} FROM unnest(%s::text[]) WITH ORDINALITY AS t(sku, n) "
+                f"ORDER BY n",
+                [skus]
+            )
+            sql_keys = [row[0] for row in cursor.fetchall()]
+
+        self.assertEqual(python_keys, ['cbt49', 'cbt49', 'xyz1', 'abcd', '', '', None])
+        self.assertEqual([None if pd.isna(key) else key for key in pandas_keys], python_keys)
+        self.assertEqual(sql_keys, python_keys)
+
+        # saved by the model
+        self.assertEqual(set(Fuse5Products.objects.values_list('sku_normalized', flat=True)), {'cbt49', 'xyz1'})
+
+    def test_empty_sku_finds_nothing(self):
+        Fuse5Products.objects.create(barcode='55555555', sku=None, price=1, inventory_quantity=1,
+                                     line_code='CCC')
+        Fuse5Products.objects.create(barcode='66666666', sku='', price=1, inventory_quantity=1)
+
+        finder = ProductsFinder(Fuse5Products.objects, default_location_name='Default')
+
+        for sku in (None, '', '- _'):
+            self.assertTrue(finder.find_by_sku(sku).empty)
+
+        self.assertEqual(len(finder.find_by_sku('cbt-49')), 2)
+
+    def test_batch_search_is_the_same_as_single_search(self):
+        finder = ProductsFinder(Fuse5Products.objects, preload_index=True)
+
+        variants = [
+            SimpleNamespace(id=1, product_id=1, barcode='12345678', sku='cbt49'),
+            SimpleNamespace(id=2, product_id=1, barcode=' 0012-345678', sku='unknown'),
+            SimpleNamespace(id=3, product_id=2, barcode='8.7654321E+7', sku=None),
+            SimpleNamespace(id=4, product_id=2, barcode='123', sku='XYZ1'),
+            SimpleNamespace(id=5, product_id=3, barcode=None, sku=None),
+        ]
+
+        variants_df = ShopifyProductsUpdater.get_variants_df(variants)
+        self.assertEqual([True, True, True, False, False], variants_df['is_valid_barcode'].tolist())
+        self.assertEqual('87654321', variants_df.loc[2, 'barcode'])
+        # the same cleaning as the finder does, with the leading zeros kept
+        self.assertEqual([ProductsFinder.clean_barcode(variant.barcode or '') for variant in variants],
+                         variants_df['barcode'].tolist())
+        self.assertEqual('0012345678', variants_df.loc[1, 'barcode'])
+
+        valid_variants = variants_df[variants_df['is_valid_barcode']].to_dict('records')
+        db_finder = ProductsFinder(Fuse5Products.objects)
+        sqlite_finder = SqliteProductsFinder(pd.DataFrame.from_records(Fuse5Products.objects.order_by('pk').values()))
+
+        for batch_finder in (finder, db_finder, sqlite_finder):
+            found = batch_finder.find_many_by_barcode_and_sku(valid_variants)
+
+            for variant in valid_variants:
+                expected = finder.find_product_by_barcode_and_sku(variant)
+                self.assertEqual(expected['id'], found[variant['id']]['id'])
+
+    def test_sqlite_finder_numeric_barcodes(self):
+        # the barcodes of a CSV file read without dtypes are numbers
+        df = pd.read_csv(io.StringIO("barcode,sku,price,inventory_quantity\n12345678,A1,10,1\n87654321,B1,11,2\n"))
+        sqlite_finder = SqliteProductsFinder(df, default_location_name='Store')
+
+        found = sqlite_finder.find_many_by_barcode_and_sku([
+            dict(id=1, product_id=1, barcode='12345678', sku='A1'),
+            dict(id=2, product_id=1, barcode='87654321', sku=None),
+        ])
+
+        self.assertEqual({1: 'A1', 2: 'B1'}, {variant_id: product['sku'] for variant_id, product in found.items()})
+        self.assertEqual(['barcode', 'sku', 'price', 'inventory_quantity', 'location_name'], list(found[1]))
+
+    def test_barcode_key(self):
+        self.assertEqual('12345678', ProductsFinder.normalize_barcode(' 0012-345678'))
+        self.assertEqual('87654321', ProductsFinder.normalize_barcode('8.7654321E+7'))
+        self.assertEqual('', ProductsFinder.normalize_barcode('000'))
+        self.assertEqual(
+            ['12345678', '87654321', '', None],
+            ProductsFinder.normalize_barcodes(pd.Series(['0012345678', '8.7654321E+7', 'n/a', None]))
+            .replace({pd.NA: None}).tolist()
+        )
+
+        self.assertEqual(['12345678', '12345678', '87654321'],
+                         list(Fuse5Products.objects.order_by('pk').values_list('barcode_key', flat=True)))
+
+    def test_too_long_barcode_key(self):
+        from django.db import connection
+
+        barcodes = ['9.99999E+29', '1.23456E+13', '123456789012345678', '00012345678901234', None]
+
+        python_keys = [ProductsFinder.normalize_barcode(barcode) for barcode in barcodes]
+        pandas_keys = ProductsFinder.normalize_barcodes(pd.Series(barcodes, dtype=object)).tolist()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {ProductsFinder.BARCODE_KEY_SQL} FROM unnest(%s::text[]) WITH ORDINALITY AS t(barcode, n) "
+                f"ORDER BY n",
+                [barcodes]
+            )
+            sql_keys = [row[0] for row in cursor.fetchall()]
+
+        self.assertEqual(python_keys, [None, '12345600000000', None, '12345678901234', None])
+        self.assertEqual([None if pd.isna(key) else key for key in pandas_keys], python_keys)
+        self.assertEqual(sql_keys, python_keys)
+
+        # no int64 overflow, the broken barcode just can't be restored
+        self.assertEqual([None, '12345600000000'],
+                         ProductsFinder.clean_barcodes(pd.Series(barcodes[:2])).replace({pd.NA: None}).tolist())
+
+        # saved by the model without overflowing the column
+        product = Fuse5Products.objects.create(barcode='9.99999E+29', sku='LONG1', price=1, inventory_quantity=1)
+        self.assertIsNone(Fuse5Products.objects.get(pk=product.pk).barcode_key)
+
+
+class FakeShopifyGraphQLServer:
+    """
+    Local HTTP server answering GraphQL requests by the `responder(payload) -> dict` callable
+    and serving the `files` by their paths
+    """
+
+    def __init__(self, responder: callable, files: dict[str, str] = None):
+        self.requests = []
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = (files or {})[self.path].encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                fake_server.requests.append(payload)
+
+                body = json.dumps(responder(payload)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = "http://127.0.0.1:%s" % self.httpd.server_port
+        self.url = self.base_url + "/graphql.json"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeShopifyRESTServer(FakeShopifyGraphQLServer):
+    """
+    Local HTTP server answering REST GET requests by the `responder(path, query) -> (body, next_page_query)` callable.
+    The requests without the access token are refused as Shopify does.
+    """
+
+    API_PATH = '/admin/api/%s' % ShopifyClient.API_VERSION
+
+    def __init__(self, responder: callable):
+        self.requests = []
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake_server.requests.append((url.path, url.query))
+
+                if self.headers.get('X-Shopify-Access-Token') != 'token':
+                    return self.send_json(401, {'errors': 'Invalid API key or access token'})
+
+                body, next_page_query = responder(url.path.removeprefix(fake_server.API_PATH),
+                                                  {k: v[0] for k, v in parse_qs(url.query).items()})
+
+                headers = {}
+                if next_page_query:
+                    headers['Link'] = '<%s%s?%s>; rel="next"' % (fake_server.base_url, url.path, next_page_query)
+
+                self.send_json(200, body, headers)
+
+            def send_json(self, code: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = "http://127.0.0.1:%s" % self.httpd.server_port
+
+
+def get_offline_shopify_client(graphql_url: str, rest_url: str = None) -> ShopifyClient:
+    location = SimpleNamespace(id=1, name=ShopifyClient.DEFAULT_LOCATION_NAME)
+
+    with patch.object(ShopifyClient, 'get_locations', return_value=[location]):
+        shopify_client = ShopifyClient(shop_name='test', api_token='token', graphql_url=graphql_url)
+
+    if rest_url is not None:
+        shopify_client.session = SimpleNamespace(site=rest_url + FakeShopifyRESTServer.API_PATH, url=rest_url,
+                                                 api_version=SimpleNamespace(name=ShopifyClient.API_VERSION),
+                                                 token='token')
+        shopify_client.activate_session()
+
+    return shopify_client
+
+
+class TestShopifyClientGraphQL(TestCase):
+    def test_update_variants_prices(self):
+        def responder(payload):
+            data = {}
+            for idx in range(len(payload['variables']) // 2):
+                user_errors = []
+                if payload['variables'][f"productId{idx}"] == ShopifyClient.to_gid('Product', 2):
+                    user_errors.append({'field': ['variants', '1', 'price'], 'message': 'Invalid price'})
+
+                data[f"p{idx}"] = {'userErrors': user_errors}
+
+            return {'data': data}
+
+        with FakeShopifyGraphQLServer(responder) as server:
+            shopify_client = get_offline_shopify_client(server.url)
+            shopify_client.PRODUCTS_PER_PRICES_MUTATION = 2
+
+            errors = shopify_client.update_variants_prices([
+                (1, 11, 1.5),
+                (2, 21, 2.5),
+                (2, 22, -1),
+                (3, 31, 3.5),
+            ])
+
+        self.assertEqual({22: 'Invalid price'}, errors)
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual(
+            [{'id': ShopifyClient.to_gid('ProductVariant', 21), 'price': '2.5'},
+             {'id': ShopifyClient.to_gid('ProductVariant', 22), 'price': '-1'}],
+            server.requests[0]['variables']['variants1']
+        )
+
+    def test_set_inventory_levels(self):
+        not_stocked_items = {ShopifyClient.to_gid('InventoryItem', 102), ShopifyClient.to_gid('InventoryItem', 103)}
+
+        def responder(payload):
+            # the errors point to the items of the requested batch
+            user_errors = [
+                {'field': ['input', 'quantities', str(idx), 'locationId'], 'message': 'Not stocked'}
+                for idx, quantity in enumerate(payload['variables']['input']['quantities'])
+                if quantity['inventoryItemId'] in not_stocked_items
+            ]
+            return {'data': {'inventorySetQuantities': {'userErrors': user_errors}}}
+
+        with FakeShopifyGraphQLServer(responder) as server:
+            shopify_client = get_offline_shopify_client(server.url)
+            shopify_client.QUANTITIES_PER_INVENTORY_MUTATION = 2
+
+            errors = shopify_client.set_inventory_levels([(101, 1, 5), (102, 1, 6), (103, 2, 7)])
+
+        self.assertEqual({(102, 1): 'Not stocked', (103, 2): 'Not stocked'}, errors)
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual(
+            {'inventoryItemId': ShopifyClient.to_gid('InventoryItem', 103),
+             'locationId': ShopifyClient.to_gid('Location', 2),
+             'quantity': 7},
+            server.requests[1]['variables']['input']['quantities'][0]
+        )
+
+    def test_set_inventory_levels_unknown_item_error(self):
+        def responder(payload):
+            # the index out of the batch, or no index at all
+            if len(payload['variables']['input']['quantities']) > 1:
+                user_errors = [{'field': ['input', 'quantities', '5', 'locationId'], 'message': 'Out of range'}]
+            else:
+                user_errors = [{'field': ['input'], 'message': 'Invalid input'}]
+
+            return {'data': {'inventorySetQuantities': {'userErrors': user_errors}}}
+
+        with FakeShopifyGraphQLServer(responder) as server:
+            shopify_client = get_offline_shopify_client(server.url)
+            shopify_client.QUANTITIES_PER_INVENTORY_MUTATION = 2
+
+            errors = shopify_client.set_inventory_levels([(101, 1, 5), (102, 1, 6), (103, 2, 7)])
+
+        # the whole batch is failed as the failed item is unknown
+        self.assertEqual({(101, 1): 'Out of range', (102, 1): 'Out of range', (103, 2): 'Invalid input'}, errors)
+
+    def test_bulk_variants(self):
+        jsonl_lines = [
+            {'id': 'gid://shopify/ProductVariant/11', 'title': 'Red', 'sku': 'A1', 'barcode': '123456',
+             'price': '9.99', 'inventoryQuantity': 3, 'product': {'id': 'gid://shopify/Product/1'},
+             'inventoryItem': {'id': 'gid://shopify/InventoryItem/101'}},
+            {'location': {'id': 'gid://shopify/Location/1'}, 'quantities': [{'name': 'available', 'quantity': 2}],
+             '__parentId': 'gid://shopify/ProductVariant/11'},
+            {'id': 'gid://shopify/ProductVariant/12', 'title': 'Blue', 'sku': None, 'barcode': None,
+             'price': '5', 'inventoryQuantity': 0, 'product': {'id': 'gid://shopify/Product/1'},
+             'inventoryItem': {'id': 'gid://shopify/InventoryItem/102'}},
+            # a child line is not necessarily right after its parent
+            {'location': {'id': 'gid://shopify/Location/2'}, 'quantities': [{'name': 'available', 'quantity': 1}],
+             '__parentId': 'gid://shopify/ProductVariant/11'},
+        ]
+        bulk_operation = {'id': 'gid://shopify/BulkOperation/1', 'status': 'CREATED'}
+        polls = []
+
+        def responder(payload):
+            if 'bulkOperationRunQuery' in payload['query']:
+                return {'data': {'bulkOperationRunQuery': {'bulkOperation': bulk_operation, 'userErrors': []}}}
+
+            polls.append(payload)
+            status = 'RUNNING' if len(polls) < 2 else 'COMPLETED'
+            return {'data': {'currentBulkOperation': bulk_operation | {
+                'status': status, 'errorCode': None, 'objectCount': 4, 'url': server.base_url + '/result.jsonl'}}}
+
+        files = {'/result.jsonl': '\n'.join(json.dumps(line) for line in jsonl_lines)}
+
+        with FakeShopifyGraphQLServer(responder, files) as server:
+            shopify_client = get_offline_shopify_client(server.url)
+            shopify_client.BULK_OPERATION_POLL_INTERVAL = 0
+
+            variants = list(shopify_client.bulk_variants())
+
+        self.assertEqual([11, 12], [v.id for v in variants])
+        self.assertEqual({1: 2, 2: 1}, variants[0].inventory_levels)
+        self.assertEqual({}, variants[1].inventory_levels)
+        self.assertEqual((1, 101, 9.99), (variants[0].product_id, variants[0].inventory_item_id, variants[0].price))
+        self.assertNotIn('inventory_levels', variants[0].to_dict())
+
+    def test_bulk_operation_is_cancelled_on_abort(self):
+        def responder(payload):
+            if 'bulkOperationRunQuery' in payload['query']:
+                return {'data': {'bulkOperationRunQuery': {
+                    'bulkOperation': {'id': 'gid://shopify/BulkOperation/1', 'status': 'CREATED'}, 'userErrors': []}}}
+            if 'bulkOperationCancel' in payload['query']:
+                return {'data': {'bulkOperationCancel': {'userErrors': []}}}
+
+            return {'data': {'currentBulkOperation': {'id': 'gid://shopify/BulkOperation/1', 'status': 'RUNNING',
+                                                      'errorCode': None, 'objectCount': 0, 'url': None}}}
+
+        with FakeShopifyGraphQLServer(responder) as server:
+            shopify_client = get_offline_shopify_client(server.url)
+            shopify_client.BULK_OPERATION_POLL_INTERVAL = 0
+            shopify_client.callback = lambda: False
+
+            self.assertEqual([], list(shopify_client.bulk_variants()))
+
+            shopify_client.callback = None
+            shopify_client.BULK_OPERATION_TIMEOUT = 0
+            with self.assertRaises(ShopifyGraphQLException):
+                shopify_client.run_bulk_operation(ShopifyClient.BULK_VARIANTS_QUERY)
+
+        self.assertEqual(2, sum('bulkOperationCancel' in payload['query'] for payload in server.requests))
+
+    def test_updates_queue_flush(self):
+        with FakeShopifyGraphQLServer(lambda payload: {'data': {'p0': {'userErrors': []}}}) as server:
+            queue = ShopifyUpdatesQueue(get_offline_shopify_client(server.url))
+
+            updater = SimpleNamespace(shopify_variant=SimpleNamespace(id=11, product_id=1), updated_with=None)
+            updater.on_price_updated = lambda price, error: setattr(updater, 'updated_with', (price, error))
+
+            queue.add_price(updater, 9.99)
+            queue.flush()
+
+        self.assertEqual((9.99, None), updater.updated_with)
+        self.assertEqual(0, len(queue))
+
+
+class TestShopifyRateLimiter(TestCase):
+    def setUp(self):
+        self.redis_client = redis.from_url(settings.REDIS_URL)
+        self.rate_limiter = ShopifyRateLimiter(self.redis_client, 'test-%s' % random.randint(0, 10 ** 9))
+
+    def tearDown(self):
+        self.redis_client.delete(*self.redis_client.keys(self.rate_limiter.key_prefix + '*'))
+
+    def test_acquire_waits_when_bucket_is_empty(self):
+        self.rate_limiter.update(ShopifyAPI.REST, capacity=40, available=10, restore_rate=20)
+
+        with patch('app.lib.shopify_rate_limiter.sleep') as mocked_sleep:
+            self.rate_limiter.acquire(ShopifyAPI.REST)
+            mocked_sleep.assert_not_called()
+
+            self.rate_limiter.update_from_rest_header('39/40')
+            self.rate_limiter.acquire(ShopifyAPI.REST)
+            mocked_sleep.assert_called()
+
+        metrics = self.rate_limiter.metrics()[ShopifyAPI.REST]
+        self.assertEqual(2, metrics['requests'])
+        self.assertGreater(metrics['wait_time'], 0)
+
+
+class TestCeleryLogHandler(TestCase):
+    def setUp(self):
+        self.redis_client = redis.from_url(settings.REDIS_URL)
+        self.task_id = 'test-%s' % random.randint(0, 10 ** 9)
+
+    def tearDown(self):
+        self.redis_client.delete(CeleryLogHandler.get_redis_key(self.task_id),
+                                 CeleryLogHandler.get_trimmed_redis_key(self.task_id))
+
+    def test_buffering_and_trimming(self):
+        # the thresholds are set before the flusher thread starts waiting
+        class TestHandler(CeleryLogHandler):
+            BUFFER_SIZE, MAX_LOG_LINES, FLUSH_INTERVAL = 3, 4, 60
+
+        handler = TestHandler(logging.DEBUG, SimpleNamespace(request=SimpleNamespace(id=self.task_id)))
+        test_logger = logging.getLogger('test_celery_log_handler')
+        test_logger.addHandler(handler)
+
+        try:
+            for i in range(2):
+                test_logger.warning("line %s", i)
+
+            # not flushed till the buffer is full
+            self.assertEqual(0, self.redis_client.llen(CeleryLogHandler.get_redis_key(self.task_id)))
+
+            for i in range(2, 6):
+                test_logger.warning("line %s", i)
+        finally:
+            test_logger.removeHandler(handler)
+            handler.close()
+
+        self.assertEqual([b'line 2', b'line 3', b'line 4', b'line 5'],
+                         self.redis_client.lrange(CeleryLogHandler.get_redis_key(self.task_id), 0, -1))
+        self.assertEqual(b'2', self.redis_client.get(CeleryLogHandler.get_trimmed_redis_key(self.task_id)))
+
+
+class TestTaskLogsStream(APITestCase):
+    def setUp(self):
+        self.redis_client = redis.from_url(settings.REDIS_URL)
+        self.task_id = 'test-%s' % random.randint(0, 10 ** 9)
+
+        self.user = get_user_model().objects.create_user(email='stream@test.com', password='test')
+        self.token = Token.objects.create(user=self.user)
+        self.stream_token = TaskStreamTokenAuthentication.get_token(self.user, self.task_id)
+        self.url = reverse('products_sync:task_logs_stream', args=(self.task_id,))
+
+    def tearDown(self):
+        self.redis_client.delete(CeleryLogHandler.get_redis_key(self.task_id))
+
+    def get_stream(self, **params):
+        task = Mock(state='SUCCESS', result=dict(gid=5), **{'ready.return_value': True})
+
+        with patch('products_sync.views.AsyncResult', return_value=task):
+            response = self.client.get(self.url, params, HTTP_ACCEPT='text/event-stream')
+            content = b''.join(response.streaming_content).decode() if response.streaming else ''
+
+        return response, content
+
+    def test_stream_till_complete(self):
+        self.redis_client.rpush(CeleryLogHandler.get_redis_key(self.task_id), 'line 0', 'line 1', 'line 2')
+
+        response, content = self.get_stream(token=self.stream_token, from_index=1)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('id: 3\nevent: logs\ndata: {"logs": ["line 1", "line 2"], "next_index": 3}', content)
+        self.assertIn('event: state', content)
+        self.assertIn('"gid": 5', content)
+
+    def test_token_is_required(self):
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.get_stream()[0].status_code)
+
+        # the API token is never passed in the URL
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.get_stream(token=self.token.key)[0].status_code)
+
+        other_task_token = TaskStreamTokenAuthentication.get_token(self.user, 'other')
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.get_stream(token=other_task_token)[0].status_code)
+
+        with patch.object(TaskStreamTokenAuthentication, 'MAX_AGE', -1):
+            self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.get_stream(token=self.stream_token)[0].status_code)
+
+    def test_streams_are_limited(self):
+        with patch.object(TaskLogsStreamView, 'streams_semaphore', threading.BoundedSemaphore(1)):
+            # the slot is released when the stream is closed
+            for _ in range(2):
+                self.assertEqual(status.HTTP_200_OK, self.get_stream(token=self.stream_token)[0].status_code)
+
+            TaskLogsStreamView.streams_semaphore.acquire()
+            response, _ = self.get_stream(token=self.stream_token)
+
+        self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+        self.assertEqual(str(TaskLogsStreamView.RETRY_AFTER), response['Retry-After'])
+
+
+class TestProductsUpdateLogCsv(APITestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(email='csv@test.com', password='test')
+        self.client.force_authenticate(user)
+
+        ProductsUpdateLog.objects.bulk_create([
+            ProductsUpdateLog(gid=1, source='Fuse5', sku='A-1', product_id=1, variant_id=11, barcode='123',
+                              changes=dict(price=dict(old=1.5, new=2), quantity=dict(location='Main', old=1, new=3))),
+            ProductsUpdateLog(gid=1, source='Fuse5', sku='B-2', product_id=2, variant_id=22, barcode=None,
+                              changes=dict(unmatched=True, matched_by_sku='B2')),
+        ])
+
+    def test_download_csv_streamed(self):
+        url = reverse('products_sync:products_sync_logs-download-csv', args=(1, 1))
+        response = self.client.get(url)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('products_sync_log_1_', response['Content-Disposition'])
+        self.assertEqual(['source', 'time', 'sku', 'product_id', 'variant_id', 'barcode',
+                          'price_old', 'price_new', 'quantity_location', 'quantity_old', 'quantity_new'], rows[0])
+        self.assertEqual(2, len(rows))
+        self.assertEqual(['A-1', '1', '11', '123', '1.5', '2', 'Main', '1', '3'], rows[1][2:])
+
+    def test_groups(self):
+        self.assertEqual(2, SyncRun.get_next_gid(SyncRun.Types.PRODUCTS, ProductsUpdateLog))
+
+        SyncRun.save_run(SyncRun.Types.PRODUCTS, 1, now() - timedelta(minutes=1), 'Fuse5',
+                         **ProductsUpdateLog.count_changes(1))
+        # neither the runs without changes nor the running ones are listed
+        SyncRun.save_run(SyncRun.Types.PRODUCTS, 2, now(), 'Fuse5')
+        SyncRun.start_run(SyncRun.Types.PRODUCTS, ProductsUpdateLog, now(), 'Fuse5')
+        SyncRun.save_run(SyncRun.Types.PRODUCTS, 4, now(), 'Fuse5', unmatched_variants=2)
+
+        response = self.client.get(reverse('products_sync:products_sync_logs-groups'), dict(limit=1, offset=1))
+
+        self.assertEqual(2, response.data['count'])
+        self.assertEqual(1, len(response.data['results']))
+        self.assertEqual(dict(gid=1, price_updates=1, quantity_updates=1, unmatched_variants=1),
+                         {k: response.data['results'][0][k]
+                          for k in ('gid', 'price_updates', 'quantity_updates', 'unmatched_variants')})
+        self.assertEqual(5, SyncRun.get_next_gid(SyncRun.Types.PRODUCTS, ProductsUpdateLog))
+
+    def test_concurrent_runs_take_different_gids(self):
+        start_time = now()
+
+        # both runs have found the same max gid, but only one of them inserts it
+        with patch.object(SyncRun, 'get_next_gid', side_effect=[2, 2, 3]):
+            self.assertEqual(2, SyncRun.start_run(SyncRun.Types.PRODUCTS, ProductsUpdateLog, start_time, 'Fuse5'))
+            self.assertEqual(3, SyncRun.start_run(SyncRun.Types.PRODUCTS, ProductsUpdateLog, start_time, 'Fuse5'))
+
+        self.assertEqual([2, 3], list(SyncRun.objects.filter(type=SyncRun.Types.PRODUCTS).order_by('gid')
+                                      .values_list('gid', flat=True)))
+
+
+class TestFuse5DB(TestCase):
+    def setUp(self):
+        self.fuse5_db = Fuse5DB(fuse5_client=Mock())
+        self.exports = []
+        self.changed_since = []
+
+    def export(self, *rows: tuple):
+        # the rows are (line_code, sku, location_name, price)
+        self.exports.append([
+            dict(unit_barcode='123456', m6=price, quantity_onhand=1, product_number=sku, line_code=line_code,
+                 product_name='Product', location_name=location_name)
+            for line_code, sku, location_name, price in rows
+        ])
+
+    def get_data_from_remote(self, save_to, changed_since=None):
+        self.changed_since.append(changed_since)
+
+        rows = self.exports.pop(0)
+        text = io.StringIO()
+        writer = csv.DictWriter(text, fieldnames=Fuse5FieldsMap.original_fields())
+        writer.writeheader()
+        writer.writerows(rows)
+        save_to.write(text.getvalue().encode())
+
+    def get_prices(self) -> dict:
+        return {(p.line_code, p.sku): p.price for p in Fuse5Products.objects.all()}
+
+    def test_full_incremental_and_full_updates(self):
+        with patch.object(Fuse5DB, 'get_data_from_remote', new=self.get_data_from_remote):
+            # the last one of the duplicated rows wins
+            self.export(('AAA', 'A-1', 'Store', 1), ('BBB', 'B-1', 'Store', 2), ('AAA', 'A-1', 'Store', 3))
+            self.fuse5_db.update_from_remote()
+
+            self.assertEqual({('AAA', 'A-1'): 3, ('BBB', 'B-1'): 2}, self.get_prices())
+            self.assertEqual('a1', Fuse5Products.objects.get(line_code='AAA').sku_normalized)
+            self.assertFalse(self.fuse5_db.is_full_update_required())
+
+            last_update = Fuse5Products.objects.aggregate(Max('updated_at'))['updated_at__max']
+            self.export(('AAA', 'A-1', 'Store', 4), ('CCC', 'C-1', 'Store', 5))
+            self.fuse5_db.update_from_remote()
+
+            self.assertEqual(last_update - timedelta(hours=settings.FUSE5_CHANGED_SINCE_OVERLAP_HOURS),
+                             self.changed_since[-1])
+            self.assertEqual({('AAA', 'A-1'): 4, ('BBB', 'B-1'): 2, ('CCC', 'C-1'): 5}, self.get_prices())
+
+            # the last full update is too old
+            Fuse5Products.objects.update(
+                updated_at=F('updated_at') - timedelta(days=settings.FUSE5_FULL_RECONCILIATION_DAYS + 1))
+            self.assertTrue(self.fuse5_db.is_full_update_required())
+
+            self.export(('AAA', 'A-1', 'Store', 6), ('CCC', 'C-1', 'Store', 5))
+            self.fuse5_db.update_from_remote()
+
+        self.assertEqual([None, self.changed_since[1], None], self.changed_since)
+        self.assertEqual({('AAA', 'A-1'): 6, ('CCC', 'C-1'): 5}, self.get_prices())
+
+    def test_barcode_broken_by_spreadsheet(self):
+        with patch.object(Fuse5DB, 'get_data_from_remote', new=self.get_data_from_remote):
+            self.export(('AAA', 'A-1', 'Store', 1), ('BBB', 'B-1', 'Store', 2))
+            self.exports[-1][1]['unit_barcode'] = '9.99999E+29'
+            self.fuse5_db.update_from_remote()
+
+        self.assertEqual({'AAA': '123456', 'BBB': None},
+                         dict(Fuse5Products.objects.values_list('line_code', 'barcode_key')))
+
+
+class TestDiffSync(TestCase):
+    def setUp(self):
+        self.product_a = Fuse5Products.objects.create(barcode='12345678', sku='A1', price=10, inventory_quantity=5,
+                                                      location_name='Store', line_code='AAA')
+        self.product_b = Fuse5Products.objects.create(barcode='87654321', sku='B1', price=5, inventory_quantity=2,
+                                                      location_name='Store', line_code='BBB')
+
+        self.location = SimpleNamespace(id=1, name='Store')
+        self.shopify_client = Mock(DEFAULT_LOCATION_NAME='Store')
+        self.shopify_client.find_location_by_name.return_value = self.location
+        self.shopify_client.get_location.return_value = self.location
+        self.shopify_client.update_variants_prices.return_value = {}
+        self.shopify_client.set_inventory_levels.return_value = {}
+
+        self.store = {
+            11: dict(price=9.0, quantity=3, updated_at='2026-01-01T00:00:00Z'),
+            12: dict(price=5.0, quantity=2, updated_at='2026-01-01T00:00:00Z'),
+        }
+
+    def get_variants(self) -> list[Variant]:
+        variants = []
+        for variant_id, barcode, sku in ((11, '12345678', 'A1'), (12, '87654321', 'B1')):
+            state = self.store[variant_id]
+            variant = Variant(dict(id=variant_id, product_id=1, title='', sku=sku, barcode=barcode,
+                                   price=state['price'], inventory_quantity=state['quantity'],
+                                   inventory_item_id=variant_id + 100, updated_at=state['updated_at']),
+                              prefix_options={})
+            object.__setattr__(variant, 'inventory_levels', {self.location.id: state['quantity']})
+            variants.append(variant)
+
+        return variants
+
+    def sync(self, dry: bool = False) -> ShopifyProductsUpdater:
+        self.shopify_client.reset_mock()
+
+        updater = ShopifyProductsUpdater(self.shopify_client, 'Fuse5', Fuse5Products.objects,
+                                         check_if_aborted=lambda: True, diff_sync=True)
+        with patch.object(ShopifyProductsUpdater, 'get_shopify_variants', side_effect=self.get_variants):
+            return updater.process(dry=dry)
+
+    def get_updated_prices(self) -> list[tuple]:
+        return [item for call in self.shopify_client.update_variants_prices.call_args_list for item in call.args[0]]
+
+    def test_not_changed_variants_are_skipped(self):
+        self.assertEqual(0, self.sync().skipped_count)
+        self.assertEqual([(1, 11, 10.0)], self.get_updated_prices())
+
+        # the snapshot keeps the state after the update
+        snapshot = ShopifyVariantSnapshot.objects.get(variant_id=11)
+        self.assertEqual((None, 10.0, 5), (snapshot.shopify_updated_at, snapshot.price, snapshot.inventory_quantity))
+
+        # Shopify has changed the update time of the updated variant
+        self.store[11] = dict(price=10.0, quantity=5, updated_at='2026-01-01T00:01:00Z')
+
+        self.assertEqual(2, self.sync().skipped_count)
+        self.assertEqual([], self.get_updated_prices())
+        self.shopify_client.set_inventory_levels.assert_not_called()
+
+    def test_rest_price_is_compared_as_float(self):
+        # the REST API returns the prices as strings, e.g. after saving a variant
+        variant = self.get_variants()[1]
+        variant.price = '5.00'
+
+        self.assertEqual(5.0, ShopifyProductsUpdater.get_variant_state(variant)[3])
+
+    def test_supplier_row_change(self):
+        self.sync()
+        self.store[11] = dict(price=10.0, quantity=5, updated_at='2026-01-01T00:01:00Z')
+
+        self.product_b.price = 6
+        self.product_b.save()
+
+        self.assertEqual(1, self.sync().skipped_count)
+        self.assertEqual([(1, 12, 6.0)], self.get_updated_prices())
+
+    def test_better_supplier_match(self):
+        # matched by the barcode only
+        Fuse5Products.objects.filter(pk=self.product_a.pk).update(sku='X1')
+        self.sync()
+        self.store[11] = dict(price=10.0, quantity=5, updated_at='2026-01-01T00:01:00Z')
+
+        # the same barcode and SKU, but the old product hasn't changed
+        Fuse5Products.objects.create(barcode='12345678', sku='A1', price=20, inventory_quantity=5,
+                                     location_name='Store', line_code='CCC')
+
+        self.assertEqual(1, self.sync().skipped_count)
+        self.assertEqual([(1, 11, 20.0)], self.get_updated_prices())
+
+    def test_shopify_side_change(self):
+        self.sync()
+        self.store[11] = dict(price=12.0, quantity=5, updated_at='2026-01-02T00:00:00Z')
+
+        self.assertEqual(1, self.sync().skipped_count)
+        self.assertEqual([(1, 11, 10.0)], self.get_updated_prices())
+
+    def test_dry_run_keeps_snapshots(self):
+        self.sync()
+        ShopifyVariantSnapshot.objects.filter(variant_id=12).update(synced_at=now() - timedelta(days=30))
+
+        # the old snapshot is not used, but not deleted either
+        updater = self.sync(dry=True)
+
+        self.assertEqual(0, updater.skipped_count)
+        self.assertEqual(2, ShopifyVariantSnapshot.objects.count())
+
+
+class TestTTLCache(TestCase):
+    def test_lru_and_expiration(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set(1, 'a')
+        cache.set(2, None)
+        cache.get(1)
+        cache.set(3, 'c')
+
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertEqual('c', cache.get(3))
+
+        with patch('app.lib.shopify_client.monotonic', return_value=10 ** 9):
+            self.assertNotIn(1, cache)
+
+
+class TestShopifyClientPrefetch(TestCase):
+    def test_pages_order_and_errors_are_kept(self):
+        shopify_client = get_offline_shopify_client(graphql_url=None)
+        shopify_client.prefetch_pages = 1
+
+        def pages():
+            yield from ([1, 2], [3], [4, 5])
+            raise ValueError('Broken page')
+
+        received = []
+        with self.assertRaises(ValueError):
+            for page in shopify_client._iter_pages_prefetched(pages()):
+                received.extend(page)
+
+        self.assertEqual([1, 2, 3, 4, 5], received)
+
+    def test_pages_are_fetched_with_session(self):
+        def responder(path, query):
+            if path == '/variants/count.json':
+                return {'count': 3}, None
+            if 'page_info' not in query:
+                return {'variants': [{'id': 1, 'price': '1.50'}, {'id': 2, 'price': '2'}]}, 'page_info=next&limit=2'
+
+            return {'variants': [{'id': 3, 'price': '3'}]}, None
+
+        with FakeShopifyRESTServer(responder) as server:
+            shopify_client = get_offline_shopify_client(graphql_url=None, rest_url=server.base_url)
+            shopify_client.page_size, shopify_client.prefetch_pages = 2, 1
+
+            variants = list(shopify_client.variants())
+
+        self.assertEqual([(1, 1.5), (2, 2.0), (3, 3.0)], [(v.id, v.price) for v in variants])
+        self.assertEqual(3, len(server.requests))
+
+    def test_inventory_levels(self):
+        def responder(path, query):
+            # the next page urls have only the page_info param
+            if query.get('page_info') == 'chunk_1':
+                return {'inventory_levels': [{'inventory_item_id': 102, 'location_id': 2, 'available': 7}]}, None
+            if query['inventory_item_ids'] == '101,102':
+                return {'inventory_levels': [{'inventory_item_id': 101, 'location_id': 1, 'available': 5}]}, \
+                    'page_info=chunk_1&limit=250'
+
+            return {'inventory_levels': []}, None
+
+        with FakeShopifyRESTServer(responder) as server:
+            shopify_client = get_offline_shopify_client(graphql_url=None, rest_url=server.base_url)
+            shopify_client.INVENTORY_ITEMS_PER_REQUEST = 2
+
+            inventory_levels = shopify_client.get_inventory_levels([101, 102, 103], [1, 2])
+
+        self.assertEqual({(101, 1): 5, (101, 2): None, (102, 1): None, (102, 2): 7, (103, 1): None, (103, 2): None},
+                         inventory_levels)
+        self.assertEqual(3, len(server.requests))
+        self.assertEqual(2, sum('location_ids=' in query for _, query in server.requests))
+
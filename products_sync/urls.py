@@ -14,6 +14,7 @@ app_name = 'products_sync'
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('task/<str:task_id>/stream/', views.TaskLogsStreamView.as_view(), name='task_logs_stream'),
     re_path(r'^task/(?P<task_id>[\w-]+)/(?P<from_index>\d+)?', views.ManageCeleryTask.as_view()),
 
     path('get_csv_proxy/', views.get_csv_proxy),
@@ -1,39 +1,71 @@
+import csv
+import json
 import re
+from threading import BoundedSemaphore
+from time import monotonic
 
 import pandas as pd
 import redis
 import requests
 from celery.result import AsyncResult
-from django.http import HttpResponse
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.http import StreamingHttpResponse
 from django.utils.text import slugify
-from django.utils.timezone import now
+from django.utils.timezone import now, localtime
 from pyactiveresource import connection
 from rest_framework import mixins, viewsets, status
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.authentication import BaseAuthentication, TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.decorators import action, api_view
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django_cte import With
 
 from app import settings
 from app.lib.shopify_client import ShopifyClient
 from app.settings import REDIS_URL
 from . import logger
 from .filters import ShowHiddenFilterBackend
-from .models import StockDataSource, ProductsUpdateLog, UnmatchedProductsForReview, HiddenProductsFromUnmatchedReview
+from .models import StockDataSource, ProductsUpdateLog, UnmatchedProductsForReview, HiddenProductsFromUnmatchedReview, \
+    SyncRun
 from .serializers import StockDataSourceSerializer, ProductsUpdateLogSerializer, UnmatchedProductsForReviewSerializer, \
-    HiddenProductsFromUnmatchedReviewSerializer
+    HiddenProductsFromUnmatchedReviewSerializer, SyncRunSerializer
 from .sync_processors import CustomCSVProcessor
 from .sync_processors.shopify_products_updater import ShopifyVariantUpdater
-from .tasks import sync_products
+from .tasks import sync_products, CeleryLogHandler
 
 # Connect to the Redis server
 redis_client = redis.from_url(REDIS_URL)
 
 
+class EchoBuffer:
+    """
+    File-like object for `csv.writer` returning the written rows to stream them
+    """
+
+    def write(self, value):
+        return value
+
+
+def flatten_dict(d: dict, sep: str = '_', prefix: str = '') -> dict:
+    """
+    Flattens the nested dicts the same way as `pd.json_normalize`
+    """
+
+    flat = dict()
+    for k, v in d.items():
+        if isinstance(v, dict):
+            flat.update(flatten_dict(v, sep, f"{prefix}{k}{sep}"))
+        else:
+            flat[f"{prefix}{k}"] = v
+
+    return flat
+
+
 def convert_str_to_boolean(v: str):
     if v in ('False', 'false'):
         return False
@@ -64,7 +96,11 @@ class StockDataSourceViewSet(viewsets.ModelViewSet):
 
         task = sync_products.delay(source.id, dry, params)
 
-        return Response({'task_id': task.id})
+        return Response({
+            'task_id': task.id,
+            # the logs stream is authenticated by the token of the task only
+            'stream_token': TaskStreamTokenAuthentication.get_token(request.user, task.id)
+        })
 
     @action(detail=True, methods=['post'])
     def dryrun(self, request, pk=None):
@@ -77,6 +113,122 @@ class StockDataSourceViewSet(viewsets.ModelViewSet):
     #     return Response({'task_id': task.id})
 
 
+def get_task_logs(task_id: str, from_index: int) -> tuple[list[bytes], int]:
+    """
+    Receives the latest logs for the task starting from the 'from_index'
+    :return: the log lines and the index of the next line
+    """
+
+    # the first lines of too long logs are trimmed, so the list indexes are shifted by their number
+    trimmed = int(redis_client.get(CeleryLogHandler.get_trimmed_redis_key(task_id)) or 0)
+    from_index = max(int(from_index), trimmed)
+
+    # Use LRANGE to get log items in the specified range
+    logs = redis_client.lrange(CeleryLogHandler.get_redis_key(task_id), from_index - trimmed, -1)
+
+    return logs, from_index + len(logs)
+
+
+def get_task_result(task: AsyncResult) -> tuple[int | None, str, int]:
+    """
+    :return: the log group id, error message and the HTTP status code by the task result
+    """
+
+    gid = None
+    err_message = ''
+    status_code = status.HTTP_200_OK
+
+    if (result := task.result) is not None:
+        if isinstance(result, connection.Error):
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+            if m := re.search(r"code=(\d{3})", str(result)):
+                status_code = m[1]
+        elif isinstance(result, AssertionError):
+            status_code = status.HTTP_417_EXPECTATION_FAILED
+            err_message = str(result)
+        elif isinstance(result, dict):
+            gid = result.get('gid')
+        else:
+            status_code = status.HTTP_417_EXPECTATION_FAILED
+            err_message = "Got unexpected task result: %s" % str(result)
+
+    if err_message:
+        logger.error(err_message)
+
+    return gid, err_message, status_code
+
+
+class TaskStreamTokenAuthentication(BaseAuthentication):
+    """
+    Takes the token from the `token` query param, as the browsers EventSource can't send headers.
+    Unlike the API token it is signed for one task only and expires soon, as the URLs get into the access logs.
+    """
+
+    SALT = 'products_sync.task_stream'
+    MAX_AGE = 15 * 60
+
+    @classmethod
+    def get_token(cls, user, task_id: str) -> str:
+        return signing.dumps(dict(user_id=user.pk, task_id=task_id), salt=cls.SALT)
+
+    def authenticate(self, request):
+        if not (token := request.query_params.get('token')):
+            return None
+
+        try:
+            data = signing.loads(token, salt=self.SALT, max_age=self.MAX_AGE)
+        except signing.BadSignature:
+            raise AuthenticationFailed('Invalid or expired stream token.')
+
+        if data['task_id'] != request.parser_context['kwargs'].get('task_id'):
+            raise AuthenticationFailed('The stream token is issued for another task.')
+
+        user = get_user_model().objects.filter(pk=data['user_id'], is_active=True).first()
+        if user is None:
+            raise AuthenticationFailed('User inactive or deleted.')
+
+        return user, None
+
+    def authenticate_header(self, request):
+        # the unauthenticated requests are answered by 401 instead of 403
+        return 'Token'
+
+
+class ClosingIterator:
+    """
+    Calls `on_close` once the streaming response is closed, even if it has not been iterated
+    """
+
+    def __init__(self, iterator, on_close: callable):
+        self.iterator = iterator
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        if self.on_close is not None:
+            self.iterator.close()
+            self.on_close()
+            self.on_close = None
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets the `text/event-stream` requests pass the content negotiation, the errors are rendered as JSON
+    """
+
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
 class ManageCeleryTask(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -91,39 +243,14 @@ class ManageCeleryTask(APIView):
         """
         task = AsyncResult(task_id)
         state = task.state
-        redis_key = f"task_logs:{task_id}"
-
-        # Use LRANGE to get log items in the specified range
-        logs = redis_client.lrange(redis_key, int(from_index), -1)
-
-        # Decode the log items (assuming they are stored as UTF-8 strings)
-        # logs = [item.decode('utf-8') for item in logs]
-
-        gid = None
-        err_message = ''
-        status_code = status.HTTP_200_OK
 
-        if (result := task.result) is not None:
-            if isinstance(result, connection.Error):
-                status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-
-                if m := re.search(r"code=(\d{3})", str(result)):
-                    status_code = m[1]
-            elif isinstance(result, AssertionError):
-                status_code = status.HTTP_417_EXPECTATION_FAILED
-                err_message = str(result)
-            elif isinstance(result, dict):
-                gid = result.get('gid')
-            else:
-                status_code = status.HTTP_417_EXPECTATION_FAILED
-                err_message = "Got unexpected task result: %s" % str(result)
-
-        if err_message:
-            logger.error(err_message)
+        logs, next_index = get_task_logs(task_id, int(from_index))
+        gid, err_message, status_code = get_task_result(task)
 
         # TODO use serializer
         return Response(dict(
             logs=logs,
+            next_index=next_index,
             gid=gid,
             state=state,
             complete=task.ready(),
@@ -151,6 +278,86 @@ class ManageCeleryTask(APIView):
         return Response(result)
 
 
+class TaskLogsStreamView(APIView):
+    """
+    Streams the task logs as server-sent events, so the client doesn't have to poll `ManageCeleryTask`.
+
+    The logs are still read from the Redis list, the pub/sub channel only wakes up the stream when new lines
+    are flushed, so a reconnected client continues from the `Last-Event-ID` without losing lines.
+    """
+
+    authentication_classes = [TaskStreamTokenAuthentication, TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    KEEPALIVE_INTERVAL = 15
+    # the stream is closed periodically, the client reconnects automatically
+    MAX_STREAM_TIME = 600
+    RETRY_AFTER = 60
+
+    # the streams of all threads of the process
+    streams_semaphore = BoundedSemaphore(settings.TASK_LOGS_MAX_STREAMS)
+
+    def get(self, request, task_id):
+        from_index = request.headers.get('Last-Event-ID') or request.query_params.get('from_index') or 0
+
+        # the refused EventSource is closed by the browser, and the client falls back to polling
+        if not self.streams_semaphore.acquire(blocking=False):
+            return Response(dict(detail="Too many task logs streams, poll the logs instead"),
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': str(self.RETRY_AFTER)})
+
+        stream = ClosingIterator(self.stream(task_id, int(from_index)), on_close=self.streams_semaphore.release)
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+    @staticmethod
+    def format_event(event: str, data: dict, event_id: int = None) -> str:
+        id_line = f"id: {event_id}\n" if event_id is not None else ''
+        return f"{id_line}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream(self, task_id: str, from_index: int):
+        task = AsyncResult(task_id)
+        started_at = monotonic()
+        closing = False
+
+        # subscribe before reading the logs to not miss the lines flushed in between
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CeleryLogHandler.get_events_channel(task_id))
+
+        try:
+            while monotonic() - started_at < self.MAX_STREAM_TIME:
+                logs, from_index = get_task_logs(task_id, from_index)
+                if logs:
+                    yield self.format_event('logs', dict(
+                        logs=[item.decode('utf-8') for item in logs],
+                        next_index=from_index
+                    ), event_id=from_index)
+
+                if task.ready():
+                    gid, err_message, status_code = get_task_result(task)
+                    yield self.format_event('state', dict(
+                        gid=gid,
+                        state=task.state,
+                        complete=True,
+                        err_message=err_message,
+                        status_code=status_code
+                    ), event_id=from_index)
+                    return
+
+                # after the logs handler is closed only the task result is waited for
+                message = pubsub.get_message(timeout=1 if closing else self.KEEPALIVE_INTERVAL)
+                if message is None:
+                    yield ": keepalive\n\n"
+                elif message['data'] == CeleryLogHandler.CLOSED_EVENT.encode():
+                    closing = True
+        finally:
+            pubsub.close()
+
+
 class ProductsUpdateLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     serializer_class = ProductsUpdateLogSerializer
 
@@ -161,14 +368,17 @@ class ProductsUpdateLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
     @action(detail=False)
     def groups(self, request: Request) -> Response:
-        # TODO paginating
-        # first_rows = self.queryset.order_by('-gid', 'id').distinct('gid')
+        runs = SyncRun.with_changes(SyncRun.Types.PRODUCTS).order_by('-gid')
 
-        cte = With(self.queryset.distinct('gid'))
-        first_rows = cte.queryset().with_cte(cte).order_by('-gid', 'id')
+        serializer = SyncRunSerializer(self.paginate_queryset(runs), many=True)
+        return self.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(first_rows, many=True)
-        return Response(serializer.data)
+    # the flattened `changes` fields written to the CSV, the matched rows have the price and quantity changes,
+    # the unmatched ones have the products found by sku
+    CSV_MATCHED_CHANGES_COLUMNS = ['price_old', 'price_new', 'quantity_location', 'quantity_old', 'quantity_new']
+    CSV_UNMATCHED_CHANGES_COLUMNS = ['matched_by_sku']
+    CSV_CHUNK_SIZE = 2000
+    CSV_DATE_FORMAT = "%m-%d-%Y %H:%M:%S"
 
     @action(detail=False, url_path='download-csv/(?P<gid>\d+)/(?P<only_matched>[01])')
     def download_csv(self, request: Request, gid=None, only_matched=None):
@@ -177,17 +387,14 @@ class ProductsUpdateLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
         # getting only first row to create a filename
         queryset = self.queryset.filter(gid=gid).order_by('id')
-        serializer = self.get_serializer(queryset.first())
+        first_row = queryset.values('time', 'source').first()
 
-        # TODO use dedicated serializer to extract data for CSV
-
-        if not serializer.data:
+        if not first_row:
             _time = now()
             _source = ''
         else:
-            r = serializer.data
-            _time = pd.to_datetime(r['time'])
-            _source = r['source']
+            _time = localtime(first_row['time'])
+            _source = first_row['source']
 
         _type = {True: '_updated', False: '_unmatched'}.get(only_matched, '')
 
@@ -195,34 +402,37 @@ class ProductsUpdateLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             "products_sync_log_%s_%s_%s%s" % (gid, _time.strftime("%d%m%Y%H%M"), _source, _type)
         )
 
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
-        response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
-
         # now getting all rows
         if only_matched is True:
             queryset = queryset.exclude(changes__contains={'unmatched': True})
+            changes_columns = self.CSV_MATCHED_CHANGES_COLUMNS
         elif only_matched is False:
             queryset = queryset.filter(changes__contains={'unmatched': True})
+            changes_columns = self.CSV_UNMATCHED_CHANGES_COLUMNS
+        else:
+            changes_columns = self.CSV_MATCHED_CHANGES_COLUMNS + self.CSV_UNMATCHED_CHANGES_COLUMNS
 
-        serializer = self.get_serializer(queryset, many=True)
-        df = pd.DataFrame(serializer.data, columns=ProductsUpdateLogSerializer.Meta.fields)
-        if not df.empty:
-            df['time'] = pd.to_datetime(df['time'])
+        response = StreamingHttpResponse(self.iter_csv_rows(queryset, changes_columns), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
 
-            pd.json_normalize(df['changes'][0], sep='_')
-            changes_df = pd.json_normalize(df['changes'], sep='_')
+        return response
 
-            df = pd.concat([df, changes_df], axis=1)
+    def iter_csv_rows(self, queryset, changes_columns: list[str]):
+        """
+        Writes the CSV by rows reading the log by chunks, so the memory usage doesn't depend on the log size
+        """
 
-        # noinspection PyTypeChecker
-        df.drop(
-            columns=['gid', 'changes', 'unmatched'], errors='ignore'
-        ).to_csv(
-            response, index=False, date_format="%m-%d-%Y %H:%M:%S"
-        )
+        columns = [f for f in ProductsUpdateLogSerializer.Meta.fields if f not in ('gid', 'changes')]
+        writer = csv.writer(EchoBuffer())
 
-        return response
+        yield writer.writerow(columns + changes_columns)
+
+        for row in queryset.values(*columns, 'changes').iterator(chunk_size=self.CSV_CHUNK_SIZE):
+            row['time'] = localtime(row['time']).strftime(self.CSV_DATE_FORMAT)
+            changes = flatten_dict(row.pop('changes'))
+
+            yield writer.writerow([row[c] for c in columns] + [changes.get(c) for c in changes_columns])
 
 
 @api_view(['POST'])